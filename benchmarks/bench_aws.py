@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Benchmark the AWS bill calculations on synthetic detailed billing files.
+
+For each number of rows, billing files are generated once (see generate_aws_bills.py) and the
+following stages are timed, each in a fresh process so that its peak memory is its own:
+    aggregate    _aggregateBillFiles: unzip and parse the csv rows
+    sumUp        _sumUpBillFromDateToDate over the rows of all files, from the first day
+    corrections  _applyBillCorrections, repeated --corrections times
+    flows        CalculateBill, then the AWSBillAlarm and AWSBillDataEgress windows, per billEngine
+
+Wall time and peak resident memory (ru_maxrss) are reported; with --tracemalloc the peak of the
+Python allocations is reported too, from a separate run since tracing slows the code down.
+Results are printed and appended to --output.
+
+Example:
+    python benchmarks/bench_aws.py --rows 10000,1000000 --engines python,numpy,index
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarkDirectory, '..', 'src'))
+sys.path.insert(0, benchmarkDirectory)
+
+from generate_aws_bills import generateBillFiles
+
+stageList = [ 'aggregate', 'sumUp', 'corrections', 'flows' ]
+
+
+def billFiles(dataPath, rows, months):
+    """Generate, or reuse, the billing files with rows line items; returns their names"""
+    billDirectory = os.path.join(dataPath, 'rows-%d-months-%d' % ( rows, months ))
+    doneFileName = os.path.join(billDirectory, 'done.json')
+    if os.path.exists(doneFileName):
+        with open(doneFileName) as doneFile:
+            return json.load(doneFile)
+    print('Generating %d rows in %s' % ( rows, billDirectory ), file=sys.stderr)
+    zipFileList = generateBillFiles(billDirectory, rows, months=months)
+    with open(doneFileName, 'w') as doneFile:
+        json.dump(zipFileList, doneFile)
+    return zipFileList
+
+
+def runStage(stage, engine, zipFileList, corrections, traceMemory):
+    """Run one stage in this process; returns the measurements"""
+    from bill_calculator_hep.AWSBillAnalysis import AWSBillCalculator, AWSBillAlarm, AWSBillDataEgress
+
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.WARNING)
+    globalConfig = { 'outputPath': os.path.dirname(zipFileList[0]), 'graphite_host': 'localhost',
+                     'grafana_dashboard': '', 'billEngine': engine }
+    # Sum up from the first day of the first file
+    firstMonth = os.path.basename(zipFileList[0])[-len('YYYY-MM.csv.zip'):-len('.csv.zip')]
+    constants = { 'credentialsProfileName': 'bench', 'accountNumber': '123456789012', 'bucketBillingName': 'bench',
+                  'lastKnownBillDate': datetime.datetime.strptime(firstMonth, '%Y-%m').strftime('%m/%d/%y %H:%M'),
+                  'balanceAtDate': 1000000.0, 'applyDiscount': True,
+                  'costRatePerHourInLastSixHoursAlarmThreshold': 20, 'costRatePerHourInLastDayAlarmThreshold': 20,
+                  'burnRateAlarmThreshold': 20, 'timeDeltaforCostCalculations': 10 }
+    calculator = AWSBillCalculator('bench', globalConfig, constants, logger)
+    # Read the generated files instead of the billing bucket
+    calculator._downloadBillFiles = lambda: zipFileList
+    calculator.billFileIdentityDict = dict( ( zipFileName, ( '', os.path.getsize(zipFileName) ) ) for zipFileName in zipFileList )
+
+    billSummaryDict = None
+    if stage == 'corrections':
+        lastStartDate, billSummaryDict = calculator._sumUpBillFromDateToDate(
+            calculator._normalizeBillRows(calculator._aggregateBillFiles(zipFileList)), constants['lastKnownBillDate'])
+
+    if traceMemory:
+        tracemalloc.start()
+    startTime = time.perf_counter()
+    result = {}
+    if stage == 'aggregate':
+        result['rows'] = sum( 1 for row in calculator._aggregateBillFiles(zipFileList) )
+    elif stage == 'sumUp':
+        lastStartDate, billSummaryDict = calculator._sumUpBillFromDateToDate(
+            calculator._normalizeBillRows(calculator._aggregateBillFiles(zipFileList)), constants['lastKnownBillDate'])
+        result['total'] = billSummaryDict['Total']
+    elif stage == 'corrections':
+        for i in range(corrections):
+            calculator._applyBillCorrections(dict(billSummaryDict))
+        result['calls'] = corrections
+    elif stage == 'flows':
+        lastStartDate, billSummaryDict = calculator.CalculateBill()
+        AWSBillAlarm(calculator, 'bench', globalConfig, constants, logger).ExtractAlarmConditions()
+        AWSBillDataEgress(calculator, 'bench', globalConfig, constants, logger).ExtractDataEgressConditions()
+        result['total'] = billSummaryDict['Total']
+    result['wallSeconds'] = time.perf_counter() - startTime
+    if traceMemory:
+        result['tracemallocPeakMB'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['maxRssMB'] = maxRss / ( 2**20 if sys.platform == 'darwin' else 2**10 )
+    return result
+
+
+def runStageInProcess(stage, engine, zipFileList, corrections, traceMemory):
+    command = [ sys.executable, os.path.abspath(__file__), '--runStage', stage, '--engines', engine,
+                '--corrections', str(corrections), '--zipFiles', json.dumps(zipFileList) ]
+    if traceMemory:
+        command.append('--tracemalloc')
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10000,1000000,10000000', help='comma separated numbers of line items')
+    parser.add_argument('--months', type=int, default=3, help='number of monthly files')
+    parser.add_argument('--engines', default='python,numpy,index', help='comma separated billEngine values for the flows')
+    parser.add_argument('--stages', default=','.join(stageList), help='comma separated stages among ' + ', '.join(stageList))
+    parser.add_argument('--corrections', type=int, default=10000, help='number of _applyBillCorrections calls')
+    parser.add_argument('--dataPath', default=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'bill-calculator-bench'),
+                        help='directory of the generated billing files, reused across runs')
+    parser.add_argument('--output', default=os.path.join(benchmarkDirectory, '..', 'bench_output.txt'),
+                        help='file the results are appended to')
+    parser.add_argument('--tracemalloc', action='store_true', help='also measure the peak of the Python allocations')
+    # Internal: run a single stage and print its measurements
+    parser.add_argument('--runStage', help=argparse.SUPPRESS)
+    parser.add_argument('--zipFiles', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.runStage:
+        print(json.dumps(runStage(args.runStage, args.engines, json.loads(args.zipFiles), args.corrections, args.tracemalloc)))
+        return
+
+    lineList = [ '# %s python %s on %s' % ( datetime.datetime.now().isoformat(timespec='seconds'), platform.python_version(), platform.node() ),
+                 '%-10s %-12s %-8s %12s %12s %16s' % ( 'rows', 'stage', 'engine', 'wall (s)', 'maxRSS (MB)', 'tracemalloc (MB)' ) ]
+    print('\n'.join(lineList))
+    for rows in [ int(rows) for rows in args.rows.split(',') ]:
+        zipFileList = billFiles(args.dataPath, rows, args.months)
+        for stage in args.stages.split(','):
+            # Only the flows depend on the engine
+            for engine in ( args.engines.split(',') if stage == 'flows' else [ 'python' ] ):
+                result = runStageInProcess(stage, engine, zipFileList, args.corrections, False)
+                tracemallocPeak = ''
+                if args.tracemalloc:
+                    tracemallocPeak = '%.1f' % runStageInProcess(stage, engine, zipFileList, args.corrections, True)['tracemallocPeakMB']
+                line = '%-10d %-12s %-8s %12.3f %12.1f %16s' % ( rows, stage, engine, result['wallSeconds'], result['maxRssMB'], tracemallocPeak )
+                print(line)
+                lineList.append(line)
+
+    with open(args.output, 'a') as outputFile:
+        outputFile.write('\n'.join(lineList) + '\n\n')
+
+
+if __name__ == '__main__':
+    main()
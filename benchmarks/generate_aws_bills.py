@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Generate synthetic AWS detailed billing files, for benchmarks.
+
+Writes one zipped detailed line items file per month, named as in the billing bucket:
+    <accountNumber>-aws-billing-detailed-line-items-YYYY-MM.csv.zip                        (before Feb 2016)
+    <accountNumber>-aws-billing-detailed-line-items-with-resources-and-tags-YYYY-MM.csv.zip (from Feb 2016)
+The rows are streamed to the zip file, so files of tens of millions of rows can be generated.
+
+Example:
+    python benchmarks/generate_aws_bills.py --rows 1000000 --months 3 --outputPath /tmp/bills
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import os
+import random
+import zipfile
+
+oldFormatHeaderList = [ 'InvoiceID', 'PayerAccountId', 'LinkedAccountId', 'RecordType', 'ProductName', 'RateId',
+                        'SubscriptionId', 'PricingPlanId', 'UsageType', 'Operation', 'AvailabilityZone',
+                        'ReservedInstance', 'ItemDescription', 'UsageStartDate', 'UsageEndDate', 'UsageQuantity',
+                        'BlendedRate', 'BlendedCost', 'UnBlendedRate', 'UnblendedCost' ]
+# Since Feb 2016: RecordId as 5th column and ResourceId as last column
+newFormatHeaderList = oldFormatHeaderList[0:4] + [ 'RecordId' ] + oldFormatHeaderList[4:] + [ 'ResourceId' ]
+
+productNameList = [ 'Amazon Elastic Compute Cloud', 'Amazon Simple Storage Service', 'AWS Support (Business)',
+                    'Amazon Route 53', 'AWS Key Management Service', 'Amazon Simple Queue Service',
+                    'Amazon Simple Notification Service', 'AWS CloudTrail', 'Amazon CloudWatch',
+                    'Amazon Elastic File System', 'Amazon Virtual Private Cloud', 'AWS Lambda' ]
+
+# Data out rows are told apart by 'data transferred out' in their ItemDescription, see AWSBillCalculator._classifyItemDescription
+dataOutItemDescriptionString = '$0.090 per GB - first 10 TB / month data transferred out'
+eduItemDescriptionString = 'EDU_R_FY2015_Q4_FermiNationalAcceleratorLab_Fermilab'
+unauthorizedUsageItemDescriptionString = 'Unauthorized Usage Credit'
+commentLineString = "Don't see your tags in the report? New tags are excluded by default - go to " + \
+    "https://portal.aws.amazon.com/gp/aws/developer/account?action=cost-allocation-report to update your cost allocation keys."
+
+
+def billFileName(accountNumber, year, month):
+    """Name of the billing file of a month, in the format AWS used at that date"""
+    if ( year, month ) >= ( 2016, 2 ):
+        return '%s-aws-billing-detailed-line-items-with-resources-and-tags-%04d-%02d.csv.zip' % ( accountNumber, year, month )
+    return '%s-aws-billing-detailed-line-items-%04d-%02d.csv.zip' % ( accountNumber, year, month )
+
+
+def generateBillFile(zipFileName, year, month, rows, numberOfProducts = 8, eduFraction = 0.02,
+                     dataOutFraction = 0.1, trailer = True, accountNumber = '123456789012', seed = 0):
+    """Write a zipped detailed line items file with rows line items for the month.
+
+    Args:
+        zipFileName: the file to write; the format (old or with-resources-and-tags) follows the file name
+        numberOfProducts: number of distinct ProductName values
+        eduFraction: fraction of rows that are EDU_ grant credits (plus a few Unauthorized Usage credits)
+        dataOutFraction: fraction of rows that are data transfer out charges
+        trailer: append the final Total rows and, in the new format, the comment line
+    """
+    newFormat = 'with-resources-and-tags' in os.path.basename(zipFileName)
+    headerList = newFormatHeaderList if newFormat else oldFormatHeaderList
+    randomGenerator = random.Random('%s-%d-%d' % ( seed, year, month ))
+    productList = [ productNameList[index % len(productNameList)] + ( '' if index < len(productNameList) else ' %d' % index )
+                    for index in range(numberOfProducts) ]
+    monthStartDatetime = datetime.datetime(year, month, 1)
+    if month == 12:
+        hoursInMonth = int( ( datetime.datetime(year + 1, 1, 1) - monthStartDatetime ).total_seconds() // 3600 )
+    else:
+        hoursInMonth = int( ( datetime.datetime(year, month + 1, 1) - monthStartDatetime ).total_seconds() // 3600 )
+    # Format the dates of the month once
+    hourList = [ ( ( monthStartDatetime + datetime.timedelta(hours=hour) ).strftime('%Y-%m-%d %H:%M:%S'),
+                   ( monthStartDatetime + datetime.timedelta(hours=hour + 1) ).strftime('%Y-%m-%d %H:%M:%S') )
+                 for hour in range(hoursInMonth) ]
+
+    def billRowList(recordType, productName, itemDescription, usageStartDate, usageEndDate, usageQuantity, cost, recordId, resourceId):
+        rowList = [ 'Estimated', accountNumber, accountNumber, recordType ]
+        if newFormat:
+            rowList.append( recordId )
+        rowList += [ productName, '', '', '', 'BoxUsage:m4.large', 'RunInstances', 'us-east-1a', 'N', itemDescription,
+                     usageStartDate, usageEndDate, usageQuantity, '', '', '', cost ]
+        if newFormat:
+            rowList.append( resourceId )
+        return rowList
+
+    billingFileName = os.path.basename(zipFileName)[:-len('.zip')]
+    with zipfile.ZipFile(zipFileName, 'w', zipfile.ZIP_DEFLATED) as zipFile, \
+         zipFile.open(billingFileName, 'w', force_zip64=True) as billCSVFile:
+        billCSVTextFile = io.TextIOWrapper(billCSVFile, encoding='utf-8', newline='')
+        billCSVWriter = csv.writer(billCSVTextFile, quoting=csv.QUOTE_ALL if newFormat else csv.QUOTE_MINIMAL)
+        billCSVWriter.writerow(headerList)
+        # Rows are in chronological order, as in the files from AWS
+        for rowIndex in range(rows):
+            usageStartDate, usageEndDate = hourList[ rowIndex * hoursInMonth // rows ]
+            productName = randomGenerator.choice(productList)
+            draw = randomGenerator.random()
+            if draw < eduFraction:
+                itemDescription = eduItemDescriptionString
+                usageQuantity = ''
+                cost = '%.10f' % -( randomGenerator.random() * 5 )
+            elif draw < eduFraction * 1.1:
+                itemDescription = unauthorizedUsageItemDescriptionString
+                usageQuantity = ''
+                cost = '%.10f' % -( randomGenerator.random() )
+            elif draw < eduFraction * 1.1 + dataOutFraction:
+                itemDescription = dataOutItemDescriptionString
+                usageQuantity = '%.10f' % ( randomGenerator.random() * 20 )
+                cost = '%.10f' % ( float(usageQuantity) * 0.09 )
+            else:
+                itemDescription = '$0.12 per On Demand Linux m4.large Instance Hour'
+                usageQuantity = '%.10f' % randomGenerator.random()
+                cost = '%.10f' % ( float(usageQuantity) * 0.12 )
+            billCSVWriter.writerow(billRowList('LineItem', productName, itemDescription, usageStartDate, usageEndDate,
+                                               usageQuantity, cost, str(rowIndex), 'i-%08x' % randomGenerator.randrange(4096)))
+        if trailer:
+            billCSVWriter.writerow(billRowList('InvoiceTotal', '', 'Total statement amount for period %d/%d' % ( month, year ),
+                                               '', '', '', '0.0', '', ''))
+            billCSVWriter.writerow(billRowList('AccountTotal', '', 'Total for linked account# %s' % accountNumber,
+                                               '', '', '', '0.0', '', ''))
+            if newFormat:
+                billCSVWriter.writerow([ commentLineString ])
+        billCSVTextFile.flush()
+        billCSVTextFile.detach()
+
+
+def generateBillFiles(outputPath, rows, months = 3, firstMonth = '2016-01', **generateBillFileArgs):
+    """Generate months consecutive billing files from firstMonth ('YYYY-MM') with rows line items in total.
+
+    Returns the list of file names, in chronological order
+    """
+    os.makedirs(outputPath, exist_ok=True)
+    year, month = [ int(field) for field in firstMonth.split('-') ]
+    accountNumber = generateBillFileArgs.get('accountNumber', '123456789012')
+    zipFileNameList = []
+    for monthIndex in range(months):
+        monthRows = rows // months + ( 1 if monthIndex < rows % months else 0 )
+        zipFileName = os.path.join(outputPath, billFileName(accountNumber, year, month))
+        generateBillFile(zipFileName, year, month, monthRows, **generateBillFileArgs)
+        zipFileNameList.append(zipFileName)
+        year, month = ( year + 1, 1 ) if month == 12 else ( year, month + 1 )
+    return zipFileNameList
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--outputPath', required=True, help='directory of the billing files')
+    parser.add_argument('--rows', type=int, default=10000, help='line items in total, over all months')
+    parser.add_argument('--months', type=int, default=3, help='number of monthly files')
+    parser.add_argument('--firstMonth', default='2016-01', help='YYYY-MM of the first file; files before 2016-02 are in the old format')
+    parser.add_argument('--products', type=int, default=8, help='number of distinct products')
+    parser.add_argument('--eduFraction', type=float, default=0.02, help='fraction of EDU_ credit rows')
+    parser.add_argument('--noTrailer', action='store_true', help='do not write the final Total and comment lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for zipFileName in generateBillFiles(args.outputPath, args.rows, months=args.months, firstMonth=args.firstMonth,
+                                         numberOfProducts=args.products, eduFraction=args.eduFraction,
+                                         trailer=not args.noTrailer, seed=args.seed):
+        print(zipFileName)
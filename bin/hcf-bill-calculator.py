@@ -1,21 +1,28 @@
-#!/usr/bin/python3.4
+#!/usr/bin/python3
 
 import logging
 import logging.handlers
 import sys
 import os
 import time
-import schedule
 import configparser
 import pwd
 import socket
 import traceback
 import threading
+import concurrent.futures
+import functools
+import contextlib
+import resource
+import tracemalloc
 import yaml
 
-from bill_calculator_hep import GCEBillAnalysis, GCEBillCalculator, GCEBillAlarm
+from bill_calculator_hep import GCEBillAnalysis, GCEBillCalculator, GCEBillAlarm, GCEBigQueryContext
 from bill_calculator_hep import AWSBillAnalysis, AWSBillCalculator, AWSBillAlarm, AWSBillDataEgress
 from bill_calculator_hep import submitAlarm, sendAlarmByEmail, submitAlarmOnServiceNow
+from bill_calculator_hep import graphite
+from bill_calculator_hep.BillingScheduler import BillingScheduler
+from bill_calculator_hep.StageMetrics import StageMetrics
 
 class hcfBillingCalculator():
 
@@ -35,7 +42,7 @@ class hcfBillingCalculator():
             # Creating a rotating file handler and adding it to our logger
             fh=logging.handlers.RotatingFileHandler(config.get('Env','LOG_DIR')+"billing-calculator.log",maxBytes=536870912,backupCount=5)
             fh.setLevel(debugLevel)
-            FORMAT="%(asctime)s:%(levelname)s:%(message)s"
+            FORMAT="%(asctime)s:%(levelname)s:%(name)s:%(message)s"
             fh.setFormatter(logging.Formatter(FORMAT))
 
             self.logger.addHandler(fh)
@@ -61,20 +68,86 @@ class hcfBillingCalculator():
     def run(self, log):
         log.info("Scheduling daemons")
         #os.chdir(os.environ.get('BILL_DATA_DIR'))
-        schedule.every().day.at("01:05").do(self.AWSBillAnalysis, logger=log)
-        schedule.every().day.at("07:05").do(self.AWSBillAnalysis, logger=log)
-        schedule.every().day.at("13:05").do(self.AWSBillAnalysis, logger=log)
-        schedule.every().day.at("19:05").do(self.AWSBillAnalysis, logger=log)
-        schedule.every().day.at("03:05").do(self.GCEBillAnalysis, logger=log)
-        schedule.every().day.at("15:05").do(self.GCEBillAnalysis, logger=log)
-        #TEsting scheduling
-        #schedule.every(2).minutes.do(self.AWSBillAnalysis, logger=log)
-        #schedule.every(1).minutes.do(self.GCEBillAnalysis, logger=log)
-        #self.GCEBillAnalysis(logger=log)
-
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        # The scheduler sleeps until the next run; AWS and GCE run in their own worker,
+        # and a run is skipped while the previous run of the same provider is still going
+        self.scheduler = BillingScheduler(log)
+        self.scheduler.addDailyJob('AWS', self.AWSBillAnalysis, [ "01:05", "07:05", "13:05", "19:05" ], logger=log)
+        self.scheduler.addDailyJob('GCE', self.GCEBillAnalysis, [ "03:05", "15:05" ], logger=log)
+        # Optional billArrivalPollMinutes in the global section of AWS.yaml: also run AWS as soon as
+        # a billing file changes in S3 (new ETag or LastModified), checking every so many minutes
+        with open('/etc/hepcloud/config.d/AWS.yaml', 'r') as stream:
+            awsGlobalConf = yaml.safe_load(stream)['global']
+        self.awsBillFilesStateDict = None
+        if ("billArrivalPollMinutes" in awsGlobalConf.keys()) and (awsGlobalConf['billArrivalPollMinutes'] != 0):
+            self.awsBillFilesStateDict = {}
+            self.scheduler.addArrivalTrigger('AWS', functools.partial(self.AWSBillDataArrived, logger=log),
+                                             60 * awsGlobalConf['billArrivalPollMinutes'])
+        #Testing scheduling
+        #self.scheduler.runJob('GCE', 'test')
+
+        self.scheduler.run()
+
+    def AWSBillDataArrived(self, logger):
+        """Return True if the billing files of an AWS account changed in S3 since the last check or run.
+
+        The first check of an account only records the state of its files.
+        """
+        with open('/etc/hepcloud/config.d/AWS.yaml', 'r') as stream:
+            config = yaml.safe_load(stream)
+        return self.updateAWSBillFilesState(config, logger)
+
+    def updateAWSBillFilesState(self, config, logger):
+        """Record the state of the billing files of every AWS account; return True if some changed since the last record"""
+        arrived = False
+        for constantsDict in config['accounts']:
+            account = constantsDict['accountName']
+            calculator = AWSBillCalculator(account, config['global'], constantsDict, logger.getChild(str(account)))
+            billFilesStateDict = calculator.getBillFilesState()
+            previousBillFilesStateDict = self.awsBillFilesStateDict.get(account)
+            if previousBillFilesStateDict is not None and billFilesStateDict != previousBillFilesStateDict:
+                changedKeyList = sorted( key for key in billFilesStateDict if billFilesStateDict[key] != previousBillFilesStateDict.get(key) )
+                logger.info("New billing data for AWS {0} account: {1}".format(account, changedKeyList))
+                arrived = True
+            self.awsBillFilesStateDict[account] = billFilesStateDict
+        return arrived
+
+    def runAccounts(self, accountAnalysis, provider, globalConf, snowConf, accountList, logger):
+        """Run accountAnalysis for every account, concurrently in a bounded pool of workers.
+
+        Optional global configuration:
+            accountWorkers: maximum number of accounts analyzed at the same time (default 1)
+            accountWorkerType: 'thread' or 'process' (default 'thread')
+
+        Each account logs through its own child logger (e.g. billing-calculator-main.RnD) and its
+        errors are captured and logged without stopping the other accounts.
+        Returns the list of accounts whose analysis failed.
+        """
+        maxWorkers = globalConf.get('accountWorkers', 1)
+        workerType = globalConf.get('accountWorkerType', 'thread')
+        if workerType == 'process':
+            executorClass = concurrent.futures.ProcessPoolExecutor
+        else:
+            executorClass = concurrent.futures.ThreadPoolExecutor
+        logger.info("Running {0} {1} accounts with up to {2} {3} workers".format(len(accountList), provider, maxWorkers, workerType))
+
+        failedAccountList = []
+        with executorClass(max_workers=maxWorkers) as executor:
+            futureDict = {}
+            for constantsDict in accountList:
+                account = constantsDict['accountName']
+                accountLogger = logger.getChild(str(account))
+                future = executor.submit(accountAnalysis, account, globalConf, snowConf, constantsDict, accountLogger)
+                futureDict[future] = (account, accountLogger)
+
+            for future in concurrent.futures.as_completed(futureDict):
+                account, accountLogger = futureDict[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    accountLogger.info("--------------------------- End of {0} calculation for {1} account {2} with ERRORS ------------------------------".format(provider, account, time.time()))
+                    accountLogger.exception(error)
+                    failedAccountList.append(account)
+        return failedAccountList
 
     def GCEBillAnalysis(self, logger):
         GCEconstants = "/etc/hepcloud/config.d/GCE.yaml"
@@ -84,32 +157,28 @@ class hcfBillingCalculator():
         globalConf = config['global']
         snowConf = config['snow']
 
-        for constantsDict in config['accounts']:
-            account = constantsDict['accountName']
-            try:
-                os.chdir(globalConf['outputPath'])
-                logger.info(" ---- Billing Analysis for GCE {0} account".format(account))
-                calculator = GCEBillCalculator(account, globalConf, constantsDict, logger)
-                lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict = calculator.CalculateBill()
-                calculator.sendDataToGraphite(CorrectedBillSummaryDict)
-
-                logger.info(" ---- Alarm calculations for GCE {0} account".format(account))
-                alarm = GCEBillAlarm(calculator, account, globalConf, constantsDict, logger)
-                message = alarm.EvaluateAlarmConditions(publishData = True)
-                if message:
-                  sendAlarmByEmail(message,
-                                   emailReceipientString = constantsDict['emailReceipientForAlarms'],
-                                   subject = '[GCE Billing Alarm] Alarm threshold surpassed for cost rate for %s account'%(account,),
-                                   sender = 'GCEBillAlarm@%s'%(socket.gethostname(),),
-                                   verbose = False)
-                  submitAlarmOnServiceNow (snowConf, message, "GCE Bill Spending Alarm")
-
-                logger.debug(message)
-                logger.debug(message)
-            except Exception as error:
-                logger.info("--------------------------- End of GCE calculation cycle {0} with ERRORS ------------------------------".format(time.time()))
-                logger.exception(error)
-                continue 
+        # No chdir to outputPath: the AWS and GCE cycles run in threads of the same process, and the
+        # calculators build their file names from outputPath
+        # Accounts analyzed in threads share one BigQuery client (credentials, HTTP connections) for the cycle;
+        # in processes every account creates its own
+        accountAnalysis = GCEAccountAnalysis
+        bigqueryContext = None
+        if globalConf.get('accountWorkerType', 'thread') != 'process':
+            bigqueryContext = GCEBigQueryContext(globalConf, logger)
+            accountAnalysis = functools.partial(GCEAccountAnalysis, bigqueryContext=bigqueryContext)
+        cycleMetrics = StageMetrics()
+        try:
+            with cycleMetrics.stage('cycle'):
+                failedAccountList = self.runAccounts(accountAnalysis, 'GCE', globalConf, snowConf, config['accounts'], logger)
+        finally:
+            if bigqueryContext is not None:
+                bigqueryContext.close()
+        cycleMetrics.merge({ 'accounts': len(config['accounts']), 'failedAccounts': len(failedAccountList) })
+        publishStageMetrics(globalConf, 'cycle', cycleMetrics, logger)
+        if failedAccountList:
+            logger.info("--------------------------- End of GCE calculation cycle {0} with ERRORS for {1} ------------------------------".format(time.time(), failedAccountList))
+        else:
+            logger.info("--------------------------- End of GCE calculation cycle {0} ------------------------------".format(time.time()))
 
     def AWSBillAnalysis(self, logger):
         AWSconstants = '/etc/hepcloud/config.d/AWS.yaml'
@@ -119,41 +188,197 @@ class hcfBillingCalculator():
         logger.info("--------------------------- Start AWS calculation cycle {0} ------------------------------".format(time.time()))
         globalConf = config['global']
         snowConf = config['snow']
-    
-        for constantsDict in config['accounts']:
-            account = constantsDict['accountName']
+
+        # The run covers the billing files as they are now: record their state, so that the
+        # arrival check only triggers on files that change after the run started
+        if self.awsBillFilesStateDict is not None:
             try:
-                os.chdir(globalConf['outputPath'])
-                logger.info(" ---- Billing Analysis for AWS {0} account".format(account))
-                calculator = AWSBillCalculator(account, globalConf, constantsDict, logger)
-                lastStartDateBilledConsideredDatetime, \
-                CorrectedBillSummaryDict = calculator.CalculateBill()
-                calculator.sendDataToGraphite(CorrectedBillSummaryDict)
-    
-                logger.info(" ---- Alarm calculations for AWS {0} account".format(account))
-                alarm = AWSBillAlarm(calculator, account, globalConf, constantsDict, logger)
-                message = alarm.EvaluateAlarmConditions(publishData = True)
-                if message:
+                self.updateAWSBillFilesState(config, logger)
+            except Exception as error:
+                logger.warning("Could not record the state of the AWS billing files: {0}".format(error))
+        cycleMetrics = StageMetrics()
+        with memoryProfile(globalConf, logger, "AWS calculation cycle"), cycleMetrics.stage('cycle'):
+            failedAccountList = self.runAccounts(AWSAccountAnalysis, 'AWS', globalConf, snowConf, config['accounts'], logger)
+        cycleMetrics.merge({ 'accounts': len(config['accounts']), 'failedAccounts': len(failedAccountList) })
+        publishStageMetrics(globalConf, 'cycle', cycleMetrics, logger)
+        logger.info("Graphite publisher statistics: {0}".format(graphitePublisher(globalConf).get_stats()))
+        if failedAccountList:
+            logger.info("--------------------------- End of AWS calculation cycle {0} with ERRORS for {1} ------------------------------".format(time.time(), failedAccountList))
+        else:
+            logger.info("--------------------------- End of AWS calculation cycle {0} ------------------------------".format(time.time()))
+
+
+# Peak resident memory of the memoryProfile blocks running in this process, as { 'peakKB': ... }:
+# the blocks can be nested (an account within the cycle) or concurrent (accounts in threads)
+memoryPeakLock = threading.Lock()
+memoryPeakDictList = []
+
+def readPeakRssKB():
+    """Peak resident memory of the process since its last reset (VmHWM) in kB, or None if not available"""
+    try:
+        with open('/proc/self/status') as statusFile:
+            for line in statusFile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def resetPeakRss():
+    """Reset the peak resident memory of the process to the current one; returns False if not possible"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clearRefsFile:
+            clearRefsFile.write('5')
+        return True
+    except OSError:
+        return False
+
+def updatePeakRss():
+    """Fold the peak resident memory since the last reset into the peaks of the running blocks; call with memoryPeakLock"""
+    peakKB = readPeakRssKB()
+    if peakKB is not None:
+        for peakDict in memoryPeakDictList:
+            peakDict['peakKB'] = max(peakDict['peakKB'], peakKB)
+
+@contextlib.contextmanager
+def memoryProfile(globalConf, logger, label):
+    """Log the memory used by the block: resident memory at the end, peak resident memory during the block,
+    and with tracemalloc, peak of the Python allocations and their largest sources.
+
+    Optional global configuration:
+        memoryProfiling: 1 to trace the Python allocations with tracemalloc (default 0: resident memory only)
+
+    The peak resident memory of the process is reset when a block starts (/proc/self/clear_refs), after being
+    folded into the peaks of the blocks already running, so that each block gets the peak reached while it ran,
+    not since the daemon or worker started. Memory is counted per process: with accounts analyzed in threads,
+    the peak of an account includes the accounts running at the same time. Where the peak cannot be reset,
+    the peak since the process started (ru_maxrss) is logged.
+    """
+    traceMemory = ("memoryProfiling" in globalConf.keys()) and (globalConf['memoryProfiling'] != 0)
+    if traceMemory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    peakDict = { 'peakKB': 0 }
+    with memoryPeakLock:
+        updatePeakRss()
+        peakResetDone = readPeakRssKB() is not None and resetPeakRss()
+        memoryPeakDictList.append(peakDict)
+    try:
+        yield
+    finally:
+        with memoryPeakLock:
+            updatePeakRss()
+            memoryPeakDictList.remove(peakDict)
+        if peakResetDone:
+            peakRssString = "peak RSS {0:.1f} MB".format(peakDict['peakKB'] / 1024.0)
+        else:
+            # ru_maxrss is in kB on Linux
+            peakRssString = "peak RSS since process start {0:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+        rssMB = None
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as statmFile:
+                rssMB = int(statmFile.read().split()[1]) * resource.getpagesize() / 2**20
+        logger.info("Memory after {0}: RSS {1} MB, {2}".format(label, 'n/a' if rssMB is None else '%.1f' % rssMB, peakRssString))
+        if traceMemory:
+            tracedBytes, peakTracedBytes = tracemalloc.get_traced_memory()
+            logger.info("Python allocations in {0}: {1:.1f} MB now, {2:.1f} MB at peak".format(label, tracedBytes / 2**20, peakTracedBytes / 2**20))
+            for statistic in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+                logger.debug("Python allocations in {0}: {1}".format(label, statistic))
+
+def graphitePublisher(globalConf):
+    """Graphite publisher of this process.
+
+    Optional global configuration:
+        graphiteSpoolFile: file keeping the points not yet delivered (default outputPath/graphite-spool.bin)
+        graphiteQueueSize: maximum number of points waiting in memory (default 10000)
+    """
+    spoolFile = globalConf.get('graphiteSpoolFile', os.path.join(globalConf['outputPath'], 'graphite-spool.bin'))
+    return graphite.get_publisher(globalConf['graphite_host'], spoolFile,
+                                  max_queued_points=globalConf.get('graphiteQueueSize', 10000))
+
+def publishStageMetrics(globalConf, name, stageMetrics, logger):
+    """Log the stage durations and counters of an account, or of the cycle, and send them to the
+    self-monitoring namespace of Graphite, under name.
+
+    Optional global configuration:
+        graphite_context_monitoring: namespace of the self-monitoring metrics
+            (default: next to the billing data, e.g. hepcloud.gce.billing_monitoring. for hepcloud.gce.billing.)
+    """
+    graphiteContext = globalConf.get('graphite_context_monitoring', globalConf['graphite_context_billing'].rstrip('.') + '_monitoring.') + str(name)
+    metricDict = stageMetrics.asDict()
+    logger.info("Stage metrics of {0}: {1}".format(name, ', '.join('%s=%g' % (key, metricDict[key]) for key in sorted(metricDict))))
+    graphitePublisher(globalConf).send_dict(graphiteContext, metricDict)
+
+def GCEAccountAnalysis(account, globalConf, snowConf, constantsDict, logger, bigqueryContext = None):
+    """Billing, alarm chain for one GCE account"""
+    stageMetrics = StageMetrics()
+    calculator = None
+    try:
+        with stageMetrics.stage('account'):
+            logger.info(" ---- Billing Analysis for GCE {0} account".format(account))
+            calculator = GCEBillCalculator(account, globalConf, constantsDict, logger, bigquery_context = bigqueryContext, stage_metrics = stageMetrics)
+            CorrectedBillSummaryDict = calculator.calculate_bill().iloc[0].to_dict()
+            calculator.send_data_to_graphite(CorrectedBillSummaryDict)
+
+            logger.info(" ---- Alarm calculations for GCE {0} account".format(account))
+            alarm = GCEBillAlarm(calculator, account, globalConf, constantsDict, logger)
+            message = alarm.EvaluateAlarmConditions(publishData = True)
+            if message:
+              with stageMetrics.stage('smtp'):
+                  sendAlarmByEmail(message,
+                                   emailReceipientString = constantsDict['emailReceipientForAlarms'],
+                                   subject = '[GCE Billing Alarm] Alarm threshold surpassed for cost rate for %s account'%(account,),
+                                   sender = 'GCEBillAlarm@%s'%(socket.gethostname(),),
+                                   verbose = False)
+              with stageMetrics.stage('serviceNow'):
+                  submitAlarmOnServiceNow (snowConf, message, "GCE Bill Spending Alarm")
+
+            logger.debug(message)
+    finally:
+        # The daemon runs for good: release the cache connection of the account at the end of every cycle
+        if calculator is not None:
+            calculator.close()
+        publishStageMetrics(globalConf, account, stageMetrics, logger)
+
+def AWSAccountAnalysis(account, globalConf, snowConf, constantsDict, logger):
+    """Billing, alarm, data egress chain for one AWS account"""
+    # The billing, alarm and data egress data of the account are sent together at the end of the chain,
+    # by a background publisher that spools them to disk while Graphite is unreachable
+    # The durations and counters of the stages of the chain are sent to the self-monitoring namespace at the end
+    stageMetrics = StageMetrics()
+    graphiteBatch = graphite.GraphiteBatch(graphitePublisher(globalConf))
+    try:
+        with memoryProfile(globalConf, logger, "AWS {0} account".format(account)), stageMetrics.stage('account'):
+            logger.info(" ---- Billing Analysis for AWS {0} account".format(account))
+            calculator = AWSBillCalculator(account, globalConf, constantsDict, logger, stageMetrics = stageMetrics)
+            lastStartDateBilledConsideredDatetime, \
+            CorrectedBillSummaryDict = calculator.CalculateBill()
+            calculator.sendDataToGraphite(CorrectedBillSummaryDict, graphiteBatch)
+
+            logger.info(" ---- Alarm calculations for AWS {0} account".format(account))
+            alarm = AWSBillAlarm(calculator, account, globalConf, constantsDict, logger)
+            message = alarm.EvaluateAlarmConditions(publishData = True, graphiteBatch = graphiteBatch)
+            if message:
+              with stageMetrics.stage('smtp'):
                   sendAlarmByEmail(message,
                                    emailReceipientString = constantsDict['emailReceipientForAlarms'],
                                    subject = '[AWS Billing Alarm] Alarm threshold surpassed for cost rate for %s account'%(account,),
                                    sender = 'AWSBillAlarm@%s'%(socket.gethostname(),),
                                    verbose = False)
+              with stageMetrics.stage('serviceNow'):
                   submitAlarmOnServiceNow (snowConf, message, "AWS Bill Spending Alarm")
-                  
-                logger.debug(message)
-                logger.info(" ---- Data Egress calculations for AWS {0} account".format(account))
-                billDataEgress = AWSBillDataEgress(calculator, account, globalConf, constantsDict, logger)
-                dataEgressConditionsDict = billDataEgress.ExtractDataEgressConditions()
-                billDataEgress.sendDataToGraphite(dataEgressConditionsDict)
-    
-            except Exception as error:
-                logger.info("--------------------------- End of AWS calculation cycle {0} with ERRORS ------------------------------".format(time.time()))
-                logger.exception(error)
-                continue
-    
-        logger.info("--------------------------- End of AWS calculation cycle {0} ------------------------------".format(time.time()))
-    
+
+            logger.debug(message)
+            logger.info(" ---- Data Egress calculations for AWS {0} account".format(account))
+            billDataEgress = AWSBillDataEgress(calculator, account, globalConf, constantsDict, logger)
+            dataEgressConditionsDict = billDataEgress.ExtractDataEgressConditions()
+            billDataEgress.sendDataToGraphite(dataEgressConditionsDict, graphiteBatch)
+    finally:
+        with stageMetrics.stage('graphiteSend'):
+            points, bytesSent = graphiteBatch.flush()
+        logger.info(" ---- Published {0} points to Graphite for AWS {1} account".format(points, account))
+        publishStageMetrics(globalConf, account, stageMetrics, logger)
 
 if __name__== "__main__":
     billingCalc = hcfBillingCalculator()
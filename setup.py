@@ -9,7 +9,7 @@ setuptools.setup(
     author="Maria P. Acosta F./HEPCloud project",
     author_email="macosta@fnal.gov",
     description="Billing calculations and threshold alarms for hybrid cloud setups",
-    install_requires=['gcs_oauth2_boto_plugin', 'pyparsing', 'google-cloud-bigquery[pandas]'],
+    install_requires=['gcs_oauth2_boto_plugin', 'pyparsing', 'google-cloud-bigquery[pandas]', 'google-auth', 'requests', 'numpy'],
     long_description=long_description,
     long_description_content_type="text/markdown",
     license='MIT',
@@ -21,5 +21,5 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.4',
+    python_requires='>=3.9',
 )
@@ -1,9 +1,10 @@
-import boto3
 from boto3.session import Session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from zipfile import ZipFile
 import csv
 import os
-from io import StringIO
+import io
 import re
 import datetime, time
 import datetime
@@ -11,12 +12,96 @@ from datetime import timedelta
 import logging
 import sys
 import traceback
-import bill_calculator_hep.graphite
+import threading
+import concurrent.futures
+import multiprocessing
+import itertools
+import json
+import bisect
+import tempfile
+import contextlib
+import operator
+import fcntl
+from bill_calculator_hep import graphite
+from bill_calculator_hep.AWSLineItemCache import AWSLineItemColumns, AWSLineItemCache, AWSBillCostIndex
+from bill_calculator_hep.S3ObjectReader import S3ObjectReader
+from bill_calculator_hep.StageMetrics import StageMetrics
 import configparser
 import yaml
+import numpy as np
+import pandas as pd
+
+# Classification of line items by their ItemDescription
+# Regular charge
+ITEM_CLASS_REGULAR = 0
+# Correction for the educational grant, unauthorized usage or final Total: not added up
+ITEM_CLASS_EXCLUDED = 1
+# Regular charge for data transferred out
+ITEM_CLASS_DATA_OUT = 2
+
+# Columns of the billing csv files kept by the parser, in the order of the bill rows it yields
+BILL_ROW_COLUMNS = ( 'UsageStartDate', 'ProductName', 'ItemDescription', 'UnblendedCost', 'UsageQuantity', 'ResourceId' )
+# Normalization of a ProductName into a product key, e.g. 'Amazon Elastic Compute Cloud' into 'AmazonElasticComputeCloud'
+#Py2.7: string.translate(productName, None, ' ()')
+PRODUCT_KEY_TRANSLATION = str.maketrans('', '', ' ()')
+
+class AWSRoleSessionCache(object):
+    """Role-based sessions and clients shared by all the calculators of the process.
+
+    Assumed-role credentials are reused until shortly before they expire, and one client per
+    service (with its connection pool) is kept for each role. Sessions are built from the
+    credentials profile of the account, never from the boto3 default session, so accounts
+    with different profiles can be calculated at the same time in different threads.
+    """
+
+    # Renew credentials this long before they expire
+    expirationMarginSeconds = 300
+    maxPoolConnections = 10
+
+    def __init__(self):
+        # The lock only guards roleLockDict: each role has its own lock, held while its credentials are
+        # renewed, so that the STS call of one account does not hold up the accounts using other roles
+        self.lock = threading.Lock()
+        self.roleLockDict = {}
+        self.roleSessionDict = {}
+
+    def getClient(self, profileName, roleArn, serviceName, logger, stageMetrics = None):
+        """Return a client for serviceName using the credentials of roleArn, assumed with profileName
+
+        The STS calls are timed as the assumeRole stage of stageMetrics, if given
+        """
+        with self.lock:
+            roleLock = self.roleLockDict.setdefault( (profileName, roleArn), threading.Lock() )
+        with roleLock:
+            roleSessionDict = self.roleSessionDict.get( (profileName, roleArn) )
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if roleSessionDict is None or \
+               roleSessionDict['Expiration'] - now < timedelta(seconds=self.expirationMarginSeconds):
+                # long term credentials have ONLY the permission to assume role
+                with ( stageMetrics.stage('assumeRole') if stageMetrics is not None else contextlib.nullcontext() ):
+                    profileSession = Session(profile_name=profileName)
+                    response = profileSession.client('sts').assume_role( RoleArn=roleArn, RoleSessionName='roleSwitchSession' )
+                credentialsDict = response['Credentials']
+                logger.debug('Opening Role-based Session with temporary key for role %s valid until %s' % (roleArn, credentialsDict['Expiration']))
+                session = Session(aws_access_key_id=credentialsDict['AccessKeyId'],
+                                  aws_secret_access_key=credentialsDict['SecretAccessKey'],
+                                  aws_session_token=credentialsDict['SessionToken'])
+                roleSessionDict = { 'Expiration': credentialsDict['Expiration'], 'Session': session, 'Clients': {} }
+                self.roleSessionDict[ (profileName, roleArn) ] = roleSessionDict
+            else:
+                logger.debug('Reusing Role-based Session for role %s valid until %s' % (roleArn, roleSessionDict['Expiration']))
+
+            # Clients are thread safe, but creating them from a session is not: the session of the role is only
+            # used under its lock
+            if serviceName not in roleSessionDict['Clients']:
+                roleSessionDict['Clients'][serviceName] = roleSessionDict['Session'].client(serviceName,
+                    config=Config(max_pool_connections=self.maxPoolConnections))
+            return roleSessionDict['Clients'][serviceName]
+
+roleSessionCache = AWSRoleSessionCache()
 
 class AWSBillCalculator(object):
-    def __init__(self, account, globalConfig, constants, logger, sumToDate = None):
+    def __init__(self, account, globalConfig, constants, logger, sumToDate = None, stageMetrics = None):
         self.logger = logger
         self.globalConfig = globalConfig
         # Configuration parameters
@@ -26,7 +111,45 @@ class AWSBillCalculator(object):
         self.accountDirs = False
         if ("accountDirs" in globalConfig.keys()) and (globalConfig['accountDirs'] != 0):
             self.accountDirs = True
+        # Optional lineItemCache (0 or 1) in the global section: 1 means parsed line items are saved next to
+        # the billing files and reused as long as the S3 object (ETag and size) does not change
+        self.lineItemCache = None
+        if ("lineItemCache" in globalConfig.keys()) and (globalConfig['lineItemCache'] != 0):
+            self.lineItemCache = AWSLineItemCache(logger)
+        # Optional streamFromS3 (0 or 1) in the global section: 1 means billing files are not saved in outputPath,
+        # but read with ranged requests and decompressed straight from S3
+        self.streamFromS3 = False
+        if ("streamFromS3" in globalConfig.keys()) and (globalConfig['streamFromS3'] != 0):
+            self.streamFromS3 = True
+        self.s3TransferConfig = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=4)
+        # Optional billEngine in the global section: 'python' (default) adds up the line items one by one,
+        # 'numpy' loads them in columns and sums them up with vectorized operations,
+        # 'index' loads them in columns and builds hourly cumulative sums, so that each window is two lookups
+        self.billEngine = 'python'
+        if "billEngine" in globalConfig.keys():
+            self.billEngine = globalConfig['billEngine']
+        if self.billEngine not in ('python', 'numpy', 'index'):
+            raise Exception('Unknown billEngine ' + str(self.billEngine) + ': expected python, numpy or index')
+        # Optional billFileWorkers in the global section: number of processes reading the monthly billing files
+        # at the same time, each file into a partial result merged afterwards (default 1: files read one by one)
+        self.billFileWorkers = 1
+        if "billFileWorkers" in globalConfig.keys():
+            self.billFileWorkers = globalConfig['billFileWorkers']
+        # Optional billFileChunkMB in the global section: with billFileWorkers > 1 and the line item cache off,
+        # billing files larger than this once decompressed are split into chunks of rows of about this size,
+        # read at the same time by the billFileWorkers processes (default 0: files are not split)
+        self.billFileChunkBytes = 0
+        if "billFileChunkMB" in globalConfig.keys():
+            self.billFileChunkBytes = int(globalConfig['billFileChunkMB'] * 1024 * 1024)
+        # Optional billChunkRows in the global section: with the python engine, the billing rows are parsed and
+        # added up billChunkRows at a time with vectorized operations, so that memory is bounded by the chunk
+        # and the hourly buckets kept between calls, whatever the size of the files (default 0: row by row)
+        self.billChunkRows = 0
+        if "billChunkRows" in globalConfig.keys():
+            self.billChunkRows = globalConfig['billChunkRows']
         self.accountName = account
+        # Kept to rebuild the calculator in the processes reading the billing files
+        self.constants = constants
         self.accountProfileName = constants['credentialsProfileName']
         self.accountNumber = constants['accountNumber']
         self.bucketBillingName = constants['bucketBillingName']
@@ -36,12 +159,29 @@ class AWSBillCalculator(object):
         self.applyDiscount = constants['applyDiscount']
         # Expect sumToDate as '%m/%d/%y %H:%M' : validated when needed
         self.sumToDate = sumToDate
+        # Durations and counters of the stages (role, listing, downloads, parsing, sums, corrections),
+        # shared with the alarm and data egress calculations of the account
+        if stageMetrics is None:
+            stageMetrics = StageMetrics()
+        self.stageMetrics = stageMetrics
+        # The billing rows repeat a few product names, item descriptions and (hourly) start dates: each distinct
+        # value is normalized once, and its product key, ITEM_CLASS_* or datetime is shared by all its line items
+        self.productKeyDict = {}
+        self.itemClassDict = {}
+        self.usageStartDateDict = {}
         self.logger.debug('Loaded account configuration successfully')
 
         # Can save state for repetitive calls e.g. for alarms
-        self.billCVSAggregateStr = None
-
-        boto3.setup_default_session(profile_name=self.accountProfileName)
+        # The billing files are read in a single pass, which adds up the costs per UsageStartDate:
+        # only these buckets are kept to sum up the bill over any time window
+        self.billFileList = None
+        self.billFileIdentityDict = {}
+        self.billFileS3KeyDict = {}
+        self.billBucketDict = None
+        # Line items loaded in columns, for the numpy engine
+        self.billLineItemColumns = None
+        # Hourly cumulative sums of the costs, for the index engine
+        self.billCostIndex = None
 
     def setLastKnownBillDate(self, lastKnownBillDate):
         self.lastKnownBillDate = lastKnownBillDate
@@ -52,10 +192,26 @@ class AWSBillCalculator(object):
     def setSumToDate(self, sumToDate):
         self.sumToDate = sumToDate
 
+    def getBillFilesState(self):
+        """Return the state of the billing files in the bucket, to tell when new billing data lands
+
+        Only lists the objects, through the listing index (see _listBillFiles): no file is downloaded.
+
+        Returns:
+            { key : ( ETag, LastModified ) } of the billing files
+        """
+        s3 = self._obtainRoleBasedClient('s3')
+        outputDirectory = self.outputPath if self.accountDirs is False else os.path.join(self.outputPath, self.accountName)
+        with self.stageMetrics.stage('listBillFiles'):
+            filesDictList = self._listBillFiles(s3, outputDirectory)
+        return dict( ( filesDict['Key'], ( filesDict['ETag'], filesDict['LastModified'] ) ) for filesDict in filesDictList )
+
     def CalculateBill(self):
         """Select and download the billing file from S3; aggregate them; calculates sum and
         correct for discounts, data egress waiver, etc.; send data to Graphite
 
+        The bill is summed up from lastKnownBillDate to sumToDate
+
         Args:
             none
         Returns:
@@ -72,29 +228,73 @@ class AWSBillCalculator(object):
                  }
         """
 
-        # Load data in memory
-        if self.billCVSAggregateStr == None:
-            fileNameForDownloadList = self._downloadBillFiles()
-            self.billCVSAggregateStr = self._aggregateBillFiles( fileNameForDownloadList );
-
-        lastStartDateBilledConsideredDatetime, BillSummaryDict = self._sumUpBillFromDateToDate( self.billCVSAggregateStr, self.lastKnownBillDate, self.sumToDate );
-        
-
-        CorrectedBillSummaryDict = self._applyBillCorrections(BillSummaryDict);
-        if "AccountName" not in CorrectedBillSummaryDict:
-            CorrectedBillSummaryDict["AccountName"] = self.accountName
+        lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict = \
+            self.CalculateBillForWindows( [ ( self.lastKnownBillDate, self.sumToDate ) ] )[0]
 
         self.logger.info('Bill Computation for %s Account Finished at %s' % ( self.accountName, time.strftime("%c") ))
         self.logger.info('Last Start Date Billed Considered : ' + lastStartDateBilledConsideredDatetime.strftime('%m/%d/%y %H:%M'))
         self.logger.info('Last Known Balance :' + str(self.balanceAtDate))
         self.logger.info('Date of Last Known Balance : ' + self.lastKnownBillDate)
-        self.logger.debug('BillSummaryDict:'.format(BillSummaryDict))
         self.logger.debug('CorrectedBillSummaryDict'.format(CorrectedBillSummaryDict))
 
         return lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict
 
+    def CalculateBillForWindows(self, windowList):
+        """Calculate the corrected bill for several time windows at once.
+
+        The billing files are downloaded and read only the first time: every window, in this
+        and later calls, is summed up from the costs aggregated in that single pass.
+
+        Args:
+            windowList: [ ( sumFromDate, sumToDate ), ... ] as '%m/%d/%y %H:%M'; sumToDate can be None
+        Returns:
+            [ ( lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict ), ... ] one per window,
+            in the same order. See CalculateBill for an example CorrectedBillSummaryDict
+        """
 
-    def sendDataToGraphite(self, CorrectedBillSummaryDict ):
+        # Download and read the billing files only once
+        if self.billFileList == None:
+            with self.stageMetrics.stage('downloadBillFiles'):
+                self.billFileList = self._downloadBillFiles()
+
+        # The billing files are unzipped, parsed and added up in a single streamed pass: readBillFiles times it as a whole
+        if self.billEngine == 'numpy':
+            if self.billLineItemColumns == None:
+                with self.stageMetrics.stage('readBillFiles'):
+                    self.billLineItemColumns = AWSLineItemColumns.concatenate( self._readBillFiles( columnar = True ) )
+            with self.stageMetrics.stage('sumUpWindows'):
+                windowSummaryList = self._sumUpBillForWindowsVectorized( self.billLineItemColumns, windowList )
+        elif self.billEngine == 'index':
+            # The line items are not kept once indexed
+            if self.billCostIndex == None:
+                with self.stageMetrics.stage('readBillFiles'):
+                    self.billCostIndex = self._buildBillCostIndex( AWSLineItemColumns.concatenate( self._readBillFiles( columnar = True ) ) )
+            with self.stageMetrics.stage('sumUpWindows'):
+                windowSummaryList = self._sumUpBillForWindowsIndexed( self.billCostIndex, windowList )
+        else:
+            if self.billBucketDict == None:
+                with self.stageMetrics.stage('readBillFiles'):
+                    if self.billFileWorkers > 1:
+                        self.billBucketDict = self._mergeBillBuckets( self._readBillFiles( columnar = False ) )
+                    elif self.lineItemCache is None:
+                        self.billBucketDict = self._bucketBillRows( self._aggregateBillFiles( self.billFileList ) )
+                    else:
+                        self.billBucketDict = self._bucketBillLineItems( self._iterBillLineItems() )
+            with self.stageMetrics.stage('sumUpWindows'):
+                windowSummaryList = self._sumUpBillForWindows( self.billBucketDict, windowList )
+        self.stageMetrics.count('windows', len( windowList ))
+
+        windowResultList = []
+        with self.stageMetrics.stage('corrections'):
+            for lastStartDateBilledConsideredDatetime, BillSummaryDict in windowSummaryList:
+                CorrectedBillSummaryDict = self._applyBillCorrections(BillSummaryDict);
+                if "AccountName" not in CorrectedBillSummaryDict:
+                    CorrectedBillSummaryDict["AccountName"] = self.accountName
+                windowResultList.append( ( lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict ) )
+        return windowResultList
+
+
+    def sendDataToGraphite(self, CorrectedBillSummaryDict, graphiteBatch = None ):
         """Send the corrected bill summary dictionary to the Graphana dashboard for the
         bill information
         Args:
@@ -109,6 +309,8 @@ class AWSBillCalculator(object):
                   'AWSSupportBusiness': 0.38862123489039674,
                   'AdjustedTotal': 268.9511507172487
                  }
+            graphiteBatch: optional graphite.GraphiteBatch collecting the data of the account cycle,
+                 sent later in a single payload
 
         Returns:
             none
@@ -117,40 +319,35 @@ class AWSBillCalculator(object):
         graphiteHost=self.globalConfig['graphite_host']
         graphiteContext=self.globalConfig['graphite_context_billing'] + str(self.accountName)
 
-        graphiteEndpoint = graphite.Graphite(host=graphiteHost)
-        graphiteEndpoint.send_dict(graphiteContext, CorrectedBillSummaryDict, send_data=True)
+        if graphiteBatch != None:
+            graphiteBatch.add_dict(graphiteContext, CorrectedBillSummaryDict)
+            return
+        with self.stageMetrics.stage('graphiteSend'):
+            graphiteEndpoint = graphite.Graphite(host=graphiteHost)
+            graphiteEndpoint.send_dict(graphiteContext, CorrectedBillSummaryDict, send_data=True)
 
 
-    def _obtainRoleBasedSession(self):
-        """ Obtain a short-lived role-based token
+    def _obtainRoleBasedClient(self, serviceName):
+        """ Obtain a client with a short-lived role-based token, reused across calls until it expires
         """
 
         roleNameString = 'CalculateBill'
         fullRoleNameString = 'arn:aws:iam::' + str(self.accountNumber) + ':role/' + roleNameString
 
-        # using boto3 default session to obtain temporary token
+        # using the account credentials profile to obtain temporary token
         # long term credentials have ONLY the permission to assume role CalculateBill
-        client = boto3.client('sts')
-        response = client.assume_role( RoleArn=fullRoleNameString, RoleSessionName='roleSwitchSession'  )
-
-        role_AK_id = response['Credentials']['AccessKeyId']
-        role_AK_sc = response['Credentials']['SecretAccessKey']
-        role_AK_tk = response['Credentials']['SessionToken']
-
-        self.logger.debug('Opening Role-based Session for account %s with temporary key for role %s' % (self.accountName, fullRoleNameString))
-        session = Session(aws_access_key_id=role_AK_id, aws_secret_access_key=role_AK_sc, aws_session_token=role_AK_tk)
-        return session
+        self.logger.debug('Obtaining %s client for account %s with role %s' % (serviceName, self.accountName, fullRoleNameString))
+        return roleSessionCache.getClient(self.accountProfileName, fullRoleNameString, serviceName, self.logger, self.stageMetrics)
 
 
     def _downloadBillFiles(self ):
         # Identify what files need to be downloaded, given the last known balance date
         # Download the files from S3
 
-        session = self._obtainRoleBasedSession()
-
-        s3 = session.client('s3')
-        filesObjsInBucketDict = s3.list_objects(Bucket=self.bucketBillingName)
-        filesDictList = filesObjsInBucketDict['Contents']
+        s3 = self._obtainRoleBasedClient('s3')
+        outputDirectory = self.outputPath if self.accountDirs is False else os.path.join(self.outputPath, self.accountName)
+        with self.stageMetrics.stage('listBillFiles'):
+            filesDictList = self._listBillFiles(s3, outputDirectory)
         # Assumption: sort files by date using file name: this is true if file name convention is maintained
         filesDictList.sort(key=lambda filesDict: filesDict['Key'])
 
@@ -223,71 +420,520 @@ class AWSBillCalculator(object):
             fileNameForDownloadList = [ filesDict['Key'] ]
         self.logger.debug('fileNameForDownloadList:'.format(fileNameForDownloadList))
 
+        filesDictByKey = dict((filesDict['Key'], filesDict) for filesDict in filesDictList)
+        downloadManifestDict = self._loadDownloadManifest(outputDirectory)
+        numberOfFilesFetched = 0
+        numberOfFilesSkipped = 0
+        numberOfFilesStreamed = 0
+        bytesFetched = 0
+        bytesSaved = 0
         new_fileNameForDownloadList = []
         for fileNameForDownload in fileNameForDownloadList:
-            outputfile = os.path.join(self.outputPath, fileNameForDownload) if self.accountDirs is False else os.path.join(self.outputPath, self.accountName, fileNameForDownload)
-            s3.download_file(self.bucketBillingName, fileNameForDownload, outputfile)
+            outputfile = os.path.join(outputDirectory, fileNameForDownload)
+            eTag = filesDictByKey[fileNameForDownload]['ETag']
+            size = filesDictByKey[fileNameForDownload]['Size']
+            lastModified = filesDictByKey[fileNameForDownload]['LastModified']
+            self.billFileIdentityDict[outputfile] = (eTag, size)
+            remoteFileDict = { 'ETag': eTag, 'Size': size, 'LastModified': lastModified }
+            # No need to download files whose parsed line items are already cached,
+            # or whose local copy was downloaded from the same S3 object
+            if self.lineItemCache is not None and self.lineItemCache.isValid(outputfile, eTag, size):
+                self.logger.debug('Line item cache is up to date for %s: skipping download' % fileNameForDownload)
+                # The cache entry may still be overwritten or become unreadable before it is loaded: the file is then
+                # parsed from its local copy if up to date, otherwise streamed from S3
+                if not (os.path.exists(outputfile) and downloadManifestDict.get(fileNameForDownload) == remoteFileDict):
+                    self.billFileS3KeyDict[outputfile] = fileNameForDownload
+                numberOfFilesSkipped += 1
+                bytesSaved += size
+            elif self.streamFromS3:
+                self.logger.debug('%s will be streamed from S3 (ETag %s, %d bytes)' % (fileNameForDownload, eTag, size))
+                self.billFileS3KeyDict[outputfile] = fileNameForDownload
+                numberOfFilesStreamed += 1
+            elif os.path.exists(outputfile) and downloadManifestDict.get(fileNameForDownload) == remoteFileDict:
+                self.logger.debug('Local copy of %s is up to date (ETag %s): skipping download' % (fileNameForDownload, eTag))
+                numberOfFilesSkipped += 1
+                bytesSaved += size
+            else:
+                self.logger.debug('Downloading %s (ETag %s, %d bytes)' % (fileNameForDownload, eTag, size))
+                # Download aside and rename, so that an interrupted download never leaves a truncated file in place;
+                # the temporary file is unique, in case another account downloads the same file at the same time
+                temporaryFileDescriptor, temporaryOutputfile = tempfile.mkstemp(prefix=os.path.basename(outputfile) + '.', suffix='.part',
+                                                                                dir=os.path.dirname(outputfile))
+                os.close(temporaryFileDescriptor)
+                try:
+                    with self.stageMetrics.stage('download'):
+                        s3.download_file(self.bucketBillingName, fileNameForDownload, temporaryOutputfile)
+                    os.replace(temporaryOutputfile, outputfile)
+                except:
+                    if os.path.exists(temporaryOutputfile):
+                        os.remove(temporaryOutputfile)
+                    raise
+                self._updateDownloadManifest(outputDirectory, fileNameForDownload, remoteFileDict)
+                numberOfFilesFetched += 1
+                bytesFetched += size
             new_fileNameForDownloadList.append(outputfile)
+
+        self.logger.info('Billing files for %s account: %d downloaded (%d bytes), %d up to date (%d bytes saved), %d streamed from S3' % \
+            (self.accountName, numberOfFilesFetched, bytesFetched, numberOfFilesSkipped, bytesSaved, numberOfFilesStreamed))
+        self.stageMetrics.merge({ 'downloadedFiles': numberOfFilesFetched, 'downloadedBytes': bytesFetched,
+                                  'upToDateFiles': numberOfFilesSkipped, 'streamedFiles': numberOfFilesStreamed })
         return new_fileNameForDownloadList
 
+    def _listBillFiles(self, s3, outputDirectory):
+        # List the billing files in the bucket, as dictionaries with Key, ETag, Size and LastModified.
+        #
+        # The listing is paginated, so that buckets with more than 1000 objects are fully listed.
+        # The billing files found are kept in a local index between runs: once a report family
+        # (the key up to the date, e.g. 950490332792-aws-billing-detailed-line-items-) is known,
+        # only its keys past the month before lastKnownBillDate are listed again, using StartAfter.
+        # Older months are taken from the index. Removing the index forces a full listing.
+        # There is one index per bucket, since accounts with different buckets can share the outputDirectory.
+
+        # Constants
+        # Assume a format such as this: 950490332792-aws-billing-detailed-line-items-2015-09.csv.zip
+        billingFileNameIdentifier = 'aws\-billing.*\-(20[0-9][0-9]\-[0-9][0-9]).csv.zip$'
+        billingFileMatch = re.compile(billingFileNameIdentifier)
+        listingIndexFileName = os.path.join(outputDirectory, 'bill-files-index-' + self.bucketBillingName + '.json')
+
+        listingIndexDict = {}
+        if os.path.exists(listingIndexFileName):
+            try:
+                with open(listingIndexFileName, 'r') as listingIndexFile:
+                    listingIndexDict = json.load(listingIndexFile)
+            except ValueError as error:
+                self.logger.warning('Ignoring corrupted listing index %s: %s' % (listingIndexFileName, error))
+        if listingIndexDict.get('Bucket') != self.bucketBillingName:
+            listingIndexDict = { 'Bucket': self.bucketBillingName, 'Objects': {} }
+        objectDict = listingIndexDict['Objects']
+
+        def listObjects(**listArgs):
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucketBillingName, **listArgs):
+                for filesDict in page.get('Contents', []):
+                    if billingFileMatch.search(filesDict['Key']) is not None:
+                        yield { 'Key': filesDict['Key'], 'ETag': filesDict['ETag'], 'Size': filesDict['Size'],
+                                'LastModified': str(filesDict['LastModified']) }
+
+        def family(key):
+            return key[:billingFileMatch.search(key).start(1)]
+
+        familyList = sorted(set(family(key) for key in objectDict))
+        if not familyList:
+            self.logger.debug('Listing all the objects in bucket ' + self.bucketBillingName)
+            for filesDict in listObjects():
+                objectDict[filesDict['Key']] = filesDict
+        else:
+            # Refresh the billing files from the month before lastKnownBillDate on
+            lastKnownBillDateDatetime = datetime.datetime(*(time.strptime(self.lastKnownBillDate, '%m/%d/%y %H:%M')[0:6]))
+            startAfterMonthString = (lastKnownBillDateDatetime.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+            for familyString in familyList:
+                startAfterKey = familyString + startAfterMonthString
+                self.logger.debug('Listing the objects in bucket ' + self.bucketBillingName + ' starting after ' + startAfterKey)
+                for key in [ key for key in objectDict if family(key) == familyString and key > startAfterKey ]:
+                    del objectDict[key]
+                # The date follows the family in the key: the prefix leaves out other families extending this one
+                for filesDict in listObjects(Prefix=familyString + '20', StartAfter=startAfterKey):
+                    objectDict[filesDict['Key']] = filesDict
+
+        self._saveJSONFile(listingIndexFileName, listingIndexDict)
+
+        return list(objectDict.values())
+
+    def _saveJSONFile(self, fileName, contentDict):
+        # Write aside and rename, through a temporary file of its own, so that calculators writing the same
+        # file at the same time never install a half-written file nor rename each other's temporary file
+        temporaryFileDescriptor, temporaryFileName = tempfile.mkstemp(prefix=os.path.basename(fileName) + '.', suffix='.tmp',
+                                                                      dir=os.path.dirname(fileName))
+        try:
+            with os.fdopen(temporaryFileDescriptor, 'w') as temporaryFile:
+                json.dump(contentDict, temporaryFile, indent=1, sort_keys=True)
+            os.replace(temporaryFileName, fileName)
+        except:
+            os.remove(temporaryFileName)
+            raise
+
+    def _downloadManifestFileName(self, outputDirectory):
+        # One manifest per bucket, since accounts with different buckets can share the outputDirectory
+        return os.path.join(outputDirectory, 'bill-files-manifest-' + self.bucketBillingName + '.json')
+
+    def _loadDownloadManifest(self, outputDirectory):
+        # The download manifest records ETag, Size and LastModified of the S3 object each local
+        # billing file was downloaded from: { key : { 'ETag': ..., 'Size': ..., 'LastModified': ... } }
+        downloadManifestFileName = self._downloadManifestFileName(outputDirectory)
+        if not os.path.exists(downloadManifestFileName):
+            return {}
+        try:
+            with open(downloadManifestFileName, 'r') as downloadManifestFile:
+                return json.load(downloadManifestFile)
+        except ValueError as error:
+            self.logger.warning('Ignoring corrupted download manifest %s: %s' % (downloadManifestFileName, error))
+            return {}
+
+    def _updateDownloadManifest(self, outputDirectory, key, remoteFileDict):
+        # Record the S3 object a billing file was just downloaded from. Accounts sharing the bucket may update
+        # the manifest at the same time, in threads or processes: the manifest is read again and saved under a
+        # file lock, so that no entry is lost
+        downloadManifestFileName = self._downloadManifestFileName(outputDirectory)
+        with open(downloadManifestFileName + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                downloadManifestDict = self._loadDownloadManifest(outputDirectory)
+                downloadManifestDict[key] = remoteFileDict
+                self._saveJSONFile(downloadManifestFileName, downloadManifestDict)
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
 
     def _aggregateBillFiles(self, zipFileList ):
-       # Unzip files and aggregate billing info in a single dictionary
+       # Unzip files and stream the billing rows of all of them as a single sequence of
+       # bill rows, see _selectBillRows.
+       # Rows are read straight from the zip members, so only one row at a time is held
+       # in memory no matter how large the billing files are.
 
        # Since Feb 2016, the csv file has two new field: RecordId (as new 5th column) and
        # ResourceId (last column)
-       # If we are merging files with old and new format, we need to add empty
-       # columns to preserve the format and allow the cvs module to work properly
-       # Here we add the new columns to the old format in any case
-
-       # Constants
-       billingFileNameNewFormatIdentifiew = '.*with\-resources\-and\-tags\-.*.csv.zip'
-       billingFileNameNewFormatMatch = re.compile(billingFileNameNewFormatIdentifiew)
-       newLastColumnHeaderString = 'ResourceId'
-       new5thColumnHeaderString = 'RecordId'
-       old4thColumnHeaderString = 'RecordType'
-       billCVSAggregateStr = ''
-       newFormat = True
+       # The columns are picked by name from the header of each file, so files in the old
+       # and new format can be merged: ResourceId is empty for the old format
+
        for zipFileName in zipFileList:
          zipFileNameBase = os.path.basename( zipFileName )
-         # Check if file is in new or old format
-         if billingFileNameNewFormatMatch.search(zipFileName) is None:
-             newFormat = False
-         else:
-             newFormat = True
-
-         # Read in files for the merging
-         zipFile = ZipFile(zipFileName, 'r')
-         billingFileName = zipFileNameBase.rstrip('.zip')
-         billCSVStr = zipFile.read(billingFileName)
-         billCSVStr = billCSVStr.decode("utf-8")
-
-         # Remove the header for all files except the first
-         if billCVSAggregateStr != '':
-             billCSVStr = re.sub('^.*\n','',billCSVStr,count=1)
-
-         # If the file is in the old format, add the missing fields for every row
-         if not newFormat:
-             lineArray = billCSVStr.splitlines()
-             firstLine = True
-             for line in lineArray:
-                # If the file is in the old format, add the new columns to the header
-                if firstLine and billCVSAggregateStr == '':
-                  firstLine = False
-                  billCSVStr = re.sub(old4thColumnHeaderString,old4thColumnHeaderString+','+new5thColumnHeaderString,line) +\
-                      ','+newLastColumnHeaderString+'\n'
-
-                  continue
-
-                #Put lines back together adding missing fields
-                recordList=line.split(',')
-                billCSVStr = billCSVStr + ','.join(recordList[0:4]) + ',,' + ','.join(recordList[4:]) + ',\n'
-
-         # aggregate data from all files
-         billCVSAggregateStr = billCVSAggregateStr + billCSVStr
-       return billCVSAggregateStr;
-
-    def _sumUpBillFromDateToDate(self, billCVSAggregateStr , sumFromDate, sumToDate = None):
+
+         # Stream the csv member of the zip file
+         billingFileName = zipFileNameBase[:-len('.zip')]
+         with self._openBillFile(zipFileName) as billFile, ZipFile(billFile, 'r') as zipFile, zipFile.open(billingFileName) as billCSVFile:
+           billCSVReader = csv.reader(io.TextIOWrapper(billCSVFile, encoding='utf-8', newline=''))
+           headerList = next(billCSVReader, None)
+           if headerList is None:
+               continue
+
+           yield from self._selectBillRows( headerList, billCSVReader )
+           self.stageMetrics.count('billFilesParsed')
+           if zipFileName in self.billFileS3KeyDict:
+               self.stageMetrics.count('streamedBytes', billFile.bytesFetched)
+
+    def _selectBillRows(self, headerList, recordLists):
+        # Turn the csv records of a billing file, whose header is headerList, into bill rows: tuples of the
+        # strings of the BILL_ROW_COLUMNS
+        #   ( UsageStartDate, ProductName, ItemDescription, UnblendedCost, UsageQuantity, ResourceId )
+        # picked by index, without building a dictionary per row. Columns missing from the header, or from
+        # a short record, are empty. Rows without a date (e.g. final comment lines) are dropped.
+        numberOfColumns = len( headerList )
+        columnIndexDict = dict( ( columnName, index ) for index, columnName in enumerate( headerList ) )
+        # Missing columns are picked from an empty field added past the last column
+        columnIndexList = [ columnIndexDict.get( columnName, numberOfColumns ) for columnName in BILL_ROW_COLUMNS ]
+        hasMissingColumns = numberOfColumns in columnIndexList
+        selectColumns = operator.itemgetter( *columnIndexList )
+        paddingList = [ '' ] * ( numberOfColumns + 1 )
+
+        numberOfRecords = 0
+        for recordList in recordLists:
+            numberOfRecords += 1
+            if hasMissingColumns or len( recordList ) < numberOfColumns:
+                recordList = ( recordList + paddingList )[ :numberOfColumns + 1 ]
+            billRow = selectColumns( recordList )
+            # Skip if there is no date (e.g. final comment lines)
+            if billRow[0]:
+                yield billRow
+        self.stageMetrics.count('rowsParsed', numberOfRecords)
+
+    def _openBillFile(self, zipFileName):
+        # Open a billing zip file: the local copy, or the S3 object itself when streaming from S3
+        if zipFileName in self.billFileS3KeyDict:
+            eTag, size = self.billFileIdentityDict[zipFileName]
+            return S3ObjectReader(self._obtainRoleBasedClient('s3'), self.bucketBillingName, self.billFileS3KeyDict[zipFileName],
+                                  size, self.s3TransferConfig)
+        return open(zipFileName, 'rb')
+
+    def _normalizeBillRows(self, billRows):
+        # Turn bill rows, as yielded by _selectBillRows, into line items
+        #   ( usageStartDateDatetime, productKey, unblendedCost, usageQuantity, itemClass, resourceId )
+        # The start date, product key and item class are looked up in the memos of the calculator:
+        # only the first row with a given value parses or normalizes it
+        usageStartDateDict = self.usageStartDateDict
+        productKeyDict = self.productKeyDict
+        itemClassDict = self.itemClassDict
+
+        for usageStartDate, productName, itemDescription, unblendedCost, usageQuantity, resourceId in billRows:
+            usageStartDateDatetime = usageStartDateDict.get(usageStartDate)
+            if usageStartDateDatetime is None:
+                usageStartDateDatetime = usageStartDateDict[usageStartDate] = \
+                    datetime.datetime(*(time.strptime(usageStartDate, '%Y-%m-%d %H:%M:%S')[0:6]))
+
+            key = productKeyDict.get(productName)
+            if key is None:
+                key = self._productKey(productName)
+
+            itemClass = itemClassDict.get(itemDescription)
+            if itemClass is None:
+                itemClass = self._classifyItemDescription(itemDescription)
+
+            yield usageStartDateDatetime, key, float(unblendedCost or 0), float(usageQuantity or 0), itemClass, resourceId
+
+    def _productKey(self, productName):
+        # Return the product key of a ProductName, e.g. 'AmazonElasticComputeCloud' for 'Amazon Elastic Compute Cloud',
+        # memoized: the keys of all the line items of a product are the same interned string
+        key = self.productKeyDict.get(productName)
+        if key is None:
+            key = self.productKeyDict[productName] = sys.intern(productName.translate(PRODUCT_KEY_TRANSLATION))
+        return key
+
+    def _classifyItemDescription(self, itemDescription):
+        # Return the ITEM_CLASS_* of a line item given its ItemDescription, memoized per ItemDescription
+
+        # Constants
+        totalCsvHeaderString = 'Total'
+        educationalGrantRowIdentifyingString = 'EDU_'
+        unauthorizedUsageString = 'Unauthorized Usage'
+        dataTransferredOutString = 'data transferred out'
+
+        itemClass = self.itemClassDict.get(itemDescription)
+        if itemClass is not None:
+            return itemClass
+
+        # Don't add up lines that are corrections for the educational grant, the unauthorized usage, or the final Total
+        if itemDescription.find(educationalGrantRowIdentifyingString) != -1 or \
+           itemDescription.find(unauthorizedUsageString) != -1 or \
+           itemDescription.find(totalCsvHeaderString) != -1 :
+            itemClass = ITEM_CLASS_EXCLUDED
+        elif itemDescription.find(dataTransferredOutString) != -1:
+            itemClass = ITEM_CLASS_DATA_OUT
+        else:
+            itemClass = ITEM_CLASS_REGULAR
+        self.itemClassDict[itemDescription] = itemClass
+        return itemClass
+
+    def _columnizeBillRows(self, billRows):
+        # Load bill rows, as yielded by _selectBillRows, into AWSLineItemColumns.
+        # Only the raw strings are collected row by row: dates and numbers are parsed with
+        # vectorized operations, and product names and item descriptions are normalized once
+        # per distinct value.
+
+        # Constants
+        itemDescriptionCsvHeaderString = 'ItemDescription'
+        ProductNameCsvHeaderString = 'ProductName'
+        usageQuantityHeaderString = 'UsageQuantity'
+        unBlendedCostCsvHeaderString = 'UnblendedCost'
+        usageStartDateCsvHeaderString = 'UsageStartDate'
+        resourceIdCsvHeaderString = 'ResourceId'
+
+        columnValueListDict = dict( ( columnName, [] ) for columnName in BILL_ROW_COLUMNS )
+        appendList = [ columnValueListDict[ columnName ].append for columnName in BILL_ROW_COLUMNS ]
+        appendUsageStartDate, appendProductName, appendItemDescription, appendUnblendedCost, appendUsageQuantity, appendResourceId = appendList
+        for usageStartDate, productName, itemDescription, unblendedCost, usageQuantity, resourceId in billRows:
+            appendUsageStartDate( usageStartDate )
+            appendProductName( productName )
+            appendItemDescription( itemDescription )
+            appendUnblendedCost( unblendedCost )
+            appendUsageQuantity( usageQuantity )
+            appendResourceId( resourceId )
+
+        def toFloatArray(valueList):
+            valueArray = np.array( valueList, dtype=str )
+            return np.where( valueArray == '', '0', valueArray ).astype( np.float64 )
+
+        usageStartDate = np.array( columnValueListDict[ usageStartDateCsvHeaderString ], dtype='datetime64[s]' )
+        productNameIndex, productNameArray = pd.Series( columnValueListDict[ ProductNameCsvHeaderString ], dtype=object ).factorize()
+        itemDescriptionIndex, itemDescriptionArray = pd.Series( columnValueListDict[ itemDescriptionCsvHeaderString ], dtype=object ).factorize()
+        resourceIdIndex, resourceIdArray = pd.Series( columnValueListDict[ resourceIdCsvHeaderString ], dtype=object ).factorize()
+
+        # Normalize once per distinct product name and item description, reusing the memos across chunks and files
+        productKeyList = [ self._productKey( productName ) for productName in productNameArray ]
+        itemClassArray = np.array( [ self._classifyItemDescription( itemDescription ) for itemDescription in itemDescriptionArray ], dtype=np.int8 )
+
+        return AWSLineItemColumns( usageStartDate,
+                                   productNameIndex.astype( np.int32 ),
+                                   np.array( productKeyList, dtype=str ),
+                                   toFloatArray( columnValueListDict[ unBlendedCostCsvHeaderString ] ),
+                                   toFloatArray( columnValueListDict[ usageQuantityHeaderString ] ),
+                                   itemClassArray[ itemDescriptionIndex ],
+                                   resourceIdIndex.astype( np.int32 ),
+                                   np.array( list( resourceIdArray ), dtype=str ) )
+
+    def _readBillFiles(self, columnar):
+        # Read each billing file into a partial result: its AWSLineItemColumns if columnar, otherwise its
+        # buckets as built by _bucketBillLineItems (costs per product, Total, TotalDataOut and EstimatedTotalDataOut
+        # per UsageStartDate, from which the monthly totals for the tiered support and the last date are derived).
+        # With billFileWorkers > 1, the files are read at the same time in a pool of processes, and with
+        # billFileChunkMB, large files are split into chunks of rows read at the same time too.
+        # Returns the partial results in the order of billFileList (and of the chunks within a file)
+        if self.billFileWorkers <= 1:
+            return [ self._readBillFile( billFileName, columnar ) for billFileName in self.billFileList ]
+
+        temporaryFileNameList = []
+        try:
+            # ( function, arguments ) of each file or chunk
+            taskList = []
+            for billFileName in self.billFileList:
+                if self.billFileChunkBytes > 0 and self.lineItemCache is None and \
+                   self._billFileCSVSize( billFileName ) > self.billFileChunkBytes:
+                    with self.stageMetrics.stage('splitBillFile'):
+                        csvFileName, headerList, byteRangeList = self._splitBillFile( billFileName, self.billFileChunkBytes )
+                    temporaryFileNameList.append( csvFileName )
+                    self.logger.debug('Split %s in %d chunks' % ( billFileName, len( byteRangeList ) ))
+                    taskList += [ ( readBillCSVRangeInProcess, ( csvFileName, headerList, start, end, columnar ) )
+                                  for start, end in byteRangeList ]
+                else:
+                    taskList.append( ( readBillFileInProcess, ( billFileName, self.billFileIdentityDict.get(billFileName),
+                                                                self.billFileS3KeyDict.get(billFileName), columnar ) ) )
+
+            numberOfWorkers = min( self.billFileWorkers, len( taskList ) )
+            self.logger.debug('Reading %d billing files in %d parts with %d processes' % ( len( self.billFileList ), len( taskList ), numberOfWorkers ))
+            # The calculator may run in a thread (scheduler, account workers) while other threads hold locks:
+            # the worker processes are started by a forkserver rather than forked from this process
+            with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfWorkers,
+                                                        mp_context=multiprocessing.get_context('forkserver')) as executor:
+                futureList = [ executor.submit(function, self.accountName, self.globalConfig, self.constants, self.logger.name, *arguments)
+                               for function, arguments in taskList ]
+                # Each process also returns its metrics, e.g. the rows it parsed
+                partialResultList = []
+                for future in futureList:
+                    partialResult, metricDict = future.result()
+                    self.stageMetrics.merge( metricDict )
+                    partialResultList.append( partialResult )
+                return partialResultList
+        finally:
+            for temporaryFileName in temporaryFileNameList:
+                os.remove( temporaryFileName )
+
+    def _readBillFile(self, billFileName, columnar):
+        # Partial result of one billing file, see _readBillFiles
+        if columnar:
+            return self._loadBillLineItemColumns( billFileName )
+        if self.lineItemCache is None:
+            return self._bucketBillRows( self._aggregateBillFiles( [ billFileName ] ) )
+        return self._bucketBillLineItems( self._loadBillLineItemColumns( billFileName ).iterLineItems() )
+
+    def _billFileCSVSize(self, billFileName):
+        # Size of the csv member of a billing file once decompressed, from the zip directory
+        with self._openBillFile(billFileName) as billFile, ZipFile(billFile, 'r') as zipFile:
+            return zipFile.getinfo( os.path.basename( billFileName )[:-len('.zip')] ).file_size
+
+    def _splitBillFile(self, billFileName, chunkBytes):
+        # Decompress the csv member of a billing file into a temporary file in outputPath, and split its rows
+        # into byte ranges of about chunkBytes. A range ends right after a newline that ends a record: a newline
+        # preceded by an even number of quotes since the first row, since quoted fields can contain newlines
+        # (and quotes within quoted fields are doubled, which keeps the parity).
+        #
+        #  Returns: ( csvFileName, headerList, [ ( start, end ), ... ] )
+        #               headerList: the header of the file
+        #               The caller removes csvFileName
+
+        # Constants
+        blockSize = 16 * 1024 * 1024
+
+        billingFileName = os.path.basename( billFileName )[:-len('.zip')]
+        csvFileDescriptor, csvFileName = tempfile.mkstemp(prefix=billingFileName + '.', suffix='.part', dir=self.outputPath)
+        try:
+            with self._openBillFile(billFileName) as billFile, ZipFile(billFile, 'r') as zipFile, \
+                 zipFile.open(billingFileName) as billCSVFile, os.fdopen(csvFileDescriptor, 'wb') as csvFile:
+                headerLineBytes = billCSVFile.readline()
+                csvFile.write( headerLineBytes )
+                headerList = next( csv.reader( [ headerLineBytes.decode('utf-8') ] ), [] )
+
+                byteRangeList = []
+                position = rangeStart = len( headerLineBytes )
+                splitPosition = rangeStart + chunkBytes
+                quoteCount = 0
+                while True:
+                    block = billCSVFile.read( blockSize )
+                    if not block:
+                        break
+                    csvFile.write( block )
+                    blockStart = position
+                    position += len( block )
+                    # Look for the end of a record from splitPosition on, possibly carried over from the previous blocks;
+                    # quotes are counted up to countedIndex in the block
+                    searchIndex = countedIndex = 0
+                    while splitPosition < position:
+                        newlineIndex = block.find( b'\n', max( splitPosition - blockStart, searchIndex ) )
+                        if newlineIndex == -1:
+                            break
+                        quoteCount += block.count( b'"', countedIndex, newlineIndex )
+                        countedIndex = newlineIndex
+                        if quoteCount % 2 == 0:
+                            byteRangeList.append( ( rangeStart, blockStart + newlineIndex + 1 ) )
+                            rangeStart = blockStart + newlineIndex + 1
+                            splitPosition = rangeStart + chunkBytes
+                        searchIndex = newlineIndex + 1
+                    quoteCount += block.count( b'"', countedIndex )
+                if rangeStart < position:
+                    byteRangeList.append( ( rangeStart, position ) )
+        except:
+            os.remove( csvFileName )
+            raise
+        return csvFileName, headerList, byteRangeList
+
+    def _readBillCSVRange(self, csvFileName, headerList, start, end):
+        # Stream the bill rows of the byte range [ start, end ) of a csv file split by _splitBillFile,
+        # like _aggregateBillFiles
+        with open(csvFileName, 'rb') as csvFile:
+            csvFile.seek( start )
+
+            def lineIterator():
+                # The range ends at the end of a record, so the csv reader never needs the next line
+                position = start
+                while position < end:
+                    lineBytes = csvFile.readline()
+                    if not lineBytes:
+                        return
+                    position += len( lineBytes )
+                    yield lineBytes.decode('utf-8')
+
+            yield from self._selectBillRows( headerList, csv.reader( lineIterator() ) )
+
+    def _mergeBillBuckets(self, billBucketDictList):
+        # Merge buckets built by _bucketBillLineItems from different line items, e.g. one per billing file,
+        # adding up the costs of the buckets with the same UsageStartDate
+        mergedBillBucketDict = {}
+        for billBucketDict in billBucketDictList:
+            for usageStartDateDatetime, billBucket in billBucketDict.items():
+                mergedBillBucket = mergedBillBucketDict.get( usageStartDateDatetime )
+                if mergedBillBucket is None:
+                    mergedBillBucketDict[ usageStartDateDatetime ] = billBucket
+                    continue
+                for key, cost in billBucket.items():
+                    mergedBillBucket[ key ] = mergedBillBucket.get( key, 0.0 ) + cost
+        return mergedBillBucketDict
+
+    def _iterBillLineItems(self):
+        # Line items of all the billing files: streamed from the zip files, or read from the
+        # line item cache when it is enabled
+        if self.lineItemCache is None:
+            return self._normalizeBillRows( self._aggregateBillFiles( self.billFileList ) )
+
+        return itertools.chain.from_iterable( self._loadBillLineItemColumns( billFileName ).iterLineItems() for billFileName in self.billFileList )
+
+    def _loadBillLineItemColumns(self, billFileName):
+        # Parsed line items of a billing file, from the cache if it was built from the same S3 object;
+        # otherwise the file is parsed and the cache, if enabled, is refreshed
+        if self.lineItemCache is None:
+            return self._columnizeBillRows( self._aggregateBillFiles( [ billFileName ] ) )
+
+        eTag, size = self.billFileIdentityDict[billFileName]
+        columns = self.lineItemCache.load(billFileName, eTag, size)
+        if columns is None:
+            self.logger.debug('Parsing %s to refresh the line item cache' % billFileName)
+            columns = self._columnizeBillRows( self._aggregateBillFiles( [ billFileName ] ) )
+            self.lineItemCache.store(billFileName, eTag, size, columns)
+        return columns
+
+    def _sumUpBillFromDateToDate(self, lineItems , sumFromDate, sumToDate = None):
+        # lineItems: iterable of line items
+        #   ( usageStartDateDatetime, productKey, unblendedCost, usageQuantity, itemClass, resourceId )
+        # e.g. as returned by _iterBillLineItems
+        #
+        #  Returns:
+        #               ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) as described in _sumUpBillForWindows
+        return self._sumUpBillForWindows( self._bucketBillLineItems( lineItems ), [ ( sumFromDate, sumToDate ) ] )[0]
+
+    def _bucketBillLineItems(self, lineItems):
+        # Single pass over the line items, adding up costs per UsageStartDate, so that the bill of
+        # any time window can be summed up later without reading the line items again.
+        #
+        # lineItems: iterable of line items
+        #   ( usageStartDateDatetime, productKey, unblendedCost, usageQuantity, itemClass, resourceId )
+        # e.g. as returned by _iterBillLineItems
+        #
         # CSV Billing file format documentation:
         #
         # UnBlendedCost : the corrected cost of each item; unblended from the accounts under
@@ -299,6 +945,115 @@ class AWSBillCalculator(object):
         # charges due to data transfers out
         #
         #  Returns:
+        #               billBucketDict: { usageStartDateDatetime : bucket }
+        #               where each bucket holds the cost per product (key), the Total, TotalDataOut and
+        #               EstimatedTotalDataOut of the line items starting at that date, e.g.
+        #                    {'AmazonElasticComputeCloud': 0.24066755999999997,
+        #                     'AmazonSimpleStorageService': 0.38619119999999818,
+        #                     'AWSSupportBusiness': 0.00083480700000000642,
+        #                     'EstimatedTotalDataOut': 0.0033834411000000018,
+        #                     'TotalDataOut': 0.0,
+        #                     'Total': 0.62769356699999868}
+        #               Dates with only corrections (e.g. the educational grant) have buckets with no costs
+
+
+        # Constants
+        totalDataOutCsvHeaderString = 'TotalDataOut'
+        estimatedTotalDataOutCsvHeaderString = 'EstimatedTotalDataOut'
+        totalCsvHeaderString = 'Total'
+
+        awsSupportBusinessCostKeyString = 'AWSSupportBusiness'
+
+        costOfGBOut = 0.09 # Assume highest cost of data transfer out per GB in $
+
+        billBucketDict = {}
+        for usageStartDateDatetime, key, unblendedCost, usageQuantity, itemClass, resourceId in lineItems:
+            try:
+                billBucket = billBucketDict[ usageStartDateDatetime ]
+            except KeyError:
+                billBucket = billBucketDict[ usageStartDateDatetime ] = { totalCsvHeaderString : 0.0 , totalDataOutCsvHeaderString : 0.0, \
+                                                                          estimatedTotalDataOutCsvHeaderString : 0.0 }
+
+            # Don't add up lines that are corrections for the educational grant, the unauthorized usage, or the final Total
+            # Don't add up lines that don't have a key e.g. final comments in the csv file
+            if itemClass == ITEM_CLASS_EXCLUDED or key == '':
+                continue
+
+            # Add up cost per product (i.e. key) and total cost
+            billBucket[ key ] = billBucket.get( key, 0.0 ) + unblendedCost
+            # Do not double count support from AWS billing
+            if key != awsSupportBusinessCostKeyString:
+                billBucket[ totalCsvHeaderString ] += unblendedCost
+
+            # Add up all data transfer charges separately
+            if itemClass == ITEM_CLASS_DATA_OUT:
+                billBucket[ totalDataOutCsvHeaderString ] += unblendedCost
+                billBucket[ estimatedTotalDataOutCsvHeaderString ] += usageQuantity * costOfGBOut
+
+        return billBucketDict
+
+    def _bucketBillRows(self, billRows):
+        # Buckets, as built by _bucketBillLineItems, of bill rows as yielded by _selectBillRows.
+        # With billChunkRows, the rows are parsed and added up a chunk at a time, with vectorized operations:
+        # only the rows of a chunk and the buckets are held in memory
+        if self.billChunkRows <= 0:
+            return self._bucketBillLineItems( self._normalizeBillRows( billRows ) )
+
+        billRows = iter( billRows )
+        billBucketDict = {}
+        numberOfChunks = 0
+        # Each chunk is the next row and the following billChunkRows - 1 rows, streamed to _columnizeBillRows,
+        # which only keeps the columns it needs
+        for firstBillRow in billRows:
+            columns = self._columnizeBillRows( itertools.chain( [ firstBillRow ], itertools.islice( billRows, self.billChunkRows - 1 ) ) )
+            billBucketDict = self._mergeBillBuckets( [ billBucketDict, self._bucketBillLineItemColumns( columns ) ] )
+            numberOfChunks += 1
+        self.logger.debug('Added up %d chunks of up to %d billing rows into %d buckets' % ( numberOfChunks, self.billChunkRows, len( billBucketDict ) ))
+        return billBucketDict
+
+    def _bucketBillLineItemColumns(self, columns):
+        # Same as _bucketBillLineItems over AWSLineItemColumns, with vectorized operations: the costs are
+        # added up per UsageStartDate and per product with bincount, in the order of the line items
+
+        # Constants
+        totalDataOutCsvHeaderString = 'TotalDataOut'
+        estimatedTotalDataOutCsvHeaderString = 'EstimatedTotalDataOut'
+        totalCsvHeaderString = 'Total'
+
+        costOfGBOut = 0.09 # Assume highest cost of data transfer out per GB in $
+
+        isIncluded, isAddedToTotal, isDataOut = self._selectLineItemColumns( columns )
+        usageStartDateArray, dateIndex = np.unique( columns.usageStartDate, return_inverse=True )
+        numberOfDates = len( usageStartDateArray )
+        numberOfProducts = len( columns.productKeyList )
+
+        def sumPerDate(mask, values):
+            return np.bincount( dateIndex[ mask ], weights=values[ mask ], minlength=numberOfDates ).tolist()
+
+        totalList = sumPerDate( isAddedToTotal, columns.unblendedCost )
+        dataOutList = sumPerDate( isDataOut, columns.unblendedCost )
+        estimatedDataOutList = sumPerDate( isDataOut, columns.usageQuantity * costOfGBOut )
+        # Cost and number of line items per ( date, product )
+        dateProductIndex = dateIndex[ isIncluded ] * numberOfProducts + columns.productKeyIndex[ isIncluded ]
+        productCostArray = np.bincount( dateProductIndex, weights=columns.unblendedCost[ isIncluded ],
+                                        minlength=numberOfDates * numberOfProducts ).reshape( numberOfDates, numberOfProducts )
+        productCountArray = np.bincount( dateProductIndex, minlength=numberOfDates * numberOfProducts ).reshape( numberOfDates, numberOfProducts )
+
+        productKeyList = columns.productKeyList.tolist()
+        billBucketDict = {}
+        for index, usageStartDateDatetime in enumerate( usageStartDateArray.tolist() ):
+            billBucket = billBucketDict[ usageStartDateDatetime ] = { totalCsvHeaderString : totalList[ index ], totalDataOutCsvHeaderString : dataOutList[ index ], \
+                                                                      estimatedTotalDataOutCsvHeaderString : estimatedDataOutList[ index ] }
+            for productIndex in np.flatnonzero( productCountArray[ index ] ).tolist():
+                billBucket[ productKeyList[ productIndex ] ] = productCostArray[ index, productIndex ].item()
+        return billBucketDict
+
+    def _sumUpBillForWindows(self, billBucketDict, windowList):
+        # Sum up the buckets built by _bucketBillLineItems for each time window
+        #
+        # windowList: [ ( sumFromDate, sumToDate ), ... ] as '%m/%d/%y %H:%M'; sumToDate can be None
+        #
+        #  Returns: one ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) per window
         #               BillSummaryDict: (Keys depend on services present in the csv file)
         #                    {'AmazonSimpleQueueService': 0.0,
         #                     'AmazonSimpleNotificationService': 0.0,
@@ -309,110 +1064,203 @@ class AWSBillCalculator(object):
         #                     'AmazonSimpleStorageService': 0.38619119999999818,
         #                     'TotalDataOut': 0.0,
         #                     'Total': 0.62769356699999868,
+        #                     'AdjustedSupport': 0.062769356699999868,
         #                     'AWSSupportBusiness': 0.00083480700000000642}
 
-
         # Constants
-        itemDescriptionCsvHeaderString = 'ItemDescription'
-        ProductNameCsvHeaderString = 'ProductName'
         totalDataOutCsvHeaderString = 'TotalDataOut'
         estimatedTotalDataOutCsvHeaderString = 'EstimatedTotalDataOut'
-        usageQuantityHeaderString = 'UsageQuantity'
-        unBlendedCostCsvHeaderString = 'UnblendedCost'
-        usageStartDateCsvHeaderString = 'UsageStartDate'
         totalCsvHeaderString = 'Total'
+        adjustedSupportCostKeyString = 'AdjustedSupport'
+
+        sortedUsageStartDateList = sorted( billBucketDict )
 
+        windowResultList = []
+        for sumFromDate, sumToDate in windowList:
+            sumFromDateDatetime = datetime.datetime(*(time.strptime(sumFromDate, '%m/%d/%y %H:%M')[0:6]))
+            lastStartDateBilledConsideredDatetime = sumFromDateDatetime
+            # Skip buckets whose UsageStartDate is prior to sumFromDate and past sumToDate
+            firstIndex = bisect.bisect_left( sortedUsageStartDateList, sumFromDateDatetime )
+            if sumToDate != None:
+                sumToDateDatetime = datetime.datetime(*(time.strptime(sumToDate, '%m/%d/%y %H:%M')[0:6]))
+                lastIndex = bisect.bisect_right( sortedUsageStartDateList, sumToDateDatetime )
+            else:
+                lastIndex = len( sortedUsageStartDateList )
+
+            BillSummaryDict = { totalCsvHeaderString : 0.0 , totalDataOutCsvHeaderString : 0.0, \
+                                estimatedTotalDataOutCsvHeaderString : 0.0, adjustedSupportCostKeyString : 0.0 }
+            # Total per month, to calculate tiered support cost
+            monthlyTotalDict = {}
+            for usageStartDateDatetime in sortedUsageStartDateList[ firstIndex:lastIndex ]:
+                billBucket = billBucketDict[ usageStartDateDatetime ]
+                for key, cost in billBucket.items():
+                    BillSummaryDict[ key ] = BillSummaryDict.get( key, 0.0 ) + cost
+                month = ( usageStartDateDatetime.year, usageStartDateDatetime.month )
+                monthlyTotalDict[ month ] = monthlyTotalDict.get( month, 0.0 ) + billBucket[ totalCsvHeaderString ]
+                lastStartDateBilledConsideredDatetime = usageStartDateDatetime
+
+            # Calculate support cost month by month
+            for month in sorted( monthlyTotalDict ):
+                monthlySupportCost = self._calculateTieredSupportCost( monthlyTotalDict[ month ] )
+                BillSummaryDict[ adjustedSupportCostKeyString ] += monthlySupportCost
+                self.logger.debug('Support calculation. Month: %d/%d. Calculated support at %f for total cost at %f. Total support at %f' % \
+                        (month[1], month[0], monthlySupportCost, monthlyTotalDict[ month ], BillSummaryDict[ adjustedSupportCostKeyString ] ))
+
+            windowResultList.append( ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) )
+
+        return windowResultList
+
+
+    def _sumUpBillForWindowsVectorized(self, columns, windowList):
+        # Same as _sumUpBillForWindows, computed with vectorized operations over AWSLineItemColumns:
+        # the line items of each window are selected with a mask on UsageStartDate and added up
+        # per product and per month with bincount
+        #
+        # windowList: [ ( sumFromDate, sumToDate ), ... ] as '%m/%d/%y %H:%M'; sumToDate can be None
+        #
+        #  Returns: one ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) per window,
+        #           see _sumUpBillForWindows
+
+        # Constants
+        totalDataOutCsvHeaderString = 'TotalDataOut'
+        estimatedTotalDataOutCsvHeaderString = 'EstimatedTotalDataOut'
+        totalCsvHeaderString = 'Total'
         adjustedSupportCostKeyString = 'AdjustedSupport'
-        awsSupportBusinessCostKeyString = 'AWSSupportBusiness'
 
-        educationalGrantRowIdentifyingString = 'EDU_'
-        unauthorizedUsageString = 'Unauthorized Usage'
         costOfGBOut = 0.09 # Assume highest cost of data transfer out per GB in $
 
-        sumFromDateDatetime = datetime.datetime(*(time.strptime(sumFromDate, '%m/%d/%y %H:%M')[0:6]))
-        lastStartDateBilledConsideredDatetime = sumFromDateDatetime
-        if sumToDate != None:
-            sumToDateDatetime = datetime.datetime(*(time.strptime(sumToDate, '%m/%d/%y %H:%M')[0:6]))
-        BillSummaryDict = { totalCsvHeaderString : 0.0 , totalDataOutCsvHeaderString : 0.0, \
-                            estimatedTotalDataOutCsvHeaderString : 0.0, adjustedSupportCostKeyString : 0.0 }
-
-        # Counters to calculate tiered support cost
-        totalForPreviousMonth = 0
-        currentMonth = ''
-
-        # The seek(0) resets the csv iterator, in case of multiple passes e.g. in alarm calculations
-        billCVSAggregateStrStringIO = StringIO(billCVSAggregateStr)
-        billCVSAggregateStrStringIO.seek(0)
-        for row in csv.DictReader(billCVSAggregateStrStringIO):
-            # Skip if there is no date (e.g. final comment lines)
-            if row[usageStartDateCsvHeaderString] == '' :
-               continue;
+        productKeyList = columns.productKeyList.tolist()
+        numberOfProductKeys = len( productKeyList )
 
-            # Skip rows whose UsageStartDate is prior to sumFromDate and past sumToDate
-            usageStartDateDatetime = datetime.datetime(*(time.strptime(row[usageStartDateCsvHeaderString], '%Y-%m-%d %H:%M:%S')[0:6]))
-            if usageStartDateDatetime < sumFromDateDatetime :
-               continue;
+        isIncluded, isAddedToTotal, isDataOut = self._selectLineItemColumns( columns )
+        usageStartMonth = columns.usageStartDate.astype( 'datetime64[M]' )
 
+        windowResultList = []
+        for sumFromDate, sumToDate in windowList:
+            sumFromDateDatetime = datetime.datetime(*(time.strptime(sumFromDate, '%m/%d/%y %H:%M')[0:6]))
+            # Skip line items whose UsageStartDate is prior to sumFromDate and past sumToDate
+            isInWindow = columns.usageStartDate >= np.datetime64( sumFromDateDatetime, 's' )
             if sumToDate != None:
-                if usageStartDateDatetime > sumToDateDatetime :
-                    continue;
+                sumToDateDatetime = datetime.datetime(*(time.strptime(sumToDate, '%m/%d/%y %H:%M')[0:6]))
+                isInWindow &= columns.usageStartDate <= np.datetime64( sumToDateDatetime, 's' )
+
+            lastStartDateBilledConsideredDatetime = sumFromDateDatetime
+            if isInWindow.any():
+                lastStartDateBilledConsideredDatetime = columns.usageStartDate[ isInWindow ].max().item()
+
+            BillSummaryDict = { totalCsvHeaderString : 0.0 , totalDataOutCsvHeaderString : 0.0, \
+                                estimatedTotalDataOutCsvHeaderString : 0.0, adjustedSupportCostKeyString : 0.0 }
+
+            # Add up cost per product (i.e. key)
+            isIncludedInWindow = isIncluded & isInWindow
+            productKeyIndex = columns.productKeyIndex[ isIncludedInWindow ]
+            productCount = np.bincount( productKeyIndex, minlength=numberOfProductKeys )
+            productCost = np.bincount( productKeyIndex, weights=columns.unblendedCost[ isIncludedInWindow ], minlength=numberOfProductKeys )
+            for index in np.flatnonzero( productCount ):
+                BillSummaryDict[ productKeyList[ index ] ] = float( productCost[ index ] )
+
+            # Add up total cost, and total cost per month to calculate tiered support cost
+            isAddedToTotalInWindow = isAddedToTotal & isInWindow
+            BillSummaryDict[ totalCsvHeaderString ] = float( columns.unblendedCost[ isAddedToTotalInWindow ].sum() )
+            monthArray, monthIndex = np.unique( usageStartMonth[ isAddedToTotalInWindow ], return_inverse=True )
+            monthlyTotalArray = np.bincount( monthIndex, weights=columns.unblendedCost[ isAddedToTotalInWindow ], minlength=len( monthArray ) )
+            for month, monthlyTotal in zip( monthArray.tolist(), monthlyTotalArray.tolist() ):
+                monthlySupportCost = self._calculateTieredSupportCost( monthlyTotal )
+                BillSummaryDict[ adjustedSupportCostKeyString ] += monthlySupportCost
+                self.logger.debug('Support calculation. Month: %d/%d. Calculated support at %f for total cost at %f. Total support at %f' % \
+                        (month.month, month.year, monthlySupportCost, monthlyTotal, BillSummaryDict[ adjustedSupportCostKeyString ] ))
+
+            isDataOutInWindow = isDataOut & isInWindow
+            BillSummaryDict[ totalDataOutCsvHeaderString ] = float( columns.unblendedCost[ isDataOutInWindow ].sum() )
+            BillSummaryDict[ estimatedTotalDataOutCsvHeaderString ] = float( ( columns.usageQuantity[ isDataOutInWindow ] * costOfGBOut ).sum() )
+
+            windowResultList.append( ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) )
+
+        return windowResultList
+
+    def _selectLineItemColumns(self, columns):
+        # Masks over AWSLineItemColumns of the line items added up per product, in the total and in the data out
+        #
+        #  Returns: ( isIncluded, isAddedToTotal, isDataOut )
+
+        # Constants
+        awsSupportBusinessCostKeyString = 'AWSSupportBusiness'
 
-            if usageStartDateDatetime > lastStartDateBilledConsideredDatetime:
-               lastStartDateBilledConsideredDatetime = usageStartDateDatetime
+        # Don't add up lines that are corrections for the educational grant, the unauthorized usage, or the final Total
+        # Don't add up lines that don't have a key e.g. final comments in the csv file
+        isIncluded = ( columns.itemClass != ITEM_CLASS_EXCLUDED ) & ( columns.productKeyList != '' )[ columns.productKeyIndex ]
+        # Do not double count support from AWS billing
+        isAddedToTotal = isIncluded & ( columns.productKeyList != awsSupportBusinessCostKeyString )[ columns.productKeyIndex ]
+        # Add up all data transfer charges separately
+        isDataOut = isIncluded & ( columns.itemClass == ITEM_CLASS_DATA_OUT )
+        return isIncluded, isAddedToTotal, isDataOut
 
-            # Sum up the costs
-            try:
-                # Don't add up lines that are corrections for the educational grant, the unauthorized usage, or the final Total
-                if row[itemDescriptionCsvHeaderString].find(educationalGrantRowIdentifyingString) == -1 and \
-                   row[itemDescriptionCsvHeaderString].find(unauthorizedUsageString) == -1 and \
-                   row[itemDescriptionCsvHeaderString].find(totalCsvHeaderString) == -1 :
-                    #Py2.7: string.translate(row[ProductNameCsvHeaderString], None, ' ()')
-                    #Ported to py3 is: str.maketrans('','',' ()'))
-                    key = row[ProductNameCsvHeaderString].translate(str.maketrans('','',' ()'))
-
-                    # Don't add up lines that don't have a key e.g. final comments in the csv file
-                    if key != '':
-                        # Calculate support cost at the end of the month
-                        # For the first row, we initialize the current month
-                        if currentMonth == '':
-                             currentMonth = usageStartDateDatetime.month
-                        else:
-                            # If this row is for a new month, then we calculate the support cost
-                            if  currentMonth != usageStartDateDatetime.month:
-                                monthlySupportCost = self._calculateTieredSupportCost( BillSummaryDict[ totalCsvHeaderString ] - totalForPreviousMonth )
-                                BillSummaryDict[ adjustedSupportCostKeyString ] += monthlySupportCost
-                                currentMonth = usageStartDateDatetime.month
-                                self.logger.debug('New month: %d. Calculated support at %f for total cost at %f. Total support at %f Last row considered:' % \
-                                    (usageStartDateDatetime.month, monthlySupportCost, BillSummaryDict[ totalCsvHeaderString ], BillSummaryDict[ adjustedSupportCostKeyString ] ))
-                                self.logger.debug(row)
-                                totalForPreviousMonth = BillSummaryDict[ totalCsvHeaderString ]
-
-                        # Add up cost per product (i.e. key) and total cost
-                        BillSummaryDict[ key ] += float(row[unBlendedCostCsvHeaderString])
-                        # Do not double count support from AWS billing
-                        if key != awsSupportBusinessCostKeyString:
-                            BillSummaryDict[ totalCsvHeaderString ] += float(row[unBlendedCostCsvHeaderString])
-
-                        # Add up all data transfer charges separately
-                        if row[itemDescriptionCsvHeaderString].find('data transferred out') != -1:
-                           BillSummaryDict[ totalDataOutCsvHeaderString ] += float(row[unBlendedCostCsvHeaderString])
-                           BillSummaryDict[ estimatedTotalDataOutCsvHeaderString ] += float(row[usageQuantityHeaderString]) * costOfGBOut
-
-
-            # If it is the first time that we encounter this key (product), add it to the dictionary
-            except KeyError:
-                BillSummaryDict[ key ] = float(row[unBlendedCostCsvHeaderString])
-                if key != awsSupportBusinessCostKeyString:
-                    BillSummaryDict[ totalCsvHeaderString ] += float(row[unBlendedCostCsvHeaderString])
+    def _buildBillCostIndex(self, columns):
+        # Build the AWSBillCostIndex of the line items in AWSLineItemColumns
 
-        # Calculates the support for the last part of the month
-        monthlySupportCost = self._calculateTieredSupportCost( BillSummaryDict[ totalCsvHeaderString ] - totalForPreviousMonth )
-        BillSummaryDict[ adjustedSupportCostKeyString ] += monthlySupportCost
-        self.logger.info('Final support calculation. Month: %d. Calculated support at %f for total cost at %f. Total support at %f' % \
-                (usageStartDateDatetime.month, monthlySupportCost, BillSummaryDict[ totalCsvHeaderString ], BillSummaryDict[ adjustedSupportCostKeyString ] ))
+        # Constants
+        costOfGBOut = 0.09 # Assume highest cost of data transfer out per GB in $
 
-        return lastStartDateBilledConsideredDatetime, BillSummaryDict;
+        isIncluded, isAddedToTotal, isDataOut = self._selectLineItemColumns( columns )
+        billCostIndex = AWSBillCostIndex( columns, isIncluded, isAddedToTotal, isDataOut, costOfGBOut )
+        self.logger.debug('Indexed %d line items in %d hourly bins' % ( len( columns ), billCostIndex.numberOfBins ))
+        return billCostIndex
 
+    def _sumUpBillForWindowsIndexed(self, billCostIndex, windowList):
+        # Same as _sumUpBillForWindows, computed from the hourly cumulative sums of an AWSBillCostIndex:
+        # each sum over a window (or over the part of a window in a month) is the difference of two entries
+        #
+        # windowList: [ ( sumFromDate, sumToDate ), ... ] as '%m/%d/%y %H:%M'; sumToDate can be None
+        #
+        #  Returns: one ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) per window,
+        #           see _sumUpBillForWindows
+
+        # Constants
+        totalDataOutCsvHeaderString = 'TotalDataOut'
+        estimatedTotalDataOutCsvHeaderString = 'EstimatedTotalDataOut'
+        totalCsvHeaderString = 'Total'
+        adjustedSupportCostKeyString = 'AdjustedSupport'
+
+        windowResultList = []
+        for sumFromDate, sumToDate in windowList:
+            sumFromDateDatetime = datetime.datetime(*(time.strptime(sumFromDate, '%m/%d/%y %H:%M')[0:6]))
+            sumToDateDatetime = None
+            if sumToDate != None:
+                sumToDateDatetime = datetime.datetime(*(time.strptime(sumToDate, '%m/%d/%y %H:%M')[0:6]))
+            firstBin, lastBin = billCostIndex.binRange( sumFromDateDatetime, sumToDateDatetime )
+
+            lastStartDateBilledConsideredDatetime = billCostIndex.lastStartDate( firstBin, lastBin )
+            if lastStartDateBilledConsideredDatetime == None:
+                lastStartDateBilledConsideredDatetime = sumFromDateDatetime
+
+            BillSummaryDict = { totalCsvHeaderString : 0.0 , totalDataOutCsvHeaderString : 0.0, \
+                                estimatedTotalDataOutCsvHeaderString : 0.0, adjustedSupportCostKeyString : 0.0 }
+            BillSummaryDict.update( billCostIndex.productCosts( firstBin, lastBin ) )
+            BillSummaryDict[ totalCsvHeaderString ] = billCostIndex.totalCost( firstBin, lastBin )
+            BillSummaryDict[ totalDataOutCsvHeaderString ] = billCostIndex.dataOutCost( firstBin, lastBin )
+            BillSummaryDict[ estimatedTotalDataOutCsvHeaderString ] = billCostIndex.estimatedDataOutCost( firstBin, lastBin )
+
+            # Calculate support cost month by month, over the part of the window in each month
+            monthFirstBin = firstBin
+            while monthFirstBin < lastBin:
+                monthStartDatetime = billCostIndex.binStartDatetime( monthFirstBin )
+                if monthStartDatetime.month == 12:
+                    nextMonthDatetime = datetime.datetime( monthStartDatetime.year + 1, 1, 1 )
+                else:
+                    nextMonthDatetime = datetime.datetime( monthStartDatetime.year, monthStartDatetime.month + 1, 1 )
+                monthLastBin = min( billCostIndex.binRange( nextMonthDatetime )[0], lastBin )
+                # Months with no line items in the window are not billed
+                if billCostIndex.lineItemCount( monthFirstBin, monthLastBin ) > 0:
+                    monthlyTotal = billCostIndex.totalCost( monthFirstBin, monthLastBin )
+                    monthlySupportCost = self._calculateTieredSupportCost( monthlyTotal )
+                    BillSummaryDict[ adjustedSupportCostKeyString ] += monthlySupportCost
+                    self.logger.debug('Support calculation. Month: %d/%d. Calculated support at %f for total cost at %f. Total support at %f' % \
+                            (monthStartDatetime.month, monthStartDatetime.year, monthlySupportCost, monthlyTotal, BillSummaryDict[ adjustedSupportCostKeyString ] ))
+                monthFirstBin = monthLastBin
+
+            windowResultList.append( ( lastStartDateBilledConsideredDatetime, BillSummaryDict ) )
+
+        return windowResultList
 
     def _calculateTieredSupportCost(self, monthlyCost):
         """ Calculate support cost FOR A GIVEN MONTH, using tiered definition below
@@ -483,6 +1331,30 @@ class AWSBillCalculator(object):
 
         return CorrectedBillSummaryDict
 
+def readBillFileInProcess(account, globalConfig, constants, loggerName, billFileName, billFileIdentity, billFileS3Key, columnar):
+    """Read one billing file in a worker process, see AWSBillCalculator._readBillFiles
+
+    The calculator is rebuilt from its configuration, since its clients and caches are not sent between processes.
+    Returns ( partial result, metrics of the read as StageMetrics.asDict )
+    """
+    calculator = AWSBillCalculator(account, globalConfig, constants, logging.getLogger(loggerName))
+    if billFileIdentity is not None:
+        calculator.billFileIdentityDict[ billFileName ] = billFileIdentity
+    if billFileS3Key is not None:
+        calculator.billFileS3KeyDict[ billFileName ] = billFileS3Key
+    return calculator._readBillFile( billFileName, columnar ), calculator.stageMetrics.asDict()
+
+def readBillCSVRangeInProcess(account, globalConfig, constants, loggerName, csvFileName, headerList, start, end, columnar):
+    """Read a chunk of rows of a billing file in a worker process, see AWSBillCalculator._splitBillFile
+
+    Returns ( partial result, metrics of the read as StageMetrics.asDict )
+    """
+    calculator = AWSBillCalculator(account, globalConfig, constants, logging.getLogger(loggerName))
+    billRows = calculator._readBillCSVRange( csvFileName, headerList, start, end )
+    if columnar:
+        return calculator._columnizeBillRows( billRows ), calculator.stageMetrics.asDict()
+    return calculator._bucketBillRows( billRows ), calculator.stageMetrics.asDict()
+
 class AWSBillAlarm(object):
     
     def __init__(self, calculator, account, globalConfig, constants, logger):
@@ -498,8 +1370,9 @@ class AWSBillAlarm(object):
         self.grafanaDashboard=globalConfig['grafana_dashboard']
 
 
-    def EvaluateAlarmConditions(self, publishData = True):
+    def EvaluateAlarmConditions(self, publishData = True, graphiteBatch = None):
         """Compare the alarm conditions with the set thresholds.
+           The alarm data is published to Graphite, or added to graphiteBatch if given
 
            Returns: alarmMessage
                 If no alarms are triggered, alarmMessage = None
@@ -510,7 +1383,7 @@ class AWSBillAlarm(object):
 
         # Publish data to Graphite
         if publishData:
-            self.sendDataToGraphite(alarmConditionsDict)
+            self.sendDataToGraphite(alarmConditionsDict, graphiteBatch)
 
         # Compare alarm conditions with thresholds and builds alarm message
         alarmMessage = None
@@ -560,23 +1433,22 @@ class AWSBillAlarm(object):
             }
         """
 
-        # Get total and last date billed
-        lastStartDateBilledDatetime, CorrectedBillSummaryNowDict = self.calculator.CalculateBill()
-        dateNow = datetime.datetime.now()
+        with self.calculator.stageMetrics.stage('alarmWindows'):
+            # Get total and last date billed
+            lastStartDateBilledDatetime, CorrectedBillSummaryNowDict = self.calculator.CalculateBill()
+            dateNow = datetime.datetime.now()
 
-        # Get cost in the last 6 hours
-        sixHoursBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=6)
-        self.calculator.setLastKnownBillDate(sixHoursBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'))
-        newLastStartDateBilledDatetime, CorrectedBillSummarySixHoursBeforeDict = self.calculator.CalculateBill()
+            # Get cost in the last 6 and 24 hours, from the same pass over the billing data
+            sixHoursBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=6)
+            oneDayBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=24)
+            ( newLastStartDateBilledDatetime, CorrectedBillSummarySixHoursBeforeDict ), \
+            ( newLastStartDateBilledDatetime, CorrectedBillSummaryOneDayBeforeDict ) = self.calculator.CalculateBillForWindows(
+                [ ( sixHoursBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'), self.calculator.sumToDate ),
+                  ( oneDayBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'), self.calculator.sumToDate ) ] )
 
         costInLastSixHours = CorrectedBillSummarySixHoursBeforeDict['AdjustedTotal']
         costRatePerHourInLastSixHours = costInLastSixHours / 6
 
-        # Get cost in the last 24 hours
-        oneDayBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=24)
-        self.calculator.setLastKnownBillDate(oneDayBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'))
-        newLastStartDateBilledDatetime, CorrectedBillSummaryOneDayBeforeDict = self.calculator.CalculateBill()
-
         costInLastDay = CorrectedBillSummaryOneDayBeforeDict['AdjustedTotal']
         costRatePerHourInLastDay = costInLastDay / 24
 
@@ -612,7 +1484,7 @@ class AWSBillAlarm(object):
 
         return alarmConditionsDict
 
-    def sendDataToGraphite(self, alarmConditionsDict ):
+    def sendDataToGraphite(self, alarmConditionsDict, graphiteBatch = None ):
         """Send the alarm condition dictionary to the Graphana dashboard
 
         Args:
@@ -625,6 +1497,8 @@ class AWSBillAlarm(object):
                        'costRatePerHourInLastSixHours': 1.6481979659016666,
                        'costInLastDay': 18.082235686322473
                     }
+            graphiteBatch: optional graphite.GraphiteBatch collecting the data of the account cycle,
+                 sent later in a single payload
 
         Returns:
             none
@@ -632,8 +1506,12 @@ class AWSBillAlarm(object):
 
         graphiteContext=self.globalConfig['graphite_context_alarms'] + str(self.accountName)
 
-        graphiteEndpoint = graphite.Graphite(host=self.graphiteHost)
-        graphiteEndpoint.send_dict(graphiteContext, alarmConditionsDict, send_data=True)
+        if graphiteBatch != None:
+            graphiteBatch.add_dict(graphiteContext, alarmConditionsDict)
+            return
+        with self.calculator.stageMetrics.stage('graphiteSend'):
+            graphiteEndpoint = graphite.Graphite(host=self.graphiteHost)
+            graphiteEndpoint.send_dict(graphiteContext, alarmConditionsDict, send_data=True)
 
 class AWSBillDataEgress(object):
 
@@ -662,23 +1540,23 @@ class AWSBillDataEgress(object):
             }
         """
 
-        # Get total and last date billed 
-        lastStartDateBilledDatetime, CorrectedBillSummaryNowDict = self.calculator.CalculateBill()
-        
-        # Get costs in the last 48 hours
-        twoDaysBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=48)
-        self.calculator.setLastKnownBillDate(twoDaysBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'))
-        newLastStartDateBilledDatetime, CorrectedBillSummaryTwoDaysBeforeDict = self.calculator.CalculateBill()
-        
+        with self.calculator.stageMetrics.stage('egressWindows'):
+            # Get total and last date billed 
+            lastStartDateBilledDatetime, CorrectedBillSummaryNowDict = self.calculator.CalculateBill()
+
+            # Get costs in the last 48 hours and since the first of the month, from the same pass over the billing data
+            twoDaysBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=48)
+            lastStartDateBilledFirstOfMonthDatetime = datetime.datetime(lastStartDateBilledDatetime.year, lastStartDateBilledDatetime.month, 1)
+            ( newLastStartDateBilledDatetime, CorrectedBillSummaryTwoDaysBeforeDict ), \
+            ( newLastStartDateBilledDatetime, CorrectedBillSummaryFirstOfMonthDict ) = self.calculator.CalculateBillForWindows(
+                [ ( twoDaysBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'), self.calculator.sumToDate ),
+                  ( lastStartDateBilledFirstOfMonthDatetime.strftime('%m/%d/%y %H:%M'), self.calculator.sumToDate ) ] )
+
         costOfDataEgressInLastTwoDays = CorrectedBillSummaryTwoDaysBeforeDict['EstimatedTotalDataOut']
         costInLastTwoDays = CorrectedBillSummaryTwoDaysBeforeDict['AdjustedTotal'] + costOfDataEgressInLastTwoDays
         percentageDataEgressOverTotalCostInLastTwoDays = costOfDataEgressInLastTwoDays / costInLastTwoDays * 100
 
         # Get costs since the first of the month
-        lastStartDateBilledFirstOfMonthDatetime = datetime.datetime(lastStartDateBilledDatetime.year, lastStartDateBilledDatetime.month, 1)
-        self.calculator.setLastKnownBillDate(lastStartDateBilledFirstOfMonthDatetime.strftime('%m/%d/%y %H:%M'))
-        newLastStartDateBilledDatetime, CorrectedBillSummaryFirstOfMonthDict = self.calculator.CalculateBill()
-        
         costOfDataEgressFromFirstOfMonth = CorrectedBillSummaryFirstOfMonthDict['EstimatedTotalDataOut']
         costFromFirstOfMonth = CorrectedBillSummaryFirstOfMonthDict['AdjustedTotal'] + costOfDataEgressFromFirstOfMonth
         percentageDataEgressOverTotalCostFromFirstOfMonth = costOfDataEgressFromFirstOfMonth / costFromFirstOfMonth * 100
@@ -708,7 +1586,7 @@ class AWSBillDataEgress(object):
 
         return dataEgressConditionsDict
 
-    def sendDataToGraphite(self, dataEgressConditionsDict ):
+    def sendDataToGraphite(self, dataEgressConditionsDict, graphiteBatch = None ):
         """Send the data egress condition dictionary to the Graphana dashboard 
         
         Args: 
@@ -721,14 +1599,20 @@ class AWSBillDataEgress(object):
                       'costOfDataEgressFromFirstOfMonth': 949.5988685657911, 
                       'percentageOfEgressFromFirstOfMonth': 16.25824191940831
                     }
+            graphiteBatch: optional graphite.GraphiteBatch collecting the data of the account cycle,
+                 sent later in a single payload
 
         Returns: 
             none
         """
         
         graphiteContext=self.globalConfig['graphite_context_egress'] + str(self.accountName)
-        graphiteEndpoint = graphite.Graphite(host=self.graphiteHost)
-        graphiteEndpoint.send_dict(graphiteContext, dataEgressConditionsDict,  send_data=True)
+        if graphiteBatch != None:
+            graphiteBatch.add_dict(graphiteContext, dataEgressConditionsDict)
+            return
+        with self.calculator.stageMetrics.stage('graphiteSend'):
+            graphiteEndpoint = graphite.Graphite(host=self.graphiteHost)
+            graphiteEndpoint.send_dict(graphiteContext, dataEgressConditionsDict,  send_data=True)
 
 
 
@@ -0,0 +1,227 @@
+import os
+import tempfile
+import numpy as np
+
+class AWSLineItemColumns(object):
+    """Parsed AWS line items held as parallel NumPy columns.
+
+    Product keys and resource ids are stored once and referenced by index, so
+    a month of detailed line items fits in a few bytes per row.
+    """
+
+    def __init__(self, usageStartDate, productKeyIndex, productKeyList, unblendedCost, usageQuantity,
+                 itemClass, resourceIdIndex, resourceIdList):
+        self.usageStartDate = usageStartDate      # datetime64[s]
+        self.productKeyIndex = productKeyIndex    # int32, index in productKeyList
+        self.productKeyList = productKeyList      # str
+        self.unblendedCost = unblendedCost        # float64
+        self.usageQuantity = usageQuantity        # float64
+        self.itemClass = itemClass                # int8, see AWSBillAnalysis ITEM_CLASS_*
+        self.resourceIdIndex = resourceIdIndex    # int32, index in resourceIdList
+        self.resourceIdList = resourceIdList      # str
+
+    def __len__(self):
+        return len(self.usageStartDate)
+
+    @classmethod
+    def concatenate(cls, columnsList):
+        """Merge the columns of several billing files into one AWSLineItemColumns"""
+        productKeyDict = {}
+        resourceIdDict = {}
+        productKeyIndexList = []
+        resourceIdIndexList = []
+        for columns in columnsList:
+            # Map the indexes of each file to the merged product key and resource id lists
+            productKeyMap = np.array([ productKeyDict.setdefault(productKey, len(productKeyDict)) for productKey in columns.productKeyList.tolist() ], dtype=np.int32)
+            resourceIdMap = np.array([ resourceIdDict.setdefault(resourceId, len(resourceIdDict)) for resourceId in columns.resourceIdList.tolist() ], dtype=np.int32)
+            productKeyIndexList.append(productKeyMap[columns.productKeyIndex])
+            resourceIdIndexList.append(resourceIdMap[columns.resourceIdIndex])
+
+        return cls(np.concatenate([ columns.usageStartDate for columns in columnsList ] + [ np.zeros(0, dtype='datetime64[s]') ]),
+                   np.concatenate(productKeyIndexList + [ np.zeros(0, dtype=np.int32) ]),
+                   np.array(list(productKeyDict), dtype=str),
+                   np.concatenate([ columns.unblendedCost for columns in columnsList ] + [ np.zeros(0, dtype=np.float64) ]),
+                   np.concatenate([ columns.usageQuantity for columns in columnsList ] + [ np.zeros(0, dtype=np.float64) ]),
+                   np.concatenate([ columns.itemClass for columns in columnsList ] + [ np.zeros(0, dtype=np.int8) ]),
+                   np.concatenate(resourceIdIndexList + [ np.zeros(0, dtype=np.int32) ]),
+                   np.array(list(resourceIdDict), dtype=str))
+
+    def iterLineItems(self):
+        """Yield the line items as tuples
+        ( usageStartDateDatetime, productKey, unblendedCost, usageQuantity, itemClass, resourceId )
+        """
+        productKeyList = self.productKeyList.tolist()
+        resourceIdList = self.resourceIdList.tolist()
+        return zip(self.usageStartDate.tolist(),
+                   (productKeyList[i] for i in self.productKeyIndex.tolist()),
+                   self.unblendedCost.tolist(),
+                   self.usageQuantity.tolist(),
+                   self.itemClass.tolist(),
+                   (resourceIdList[i] for i in self.resourceIdIndex.tolist()))
+
+
+class AWSLineItemCache(object):
+    """Local cache of parsed line items, one .npz file next to each downloaded billing file.
+
+    An entry is valid only for the S3 object it was built from, identified by its ETag and size.
+    """
+
+    cacheFileSuffix = '.lineitems.npz'
+    columnNameList = [ 'usageStartDate', 'productKeyIndex', 'productKeyList', 'unblendedCost',
+                       'usageQuantity', 'itemClass', 'resourceIdIndex', 'resourceIdList' ]
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def cacheFileName(self, billFileName):
+        if billFileName.endswith('.csv.zip'):
+            billFileName = billFileName[:-len('.csv.zip')]
+        return billFileName + self.cacheFileSuffix
+
+    def isValid(self, billFileName, eTag, size):
+        """Whether there is a cache entry for billFileName built from the S3 object with this ETag and size"""
+        cacheFileName = self.cacheFileName(billFileName)
+        if not os.path.exists(cacheFileName):
+            return False
+        try:
+            with np.load(cacheFileName) as cacheFile:
+                return str(cacheFile['eTag']) == str(eTag) and int(cacheFile['size']) == int(size)
+        except Exception as error:
+            self.logger.warning('Ignoring unreadable line item cache %s: %s' % (cacheFileName, error))
+            return False
+
+    def load(self, billFileName, eTag, size):
+        """Return the cached AWSLineItemColumns for billFileName, or None if missing, stale or unreadable"""
+        cacheFileName = self.cacheFileName(billFileName)
+        if not os.path.exists(cacheFileName):
+            return None
+        # The entry is checked and read from the same open file, in case it is replaced in between
+        try:
+            with np.load(cacheFileName) as cacheFile:
+                if str(cacheFile['eTag']) != str(eTag) or int(cacheFile['size']) != int(size):
+                    return None
+                columns = AWSLineItemColumns(*[ cacheFile[columnName] for columnName in self.columnNameList ])
+        except Exception as error:
+            self.logger.warning('Ignoring unreadable line item cache %s: %s' % (cacheFileName, error))
+            return None
+        self.logger.debug('Loaded %d line items from cache %s' % (len(columns), cacheFileName))
+        return columns
+
+    def store(self, billFileName, eTag, size, columns):
+        """Save columns for billFileName; the file is written aside and renamed so readers never see a partial entry
+
+        The temporary file is unique, since several threads or processes may store the same entry at the same time
+        """
+        cacheFileName = self.cacheFileName(billFileName)
+        columnDict = dict((columnName, getattr(columns, columnName)) for columnName in self.columnNameList)
+        temporaryFileDescriptor, temporaryFileName = tempfile.mkstemp(prefix=os.path.basename(cacheFileName) + '.', suffix='.tmp',
+                                                                      dir=os.path.dirname(cacheFileName) or '.')
+        try:
+            with os.fdopen(temporaryFileDescriptor, 'wb') as temporaryFile:
+                np.savez(temporaryFile, eTag=np.array(str(eTag)), size=np.array(int(size)), **columnDict)
+            os.replace(temporaryFileName, cacheFileName)
+        except:
+            os.remove(temporaryFileName)
+            raise
+        self.logger.debug('Saved %d line items to cache %s' % (len(columns), cacheFileName))
+
+
+class AWSBillCostIndex(object):
+    """Hourly cumulative sums of the line item costs, for constant time window sums.
+
+    Line items are binned by the hour of their UsageStartDate, and the costs per product key,
+    the total, the data out and the estimated data out are accumulated over the bins: the sum
+    over any range of hours is the difference of two entries.
+
+    AWS bills usage by the hour, so UsageStartDate is on the hour and the sums are exact;
+    a line item starting within an hour would be counted with the line items of that hour.
+    """
+
+    def __init__(self, columns, isIncluded, isAddedToTotal, isDataOut, costOfGBOut):
+        # columns: AWSLineItemColumns
+        # isIncluded: mask of the line items added up per product
+        # isAddedToTotal: mask of the line items added up in the total
+        # isDataOut: mask of the line items added up in the data out
+        self.productKeyList = columns.productKeyList.tolist()
+        numberOfProductKeys = len( self.productKeyList )
+
+        if len( columns ) == 0:
+            self.firstHour = None
+            self.numberOfBins = 0
+        else:
+            usageStartHour = columns.usageStartDate.astype( 'datetime64[h]' )
+            self.firstHour = usageStartHour.min()
+            binIndex = ( usageStartHour - self.firstHour ).astype( np.int64 )
+            self.numberOfBins = int( binIndex.max() ) + 1
+        numberOfBins = self.numberOfBins
+        if numberOfBins == 0:
+            binIndex = np.zeros( 0, dtype=np.int64 )
+
+        def cumulativeSum(weights, mask):
+            return np.concatenate( ( [ 0 ], np.cumsum( np.bincount( binIndex[ mask ], weights=weights[ mask ], minlength=numberOfBins ) ) ) )
+
+        # Per product: row p holds the cumulative cost (and line item count) of productKeyList[ p ]
+        productBinIndex = columns.productKeyIndex[ isIncluded ].astype( np.int64 ) * numberOfBins + binIndex[ isIncluded ]
+        productCost = np.bincount( productBinIndex, weights=columns.unblendedCost[ isIncluded ], minlength=numberOfProductKeys * numberOfBins )
+        productCount = np.bincount( productBinIndex, minlength=numberOfProductKeys * numberOfBins )
+        self.productCumulativeCost = np.zeros( ( numberOfProductKeys, numberOfBins + 1 ) )
+        self.productCumulativeCost[ :, 1: ] = np.cumsum( productCost.reshape( numberOfProductKeys, numberOfBins ), axis=1 )
+        self.productCumulativeCount = np.zeros( ( numberOfProductKeys, numberOfBins + 1 ), dtype=np.int64 )
+        self.productCumulativeCount[ :, 1: ] = np.cumsum( productCount.reshape( numberOfProductKeys, numberOfBins ), axis=1 )
+
+        self.totalCumulativeCost = cumulativeSum( columns.unblendedCost, isAddedToTotal )
+        self.dataOutCumulativeCost = cumulativeSum( columns.unblendedCost, isDataOut )
+        self.estimatedDataOutCumulativeCost = cumulativeSum( columns.usageQuantity * costOfGBOut, isDataOut )
+
+        # All the line items, including the excluded ones, count for the last start date billed
+        lineItemCount = np.bincount( binIndex, minlength=numberOfBins )
+        self.lineItemCumulativeCount = np.concatenate( ( [ 0 ], np.cumsum( lineItemCount ) ) )
+        # Latest UsageStartDate of each bin, and latest non empty bin up to each bin
+        binLastStartSeconds = np.full( numberOfBins, np.iinfo( np.int64 ).min )
+        np.maximum.at( binLastStartSeconds, binIndex, columns.usageStartDate.astype( np.int64 ) )
+        self.binLastStartDate = binLastStartSeconds.astype( 'datetime64[s]' )
+        self.lastNonEmptyBin = np.maximum.accumulate( np.where( lineItemCount > 0, np.arange( numberOfBins ), -1 ) )
+
+    def binRange(self, fromDatetime, toDatetime = None):
+        """Return the bins [ firstBin, lastBin ) of the line items starting from fromDatetime to toDatetime included"""
+        if self.numberOfBins == 0:
+            return 0, 0
+        firstSecond = self.firstHour.astype( 'datetime64[s]' )
+        fromSeconds = int( ( np.datetime64( fromDatetime, 's' ) - firstSecond ) / np.timedelta64( 1, 's' ) )
+        firstBin = min( max( -( -fromSeconds // 3600 ), 0 ), self.numberOfBins )
+        lastBin = self.numberOfBins
+        if toDatetime != None:
+            toSeconds = int( ( np.datetime64( toDatetime, 's' ) - firstSecond ) / np.timedelta64( 1, 's' ) )
+            lastBin = min( max( toSeconds // 3600 + 1, 0 ), self.numberOfBins )
+        return firstBin, max( firstBin, lastBin )
+
+    def binStartDatetime(self, binIndex):
+        """Start of the hour of bin binIndex, as datetime"""
+        return ( self.firstHour + np.timedelta64( int( binIndex ), 'h' ) ).astype( 'datetime64[s]' ).item()
+
+    def lineItemCount(self, firstBin, lastBin):
+        return int( self.lineItemCumulativeCount[ lastBin ] - self.lineItemCumulativeCount[ firstBin ] )
+
+    def lastStartDate(self, firstBin, lastBin):
+        """Latest UsageStartDate of the line items in bins [ firstBin, lastBin ), or None if there are none"""
+        if lastBin <= firstBin:
+            return None
+        lastBin = self.lastNonEmptyBin[ lastBin - 1 ]
+        if lastBin < firstBin:
+            return None
+        return self.binLastStartDate[ lastBin ].item()
+
+    def productCosts(self, firstBin, lastBin):
+        """{ productKey: cost } of the products with line items in bins [ firstBin, lastBin )"""
+        productCount = self.productCumulativeCount[ :, lastBin ] - self.productCumulativeCount[ :, firstBin ]
+        productCost = self.productCumulativeCost[ :, lastBin ] - self.productCumulativeCost[ :, firstBin ]
+        return dict( ( self.productKeyList[ index ], float( productCost[ index ] ) ) for index in np.flatnonzero( productCount ) )
+
+    def totalCost(self, firstBin, lastBin):
+        return float( self.totalCumulativeCost[ lastBin ] - self.totalCumulativeCost[ firstBin ] )
+
+    def dataOutCost(self, firstBin, lastBin):
+        return float( self.dataOutCumulativeCost[ lastBin ] - self.dataOutCumulativeCost[ firstBin ] )
+
+    def estimatedDataOutCost(self, firstBin, lastBin):
+        return float( self.estimatedDataOutCumulativeCost[ lastBin ] - self.estimatedDataOutCumulativeCost[ firstBin ] )
@@ -0,0 +1,119 @@
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+
+class BillingScheduler(object):
+    """Run the billing jobs at their daily times, or when their data arrives.
+
+    The scheduler sleeps until the next deadline (or until it is stopped) instead of polling.
+    Each job runs in its own worker thread, so a long AWS cycle does not delay the GCE one,
+    and a job whose previous run is still going is skipped rather than run twice.
+    A job can also have an arrival check, called every few minutes: the job is run as soon
+    as the check returns True, e.g. when a billing file changed in S3.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.wakeEvent = threading.Event()
+        self.stopped = False
+        self.jobDict = {}
+        # ( deadline in seconds since the epoch, sequence number, job name, 'daily' or 'arrival' )
+        self.deadlineHeap = []
+        self.sequence = itertools.count()
+
+    def addDailyJob(self, name, function, timeList, **kwargs):
+        """Run function(**kwargs) every day at the local times in timeList, e.g. [ '01:05', '13:05' ]"""
+        self.jobDict[name] = { 'function': function, 'kwargs': kwargs, 'thread': None,
+                               'timeList': [ datetime.datetime.strptime(timeString, '%H:%M').time() for timeString in timeList ],
+                               'arrivalCheck': None, 'arrivalInterval': None }
+        self._push(self._nextDailyDeadline(name), name, 'daily')
+
+    def addArrivalTrigger(self, name, arrivalCheck, intervalSeconds):
+        """Call arrivalCheck() every intervalSeconds and run the job name when it returns True"""
+        self.jobDict[name]['arrivalCheck'] = arrivalCheck
+        self.jobDict[name]['arrivalInterval'] = intervalSeconds
+        self._push(time.time() + intervalSeconds, name, 'arrival')
+
+    def run(self):
+        """Run the jobs until stop() is called"""
+        while True:
+            with self.lock:
+                if self.stopped:
+                    return
+                deadline, sequence, name, kind = self.deadlineHeap[0]
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    heapq.heappop(self.deadlineHeap)
+            if timeout > 0:
+                self.wakeEvent.wait(timeout)
+                self.wakeEvent.clear()
+                continue
+
+            if kind == 'daily':
+                self._push(self._nextDailyDeadline(name), name, kind)
+                self.runJob(name, 'schedule')
+            else:
+                self._push(time.time() + self.jobDict[name]['arrivalInterval'], name, kind)
+                # No need to check while the job runs: it would be skipped anyway
+                thread = self.jobDict[name]['thread']
+                if thread is not None and thread.is_alive():
+                    continue
+                # The check runs in the scheduler thread: it should be a quick listing
+                try:
+                    arrived = self.jobDict[name]['arrivalCheck']()
+                except Exception as error:
+                    self.logger.warning('Arrival check for {0} failed: {1}'.format(name, error))
+                    arrived = False
+                if arrived:
+                    self.runJob(name, 'data arrival')
+
+    def runJob(self, name, reason):
+        """Start the job name in a worker thread, unless its previous run is still going; returns True if started"""
+        jobDict = self.jobDict[name]
+        with self.lock:
+            if jobDict['thread'] is not None and jobDict['thread'].is_alive():
+                self.logger.warning('Skipping {0} run triggered by {1}: the previous run is still going'.format(name, reason))
+                return False
+            self.logger.info('Starting {0} run triggered by {1}'.format(name, reason))
+            jobDict['thread'] = threading.Thread(target=self._runJob, args=(name,), name=name, daemon=True)
+            jobDict['thread'].start()
+        return True
+
+    def stop(self, wait = True):
+        """Stop scheduling; with wait, also wait for the running jobs to finish"""
+        with self.lock:
+            self.stopped = True
+            threadList = [ jobDict['thread'] for jobDict in self.jobDict.values() if jobDict['thread'] is not None ]
+        self.wakeEvent.set()
+        if wait:
+            for thread in threadList:
+                thread.join()
+
+    def _runJob(self, name):
+        jobDict = self.jobDict[name]
+        startTime = time.time()
+        try:
+            jobDict['function'](**jobDict['kwargs'])
+        except Exception as error:
+            self.logger.exception(error)
+        self.logger.info('{0} run finished in {1:.0f} s'.format(name, time.time() - startTime))
+
+    def _nextDailyDeadline(self, name):
+        now = datetime.datetime.now()
+        deadlineList = []
+        for timeOfDay in self.jobDict[name]['timeList']:
+            deadline = datetime.datetime.combine(now.date(), timeOfDay)
+            if deadline <= now:
+                deadline += datetime.timedelta(days=1)
+            deadlineList.append(deadline)
+        return time.mktime(min(deadlineList).timetuple())
+
+    def _push(self, deadline, name, kind):
+        with self.lock:
+            heapq.heappush(self.deadlineHeap, (deadline, next(self.sequence), name, kind))
+        # The new deadline may be earlier than the one the scheduler sleeps until
+        self.wakeEvent.set()
@@ -7,15 +7,80 @@ import configparser
 import time
 import yaml
 import traceback
+import threading
+import concurrent.futures
 from datetime import timedelta
 from collections import defaultdict
 # related third party imports
 import pandas as pd
+import requests.adapters
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
 from google.auth.exceptions import RefreshError, DefaultCredentialsError
+# local application imports
+from bill_calculator_hep import graphite
+from bill_calculator_hep.GCEBillCache import GCEDailyRollupCache
+from bill_calculator_hep.StageMetrics import StageMetrics
+
+class GCEBigQueryContext(object):
+    """
+    BigQuery client shared by the GCE calculations of a cycle: the credentials
+    (and their access token) are resolved once, and the HTTP connections are
+    pooled and reused by all the queries. Queries can be run concurrently on
+    a bounded pool of threads.
+
+    Optional global configuration:
+        bigqueryWorkers: maximum number of queries run at the same time (default 4)
+    """
+    def __init__(self, globalConfig, logger):
+        self.logger = logger
+        self.max_workers = globalConfig.get('bigqueryWorkers', 4)
+        self._client = None
+        self._session = None
+        self._lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bigquery')
+
+    @property
+    def client(self):
+        """
+        The BigQuery client, created on first use
+        """
+        with self._lock:
+            if self._client is None:
+                try:
+                    credentials, project = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                except DefaultCredentialsError:
+                    self.logger.error("**** AUTHENTICATION FAILED: Incorrect/Corrupted private key! Please verify. ****")
+                    raise
+                # one pooled HTTP session, sized for the concurrent queries;
+                # the session refreshes the access token only when it expires
+                self._session = AuthorizedSession(credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self._session.mount("https://", adapter)
+                self._client = bigquery.Client(project=project, credentials=credentials, _http=self._session)
+                self.logger.debug(f"Created BigQuery client for project {project}")
+            return self._client
+
+    def map(self, function, *iterables):
+        """
+        Run function over iterables concurrently, e.g. one query per item;
+        returns the results in order
+        """
+        futures = [self.executor.submit(function, *arguments) for arguments in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+                self._session = None
+
 
 class GCEBillCalculator(object):
-    def __init__(self, account, globalConfig, constants, logger, sumToDate = None):
+    def __init__(self, account, globalConfig, constants, logger, sumToDate = None, bigquery_context = None, stage_metrics = None):
         self.logger = logger
         self.globalConfig = globalConfig
         # Configuration parameters
@@ -26,6 +91,44 @@ class GCEBillCalculator(object):
         self.applyDiscount = constants['applyDiscount']
         # Expect sumToDate as '%m/%d/%y %H:%M' : validated when needed
         self.sumToDate = sumToDate #  '08/31/16 23:59'
+        # optional bigqueryStorageApi (0 or 1) in the global section: 1 means
+        # query results are read as Arrow record batches with the BigQuery
+        # Storage Read API (needs google-cloud-bigquery-storage)
+        self.use_bigquery_storage_api = globalConfig.get('bigqueryStorageApi', 0) != 0
+        # optional dailyRollupCache (0 or 1) in the global section: 1 means the
+        # days older than lateDataDays (default 3) are aggregated once and kept
+        # in a SQLite cache in outputPath, and only the later days are queried
+        self.daily_rollup_cache = None
+        if globalConfig.get('dailyRollupCache', 0) != 0:
+            self.daily_rollup_cache = GCEDailyRollupCache(os.path.join(globalConfig['outputPath'], 'gce-daily-rollup.sqlite'), logger)
+        self.late_data_days = globalConfig.get('lateDataDays', 3)
+        # optional billingPartitionColumn in the global section: the column the
+        # billing export table is partitioned on (default _PARTITIONTIME), used
+        # to prune the partitions older than the billing period; empty to
+        # filter on the usage timestamps only
+        self.partition_column = globalConfig.get('billingPartitionColumn', '_PARTITIONTIME')
+        # optional maximumBytesBilled in the global section: a query whose dry
+        # run estimates more bytes processed is not run, and BigQuery fails a
+        # job that would bill more
+        self.maximum_bytes_billed = globalConfig.get('maximumBytesBilled', None)
+        # bytes processed, bytes billed and cache hit of the jobs of the last
+        # bill calculation
+        self.query_statistics = []
+        # costs, credits and adjustments per hour of the billing period,
+        # fetched once and shared by all the alarm windows
+        self.hourly_series = None
+        self.hourly_series_period = None
+        # BigQuery client shared with the other calculations of the cycle;
+        # a calculator without one creates its own, closed with the calculator
+        self.owns_bigquery_context = bigquery_context is None
+        if bigquery_context is None:
+            bigquery_context = GCEBigQueryContext(globalConfig, logger)
+        self.bigquery_context = bigquery_context
+        # durations of the stages (queries, sub totals, alarm windows) and
+        # BigQuery counters of the account, shared with the alarm
+        if stage_metrics is None:
+            stage_metrics = StageMetrics()
+        self.stage_metrics = stage_metrics
         self.logger.info('Loaded account configuration successfully')
 
         # defining additional constants that will be used to store cloud billing
@@ -45,6 +148,18 @@ class GCEBillCalculator(object):
     def set_sum_to_date(self, sumToDate):
         self.sumToDate = sumToDate
 
+    def close(self):
+        """
+        This method releases the daily rollup cache connection and the
+        BigQuery client the calculator created, once the calculations of the
+        account (bill, alarm) are done.
+        """
+        if self.daily_rollup_cache is not None:
+            self.daily_rollup_cache.close()
+            self.daily_rollup_cache = None
+        if self.owns_bigquery_context:
+            self.bigquery_context.close()
+
     # TODO: check for possible refactoring of the following methods to redefine them as instance methods, class method or static methods
     def calculate_bill(self):
         """
@@ -53,21 +168,23 @@ class GCEBillCalculator(object):
         channel configuration).
         """
         # defining a few constants...
-        query_costs_credits, query_adjustments, last_start_date_billed_considered = self.initialize_constants_for_bill_calculation()
+        query_costs_adjustments, last_start_date_billed_considered = self.initialize_constants_for_bill_calculation()
+        self.query_statistics = []
 
         # invoking bigquery client APIs to query BigQuery for cloud billing
         # data...
-        try:
-            bq_client = bigquery.Client()
-        except DefaultCredentialsError:
-            self.logger.error("**** AUTHENTICATION FAILED: Incorrect/Corrupted private key! Please verify. ****")
-            raise
+        bq_client = self.bigquery_context.client
 
-        line_items_costs = self.calculate_sub_totals(bq_client, query_costs_credits, cost_query=True)
-        self.logger.info(f"Line item costs: {line_items_costs}")
+        # a single job returns both the costs and the adjustments issued
+        if self.daily_rollup_cache is not None:
+            query_result = self.query_with_daily_rollup_cache(bq_client)
+        else:
+            query_result = self.query_cloud_billing_data(bq_client, query_costs_adjustments)
 
-        # using similar logic to gather data about adjustments issued...
-        adj_issued = self.calculate_sub_totals(bq_client, query_adjustments)
+        with self.stage_metrics.stage('subTotals'):
+            line_items_costs = self.calculate_sub_totals(query_result, cost_query=True)
+            adj_issued = self.calculate_sub_totals(query_result)
+        self.logger.info(f"Line item costs: {line_items_costs}")
         self.logger.info(f"Line Item adjustments: {adj_issued}")
 
         # adding information from the adjustments dictionary to the costs
@@ -95,6 +212,10 @@ class GCEBillCalculator(object):
         self.logger.info(f"Last Known Balance : {str(self.balanceAtDate)}")
         self.logger.info(f"Date of Last Known Balance : {self.lastKnownBillDate}")
         self.logger.info(f"Bill Summary: {line_items_costs}")
+        self.logger.info(f"BigQuery jobs: {len(self.query_statistics)}, "
+                         f"bytes processed: {sum(stats['total_bytes_processed'] or 0 for stats in self.query_statistics)}, "
+                         f"bytes billed: {sum(stats['total_bytes_billed'] or 0 for stats in self.query_statistics)}, "
+                         f"cache hits: {sum(1 for stats in self.query_statistics if stats['cache_hit'])}")
         # converting the dictionary containing line items costs to a dataframe
         # before returning from here since the calling function requires a
         # dataframe...
@@ -106,8 +227,9 @@ class GCEBillCalculator(object):
         graphiteHost=self.globalConfig['graphite_host']
         graphiteContext=self.globalConfig['graphite_context_billing'] + str(self.project_id)
 
-        graphiteEndpoint = graphite.Graphite(host=graphiteHost)
-        graphiteEndpoint.send_dict(graphiteContext, CorrectedBillSummaryDict, send_data=True)
+        with self.stage_metrics.stage('graphiteSend'):
+            graphiteEndpoint = graphite.Graphite(host=graphiteHost)
+            graphiteEndpoint.send_dict(graphiteContext, CorrectedBillSummaryDict, send_data=True)
 
     def initialize_constants_for_bill_calculation(self):
         """
@@ -143,30 +265,231 @@ class GCEBillCalculator(object):
         usage_end_to = sum_bill_to              #  class datetime.datetime
         self.logger.info(f"usageEndDate: {usage_end_to}")
 
-        # queries to query cloud billing data in BigQuery
+        # kept to build the queries of other date ranges
+        self.billing_data_table = billing_data_table
+        self.usage_start_from = usage_start_from
+        self.usage_end_to = usage_end_to
+
+        costs_adjustments_query = self.build_costs_adjustments_query(usage_start_from.date(), usage_end_to.date())
+
+        return costs_adjustments_query, last_start_date
+
+    def build_row_filter(self, start_from_date, start_to_date, end_filter=True):
+        """
+        This method builds the WHERE condition of the rows of the project
+        starting from start_from_date to start_to_date, included, and with
+        end_filter, ending within the billing period.
+        """
+        # the usage dates are compared as half-open ranges of the raw (UTC)
+        # timestamps, which BigQuery can use to prune, instead of DATE() of
+        # every row
+        start_to_next_day = start_to_date + timedelta(days=1)
+        end_from_date = self.usage_start_from.date()
+        end_to_next_day = self.usage_end_to.date() + timedelta(days=1)
+        row_filter = (f"project.id = '{self.project_id}'"
+                      f" AND usage_start_time >= TIMESTAMP('{start_from_date}') AND usage_start_time < TIMESTAMP('{start_to_next_day}')")
+        if end_filter:
+            row_filter += f" AND usage_end_time >= TIMESTAMP('{end_from_date}') AND usage_end_time < TIMESTAMP('{end_to_next_day}')"
+        # rows are exported after their usage started, so partitions older
+        # than the first usage day have no row of the billing period; late
+        # rows and adjustments can land in any later partition
+        if self.partition_column:
+            row_filter = f"{self.partition_column} >= TIMESTAMP('{start_from_date}') AND {row_filter}"
+        return row_filter
+
+    def build_costs_adjustments_query(self, start_from_date, start_to_date, by_day=False):
+        """
+        This method builds the query of the costs, credits and adjustments of
+        the rows of the billing period starting from start_from_date to
+        start_to_date, included; by_day groups them per day of usage start and
+        of usage end too, for the rows ending at any time.
+        """
+        # query to query cloud billing data in BigQuery: costs and credits of
+        # all the rows, and with conditional aggregation, costs and credits of
+        # the rows that are adjustments, in a single scan of the table
         # date format in bigquery: YYYY-MM-DD HH:MM:SS:MS TZ
-        costs_query = f"""
-        SELECT sku.description as Sku, service.description as Service, ROUND(SUM(CAST(cost AS NUMERIC)), 8) as rawCost, ROUND(SUM(IFNULL((SELECT SUM(CAST(c.amount AS NUMERIC)) FROM UNNEST(credits) AS c), 0)), 8) as rawCredits FROM `{billing_data_table}` WHERE project.id = '{billing_project_id}' AND DATE(usage_start_time) BETWEEN '{usage_start_from.date()}' AND '{usage_end_to.date()}' AND DATE(usage_end_time) BETWEEN '{usage_start_from.date()}' AND '{usage_end_to.date()}'
-        GROUP BY 1, 2
+        # the days cached by by_day are kept across billing periods, so their
+        # rows are not filtered on the end of the period but grouped by end
+        # day, which the daily rollup cache filters on when loading them
+        day_column = "DATE(usage_start_time) as Day, DATE(usage_end_time) as EndDay," if by_day else ""
+        day_group = ", Day, EndDay" if by_day else ""
+        costs_adjustments_query = f"""
+        WITH line_items AS (
+        SELECT sku.description as Sku, service.description as Service, {day_column}
+        CAST(cost AS NUMERIC) as cost,
+        IFNULL((SELECT SUM(CAST(c.amount AS NUMERIC)) FROM UNNEST(credits) AS c), 0) as credits,
+        adjustment_info.id IS NOT NULL as is_adjustment
+        FROM `{self.billing_data_table}` WHERE {self.build_row_filter(start_from_date, start_to_date, end_filter=not by_day)}
+        )
+        SELECT Sku, Service{day_group},
+        ROUND(SUM(cost), 8) as rawCost,
+        ROUND(SUM(credits), 8) as rawCredits,
+        ROUND(SUM(IF(is_adjustment, cost, 0)), 8) as rawAdjustments,
+        ROUND(SUM(IF(is_adjustment, credits, 0)), 8) as rawAdjustmentCredits,
+        COUNTIF(is_adjustment) as adjustmentCount
+        FROM line_items
+        GROUP BY Sku, Service{day_group}
+        """
+        return costs_adjustments_query
+
+    def build_hourly_series_query(self):
         """
-        adjustments_query = f"""
-        SELECT sku.description as Sku, service.description as Service,
-        ROUND(SUM(CAST(cost AS NUMERIC)), 8) as rawAdjustments,
-        ROUND(SUM(IFNULL((SELECT SUM(CAST(c.amount AS NUMERIC)) FROM
-        UNNEST(credits) AS c), 0)), 8) as rawCredits FROM
-        `{billing_data_table}` WHERE project.id = '{billing_project_id}' AND DATE(usage_start_time) BETWEEN '{usage_start_from.date()}' AND '{usage_end_to.date()}' AND DATE(usage_end_time) BETWEEN '{usage_start_from.date()}' AND '{usage_end_to.date()}' AND adjustment_info.id IS NOT NULL
-        GROUP BY 1, 2
+        This method builds the query of the costs, credits and adjustments of
+        the billing period added up per hour of usage start, for all the
+        services and skus.
         """
+        hourly_series_query = f"""
+        WITH line_items AS (
+        SELECT TIMESTAMP_TRUNC(usage_start_time, HOUR) as Hour,
+        CAST(cost AS NUMERIC) as cost,
+        IFNULL((SELECT SUM(CAST(c.amount AS NUMERIC)) FROM UNNEST(credits) AS c), 0) as credits,
+        adjustment_info.id IS NOT NULL as is_adjustment
+        FROM `{self.billing_data_table}` WHERE {self.build_row_filter(self.usage_start_from.date(), self.usage_end_to.date())}
+        )
+        SELECT Hour,
+        ROUND(SUM(cost), 8) as rawCost,
+        ROUND(SUM(credits), 8) as rawCredits,
+        ROUND(SUM(IF(is_adjustment, cost, 0)), 8) as rawAdjustments,
+        ROUND(SUM(IF(is_adjustment, credits, 0)), 8) as rawAdjustmentCredits,
+        COUNTIF(is_adjustment) as adjustmentCount
+        FROM line_items
+        GROUP BY Hour
+        ORDER BY Hour
+        """
+        return hourly_series_query
+
+    def get_hourly_series(self):
+        """
+        This method returns the costs, credits and adjustments of the billing
+        period per hour, indexed by the (naive UTC) hour, with the cost after
+        credits in the Cost column. The series is queried once per billing
+        period and kept in memory.
+        """
+        self.initialize_constants_for_bill_calculation()
+        period = (self.usage_start_from, self.usage_end_to)
+        if self.hourly_series is None or self.hourly_series_period != period:
+            self.logger.info(f"Querying hourly costs from {self.usage_start_from} to {self.usage_end_to}")
+            query_result = self.query_cloud_billing_data(self.bigquery_context.client, self.build_hourly_series_query())
+            hours = pd.to_datetime(query_result['Hour'], utc=True).dt.tz_localize(None)
+            hourly_series = query_result.drop(columns='Hour').set_index(hours).sort_index()
+            hourly_series['Cost'] = hourly_series['rawCost'] + hourly_series['rawCredits']
+            self.hourly_series = hourly_series
+            self.hourly_series_period = period
+        return self.hourly_series
+
+    def last_hour_billed(self):
+        """
+        This method returns the last hour (datetime.datetime) with billed
+        usage in the billing period, or the start of the period if none.
+        """
+        hourly_series = self.get_hourly_series()
+        if hourly_series.empty:
+            return self.usage_start_from
+        return hourly_series.index[-1].to_pydatetime()
 
-        return costs_query, adjustments_query, last_start_date
+    def cost_in_window(self, window_from, window_to = None):
+        """
+        This method returns the cost after credits of the usage started from
+        window_from, included, to window_to, excluded (to the end of the
+        billing period if None), from the hourly series.
+        """
+        hourly_series = self.get_hourly_series()
+        in_window = hourly_series.index >= window_from
+        if window_to is not None:
+            in_window &= hourly_series.index < window_to
+        return float(hourly_series.loc[in_window, 'Cost'].sum())
+
+    def month_to_date_cost(self, at_datetime = None):
+        """
+        This method returns the cost after credits from the beginning of the
+        month of at_datetime (default the last hour billed) to at_datetime,
+        included, within the billing period.
+        """
+        if at_datetime is None:
+            at_datetime = self.last_hour_billed()
+        month_start = at_datetime.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return self.cost_in_window(month_start, at_datetime + timedelta(hours=1))
 
-    def query_cloud_billing_data(self, bigquery_client, query, cost_query=None):
+    def query_with_daily_rollup_cache(self, bigquery_client):
+        """
+        This method returns the costs and adjustments of the billing period,
+        with the days older than the late data horizon served from the daily
+        rollup cache, and only the remaining open days queried from BigQuery.
+        """
+        from_day = self.usage_start_from.date()
+        to_day = self.usage_end_to.date()
+        # the last day of the billing period is always queried since its rows
+        # are also filtered on their end date
+        first_open_day = min(datetime.datetime.utcnow().date() - timedelta(days=self.late_data_days), to_day)
+        first_open_day = max(first_open_day, from_day)
+
+        self.logger.info(f"Querying open days from {first_open_day} to {to_day}")
+        queries = [self.build_costs_adjustments_query(first_open_day, to_day)]
+        missing_days = []
+        if from_day < first_open_day:
+            last_closed_day = first_open_day - timedelta(days=1)
+            cached_days = self.daily_rollup_cache.cached_days(self.project_id, from_day, last_closed_day)
+            missing_days = [day for day in pd.date_range(from_day, last_closed_day, freq='D').date if day not in cached_days]
+            if missing_days:
+                self.logger.info(f"Querying {len(missing_days)} closed days from {missing_days[0]} to {missing_days[-1]} for the daily rollup cache")
+                queries.append(self.build_costs_adjustments_query(missing_days[0], missing_days[-1], by_day=True))
+
+        # the open days and the missing closed days are queried concurrently
+        query_results = self.bigquery_context.map(self.query_cloud_billing_data, [bigquery_client] * len(queries), queries)
+        with self.stage_metrics.stage('dailyRollupCache'):
+            if missing_days:
+                self.daily_rollup_cache.store(self.project_id, missing_days[0], missing_days[-1], query_results.pop())
+            if from_day < first_open_day:
+                query_results.append(self.daily_rollup_cache.load(self.project_id, from_day, last_closed_day, from_day, to_day))
+
+        # add up the closed and open days per (Service, Sku)
+        query_result = pd.concat(query_results, ignore_index=True)
+        return query_result.groupby(['Sku', 'Service'], as_index=False, sort=False)[GCEDailyRollupCache.value_columns].sum()
+
+    def query_cloud_billing_data(self, bigquery_client, query):
         """
         This method queries BigQuery to fetch costs,
         credits and adjustments data from cloud billing data.
         """
+        numeric_columns = ['rawCost', 'rawCredits', 'rawAdjustments', 'rawAdjustmentCredits']
         try:
-            query_result = bigquery_client.query(query).to_dataframe()
+            # the dry run is free: it validates the query and estimates the
+            # bytes it processes, to check them against maximumBytesBilled
+            with self.stage_metrics.stage('bigqueryDryRun'):
+                dry_run_job = bigquery_client.query(query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+            estimated_bytes = dry_run_job.total_bytes_processed
+            self.logger.info(f"BigQuery dry run for '{self.project_id}': {estimated_bytes} bytes estimated")
+            if self.maximum_bytes_billed is not None and estimated_bytes > self.maximum_bytes_billed:
+                raise Exception(f"BigQuery job for '{self.project_id}' would process {estimated_bytes} bytes, more than maximumBytesBilled {self.maximum_bytes_billed}")
+
+            # the job and the download of its result
+            with self.stage_metrics.stage('bigqueryQuery'):
+                query_job = bigquery_client.query(query, job_config=bigquery.QueryJobConfig(maximum_bytes_billed=self.maximum_bytes_billed))
+                if self.use_bigquery_storage_api:
+                    # fetch the result as Arrow record batches through the BigQuery
+                    # Storage Read API, and convert the numeric columns in Arrow
+                    arrow_result = query_job.to_arrow(create_bqstorage_client=True)
+                    for column in numeric_columns:
+                        arrow_result = arrow_result.set_column(arrow_result.schema.get_field_index(column), column,
+                                                               arrow_result.column(column).cast('float64'))
+                    query_result = arrow_result.to_pandas()
+                else:
+                    query_result = query_job.to_dataframe()
+            # statistics of the finished job
+            job_statistics = {'job_id': query_job.job_id,
+                              'estimated_bytes': estimated_bytes,
+                              'total_bytes_processed': query_job.total_bytes_processed,
+                              'total_bytes_billed': query_job.total_bytes_billed,
+                              'cache_hit': query_job.cache_hit}
+            self.query_statistics.append(job_statistics)
+            self.stage_metrics.merge({'bigqueryJobs': 1,
+                                      'bigqueryEstimatedBytes': estimated_bytes or 0,
+                                      'bigqueryBytesProcessed': query_job.total_bytes_processed or 0,
+                                      'bigqueryBytesBilled': query_job.total_bytes_billed or 0,
+                                      'bigqueryCacheHits': 1 if query_job.cache_hit else 0,
+                                      'bigqueryRowsFetched': len(query_result)})
+            self.logger.info(f"BigQuery job {query_job.job_id} for '{self.project_id}': {query_job.total_bytes_processed} bytes processed, "
+                             f"{query_job.total_bytes_billed} bytes billed, cache hit: {query_job.cache_hit}")
         except RefreshError as rEx:
             if rEx.args[1]['error_description'] == "Invalid grant: account not found":
                 self.logger.error("**** AUTHENTICATION FAILED: One/more fields in the credential might be incorrect/corrupted! ****")
@@ -174,62 +497,53 @@ class GCEBillCalculator(object):
                 self.logger.error("**** AUTHENTICATION FAILED: Invalid credential file!! ****")
             raise
 
-        # check the query flag to determine whether query for costs or
-        # adjustments was run
-        if cost_query:
-            target_column = 'rawCost'
-        else:
-            target_column = 'rawAdjustments'
         # dataframe columns, including numeric, have dtype object; convert to
         # float type
-        query_result = query_result.astype({target_column: 'float64', 'rawCredits': 'float64'})
-        # group data based on service category
-        result = query_result.groupby('Service')[['Sku', target_column, 'rawCredits']].apply(lambda x: x.set_index('Sku').to_dict(orient='index')).to_dict()
-        # 'result' is a dictionary of the form: {service: {sku1: {rawCost: 1.00,
-        # rawCredits: 2.00}, sku2: {rawCost: 3.00, rawCredits: 0.00}}}, (OR)
-        # {service: {sku1: {rawAdjustments: 1.00, rawCredits: 2.00}, sku2:
-        # {rawAdjustments: 3.00, rawCredits: 0.00}}}
+        query_result = query_result.astype(dict((column, 'float64') for column in numeric_columns))
 
-        return result, target_column
+        return query_result
 
-    def calculate_sub_totals(self, bigquery_client, query, cost_query = None):
+    def line_item_keys(self, query_result):
+        """
+        This method builds the line item key '<service>.<sku>' of every row of
+        the query result, e.g. 'compute-engine.N1PredefinedInstanceCore': the
+        service is lower case with words joined by '-', the sku has no spaces.
+        """
+        service = query_result['Service'].str.strip().str.lower().str.replace(r'\s+', '-', regex=True)
+        sku = query_result['Sku'].str.replace(r'\s+', '', regex=True)
+        return service + '.' + sku
+
+    def calculate_sub_totals(self, query_result, cost_query = None):
         """
         This method computes the total cost and total adjustments
-        issued individually.
+        issued individually, from the result of the costs and adjustments query.
         """
         # defining additional constants that will be used to store cloud billing data from BigQuery...
         raw_cost_key = "rawCost"
         credit_key = "Credits"
         cost_key = "Cost"
+        # column operations over all the (service, sku) rows; rows whose names
+        # differ only by spaces end up in the same line item and are added up
+        line_items = query_result.assign(line_item=self.line_item_keys(query_result))
         if cost_query:
-            query_result, cost_column = self.query_cloud_billing_data(bigquery_client, query, cost_query)
+            costs = line_items.groupby('line_item', sort=False)[[raw_cost_key, 'rawCredits']].sum()
+            # cost is before credits; so add credits to cost to get the
+            # actual costs for the sku/service
+            costs[cost_key] = costs[raw_cost_key] + costs['rawCredits']
+            costs = costs.rename(columns={'rawCredits': credit_key})
             sub_totals = dict()
-            sub_totals[self.total_key] = 0.0
+            # cumulative costs for the time window for which the bill is being
+            # calculated
+            sub_totals[self.total_key] = float(costs[cost_key].sum())
             sub_totals[self.adjusted_support_cost_key] = 0.0
+            sub_totals.update(costs[[raw_cost_key, credit_key, cost_key]].to_dict(orient='index'))
         else:
-            query_result, adjColumn = self.query_cloud_billing_data(bigquery_client, query)
-            sub_totals = defaultdict(float)
-
-        for service_name, sku in query_result.items():
-            for sku_name, usage_info in sku.items():
-                service = "-".join(service_name.lower().split())
-                sku = "".join(sku_name.split())
-                line_item = f"{service}.{sku}"
-                if cost_query:
-                    total = float(sum(usage_info.values()))
-                    # cost is before credits; so add credits to cost to get the
-                    # actual costs for the sku/service
-                    sub_totals[line_item] = {
-                        raw_cost_key: usage_info[cost_column],
-                        credit_key: usage_info['rawCredits'],
-                        cost_key: total
-                    }
-                else:
-                    total = float(sum(usage_info.values()))
-                    sub_totals[line_item] = total
-                # add the line item cost to the cumulative costs for the time
-                # window for which the bill is being calculated
-                sub_totals[self.total_key] += total
+            # only the line items with adjustments issued, with the credits of
+            # these adjustments
+            adjustments = line_items[line_items['adjustmentCount'] > 0].groupby('line_item', sort=False)[['rawAdjustments', 'rawAdjustmentCredits']].sum()
+            adjustment_totals = adjustments['rawAdjustments'] + adjustments['rawAdjustmentCredits']
+            sub_totals = defaultdict(float, adjustment_totals.to_dict())
+            sub_totals[self.total_key] = float(adjustment_totals.sum())
 
         return sub_totals
 
@@ -299,17 +613,20 @@ class GCEBillAlarm(object):
             }
         """
 
-        # Get total and last date billed
-        lastStartDateBilledDatetime, CorrectedBillSummaryNowDict = self.calculator.CalculateBill()
-        dateNow = datetime.datetime.now()
-
-        # Get cost in the last 24 hours
-        oneDayBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=24)
-        self.calculator.setLastKnownBillDate(oneDayBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'))
-        newLastStartDateBilledDatetime, CorrectedBillSummaryOneDayBeforeDict = self.calculator.CalculateBill()
-
-        costInLastDay = CorrectedBillSummaryOneDayBeforeDict['AdjustedTotal']
-        costRatePerHourInLastDay = costInLastDay / 24
+        with self.calculator.stage_metrics.stage('alarmWindows'):
+            # All the windows are computed from the hourly series of the billing
+            # period, queried once by the calculator
+            # Get total and last date billed
+            lastStartDateBilledDatetime = self.calculator.last_hour_billed()
+            adjustedTotalNow = self.calculator.cost_in_window(self.calculator.usage_start_from)
+            currentBalance = self.calculator.balanceAtDate - adjustedTotalNow
+            dateNow = datetime.datetime.utcnow()
+
+            # Get cost in the last 24 hours
+            oneDayBeforeLastDateBilledDatetime = lastStartDateBilledDatetime - timedelta(hours=24)
+            costInLastDay = self.calculator.cost_in_window(oneDayBeforeLastDateBilledDatetime)
+            costRatePerHourInLastDay = costInLastDay / 24
+            costInCurrentMonth = self.calculator.month_to_date_cost(lastStartDateBilledDatetime)
 
         dataDelay = int((time.mktime(dateNow.timetuple()) - time.mktime(lastStartDateBilledDatetime.timetuple())) / 3600)
         self.logger.info('---')
@@ -318,8 +635,9 @@ class GCEBillAlarm(object):
         self.logger.info('Now '+dateNow.strftime('%m/%d/%y %H:%M'))
         self.logger.info('Delay between now and Last Start Date Billed Considered in hours '+str(dataDelay))
         self.logger.info('One day before that: ' + oneDayBeforeLastDateBilledDatetime.strftime('%m/%d/%y %H:%M'))
-        self.logger.info('Adjusted Total Now from Date of Last Known Balance: $' + str(CorrectedBillSummaryNowDict['AdjustedTotal']))
+        self.logger.info('Adjusted Total Now from Date of Last Known Balance: $' + str(adjustedTotalNow))
         self.logger.info('Cost In the Last Day: $' + str(costInLastDay))
+        self.logger.info('Cost In the Current Month: $' + str(costInCurrentMonth))
         self.logger.info('Cost Rate Per Hour In the Last Day: $'+str(costRatePerHourInLastDay)+' / h')
         self.logger.info('Alarm Threshold: $'+str(self.constants['costRatePerHourInLastDayAlarmThreshold']))
         self.logger.info('---')
@@ -328,7 +646,7 @@ class GCEBillAlarm(object):
                                 'costRatePerHourInLastDay' : costRatePerHourInLastDay, \
                                 'costRatePerHourInLastDayAlarmThreshold' : self.costRatePerHourInLastDayAlarmThreshold, \
                                 'delayTolastStartDateBilledDatetime': dataDelay, \
-                                'currentBalance': CorrectedBillSummaryNowDict['Balance'], \
+                                'currentBalance': currentBalance, \
                                 'timeDeltaforCostCalculations': self.timeDeltaforCostCalculations, \
                                 'burnRateAlarmThreshold': self.burnRateAlarmThreshold
 
@@ -357,8 +675,9 @@ class GCEBillAlarm(object):
         graphiteHost=self.globalConfig['graphite_host']
         graphiteContext=self.globalConfig['graphite_context_alarms'] + str(self.projectId)
 
-        graphiteEndpoint = graphite.Graphite(host=graphiteHost)
-        graphiteEndpoint.send_dict(graphiteContext, alarmConditionsDict, send_data=True)
+        with self.calculator.stage_metrics.stage('graphiteSend'):
+            graphiteEndpoint = graphite.Graphite(host=graphiteHost)
+            graphiteEndpoint.send_dict(graphiteContext, alarmConditionsDict, send_data=True)
     
     def submitAlert(message, snowConfig):
         sendAlarmByEmail(alarmMessageString = message, 
@@ -429,12 +748,13 @@ if __name__ == "__main__":
             os.chdir(os.environ.get('BILL_DATA_DIR'))
             logger.info("[UNIT TEST] Starting Billing Analysis for GCE {0} account".format(account))
             calculator = GCEBillCalculator(account, globalConfig, constantsDict, logger)
-            lastStartDateBilledConsideredDatetime, CorrectedBillSummaryDict = calculator.CalculateBill()
-            calculator.sendDataToGraphite(CorrectedBillSummaryDict)
+            CorrectedBillSummaryDict = calculator.calculate_bill().iloc[0].to_dict()
+            calculator.send_data_to_graphite(CorrectedBillSummaryDict)
 
             logger.info("[UNIT TEST] Starting Alarm calculations for GCE {0} account".format(account))
             alarm = GCEBillAlarm(calculator, account, globalConfig, constantsDict, logger)
             message = alarm.EvaluateAlarmConditions(publishData = True)
+            calculator.close()
         except Exception as error:
             logger.exception(error)
             continue
@@ -0,0 +1,96 @@
+# standard library imports
+import sqlite3
+import datetime
+# related third party imports
+import pandas as pd
+
+class GCEDailyRollupCache(object):
+    """
+    Local SQLite cache of the GCE billing data aggregated per day and per
+    (Service, Sku), for the days of the billing export that no longer change.
+
+    A day is cached as a whole: once stored, it is listed in the cached_days
+    table even if it has no costs, so that it is never queried again. Its rows
+    are kept per day of usage end too, so that the days can be loaded for any
+    billing period, whose rows end within the period.
+    """
+    # version of the tables, in the user_version of the file: the tables of
+    # older versions are dropped and the days queried again
+    schema_version = 2
+    value_columns = ['rawCost', 'rawCredits', 'rawAdjustments', 'rawAdjustmentCredits', 'adjustmentCount']
+
+    def __init__(self, cache_file, logger):
+        self.cache_file = cache_file
+        self.logger = logger
+        # several accounts may share the file: wait for the other writers
+        self.connection = sqlite3.connect(cache_file, timeout=60, check_same_thread=False)
+        with self.connection:
+            user_version, = self.connection.execute("PRAGMA user_version").fetchone()
+            if user_version != self.schema_version:
+                self.connection.execute("DROP TABLE IF EXISTS daily_rollup")
+                self.connection.execute("DROP TABLE IF EXISTS cached_days")
+                self.connection.execute(f"PRAGMA user_version = {self.schema_version}")
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS daily_rollup (
+                project_id TEXT, day TEXT, end_day TEXT, Service TEXT, Sku TEXT,
+                rawCost REAL, rawCredits REAL, rawAdjustments REAL, rawAdjustmentCredits REAL, adjustmentCount INTEGER,
+                PRIMARY KEY (project_id, day, end_day, Service, Sku))
+            """)
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS cached_days (
+                project_id TEXT, day TEXT, cached_at TEXT,
+                PRIMARY KEY (project_id, day))
+            """)
+
+    def close(self):
+        """
+        This method closes the connection to the cache file.
+        """
+        self.connection.close()
+
+    def cached_days(self, project_id, from_day, to_day):
+        """
+        This method returns the set of days (datetime.date) between from_day
+        and to_day, included, that are in the cache.
+        """
+        cursor = self.connection.execute("SELECT day FROM cached_days WHERE project_id = ? AND day BETWEEN ? AND ?",
+                                         (project_id, from_day.isoformat(), to_day.isoformat()))
+        return set(datetime.date.fromisoformat(day) for day, in cursor)
+
+    def load(self, project_id, from_day, to_day, end_from_day, end_to_day):
+        """
+        This method returns the cached costs and adjustments from from_day to
+        to_day, included, of the usage ending from end_from_day to end_to_day,
+        included, added up per (Service, Sku), with the columns of the costs
+        and adjustments query.
+        """
+        query_result = pd.read_sql_query(f"""
+            SELECT Sku, Service, {', '.join(f'SUM({column}) as {column}' for column in self.value_columns)}
+            FROM daily_rollup WHERE project_id = ? AND day BETWEEN ? AND ? AND end_day BETWEEN ? AND ?
+            GROUP BY Sku, Service
+            """, self.connection, params=(project_id, from_day.isoformat(), to_day.isoformat(),
+                                          end_from_day.isoformat(), end_to_day.isoformat()))
+        self.logger.debug(f"Loaded {len(query_result)} (Service, Sku) rows from {from_day} to {to_day} from {self.cache_file}")
+        return query_result
+
+    def store(self, project_id, from_day, to_day, daily_result):
+        """
+        This method replaces the cached days from from_day to to_day, included,
+        with daily_result: the costs and adjustments query result per day, with
+        the days (datetime.date) of usage start and end in the Day and EndDay
+        columns.
+        """
+        days = pd.date_range(from_day, to_day, freq='D').date
+        rows = daily_result.assign(project_id=project_id, day=pd.to_datetime(daily_result['Day']).dt.strftime('%Y-%m-%d'),
+                                   end_day=pd.to_datetime(daily_result['EndDay']).dt.strftime('%Y-%m-%d'))
+        # sqlite3 binds python numbers, not numpy ones
+        rows = rows[['project_id', 'day', 'end_day', 'Service', 'Sku'] + self.value_columns].astype(object)
+        cached_at = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.execute("DELETE FROM daily_rollup WHERE project_id = ? AND day BETWEEN ? AND ?",
+                                    (project_id, from_day.isoformat(), to_day.isoformat()))
+            self.connection.executemany("INSERT INTO daily_rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        rows.itertuples(index=False, name=None))
+            self.connection.executemany("INSERT OR REPLACE INTO cached_days VALUES (?, ?, ?)",
+                                        [(project_id, day.isoformat(), cached_at) for day in days])
+        self.logger.info(f"Cached {len(rows)} (day, end day, Service, Sku) rows from {from_day} to {to_day} in {self.cache_file}")
@@ -0,0 +1,91 @@
+import io
+import threading
+import concurrent.futures
+
+class S3ObjectReader(io.RawIOBase):
+    """Seekable, read-only file object over an S3 object, read with ranged GETs.
+
+    The object is read in chunks of transferConfig.multipart_chunksize bytes. The chunks
+    following the current position are fetched ahead, up to transferConfig.max_request_concurrency
+    at a time, so that the consumer (e.g. ZipFile decompressing a billing file) keeps working
+    while the next chunks are on the network. Only the chunks around the current position are
+    kept in memory.
+    """
+
+    def __init__(self, s3, bucket, key, size, transferConfig):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.chunkSize = transferConfig.multipart_chunksize
+        self.readAheadChunks = transferConfig.max_request_concurrency
+        self.numberOfChunks = (size + self.chunkSize - 1) // self.chunkSize
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.readAheadChunks)
+        self.chunkFutureDict = {}
+        self.position = 0
+        self.bytesFetchedLock = threading.Lock()
+        self.bytesFetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence %s' % whence)
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        # Fill the buffer across chunk boundaries: callers such as ZipFile expect
+        # headers to be read in full
+        bufferView = memoryview(buffer).cast('B')
+        bytesCopied = 0
+        while bytesCopied < len(bufferView) and self.position < self.size:
+            chunkIndex = self.position // self.chunkSize
+            chunk = self._getChunk(chunkIndex)
+            chunkOffset = self.position - chunkIndex * self.chunkSize
+            length = min(len(bufferView) - bytesCopied, len(chunk) - chunkOffset)
+            bufferView[bytesCopied:bytesCopied + length] = chunk[chunkOffset:chunkOffset + length]
+            bytesCopied += length
+            self.position += length
+        return bytesCopied
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.chunkFutureDict = {}
+        super().close()
+
+    def _fetchChunk(self, chunkIndex):
+        start = chunkIndex * self.chunkSize
+        end = min(start + self.chunkSize, self.size) - 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end))
+        chunk = response['Body'].read()
+        with self.bytesFetchedLock:
+            self.bytesFetched += len(chunk)
+        return chunk
+
+    def _getChunk(self, chunkIndex):
+        # Schedule this chunk and the next ones, and forget the chunks out of the read-ahead window
+        lastChunkIndex = min(chunkIndex + self.readAheadChunks, self.numberOfChunks - 1)
+        for index in range(chunkIndex, lastChunkIndex + 1):
+            if index not in self.chunkFutureDict:
+                self.chunkFutureDict[index] = self.executor.submit(self._fetchChunk, index)
+        for index in list(self.chunkFutureDict):
+            if index < chunkIndex - 1 or index > lastChunkIndex:
+                self.chunkFutureDict.pop(index).cancel()
+        return self.chunkFutureDict[chunkIndex].result()
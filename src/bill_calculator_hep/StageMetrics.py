@@ -0,0 +1,42 @@
+import contextlib
+import threading
+import time
+
+
+class StageMetrics(object):
+    """Durations and counters of the stages of a billing calculation, published as self-monitoring metrics.
+
+    stage(name) times a block: its wall time and number of calls add up under <name>.seconds and
+    <name>.calls, so a stage run several times (e.g. one download per billing file) reports its total.
+    count(name, value) adds up a counter, e.g. the rows parsed or the bytes downloaded.
+    One instance follows an account through its chain (calculator, alarm, data egress, notifications);
+    it is thread safe, since the queries of a calculation may run in several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metricDict = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the block as the stage name, even if it raises"""
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.merge({ name + '.seconds': time.perf_counter() - startTime, name + '.calls': 1 })
+
+    def count(self, name, value = 1):
+        """Add value to the counter name"""
+        self.merge({ name: value })
+
+    def merge(self, metricDict):
+        """Add up the metrics of metricDict, e.g. as returned by asDict in another process"""
+        with self.lock:
+            for name, value in metricDict.items():
+                self.metricDict[name] = self.metricDict.get(name, 0) + value
+
+    def asDict(self):
+        """Return the metrics as { name : value }, e.g. { 'download.seconds': 12.3, 'download.calls': 2, 'downloadedBytes': 123456 }"""
+        with self.lock:
+            return dict(self.metricDict)
@@ -4,6 +4,14 @@ import time
 import _pickle as cPickle
 import struct
 import socket
+import select
+import threading
+import queue
+import os
+import fcntl
+import contextlib
+import atexit
+import multiprocessing.util
 import sys
 
 logger = logging.getLogger(__name__)
@@ -19,40 +27,375 @@ def sanitize_key(key):
         key = key.replace(old, new)
     return key
 
+class GraphiteConnectionPool(object):
+    """Pool of persistent connections to one carbon pickle receiver.
+
+    Connections are kept open between sends and shared by all the Graphite
+    objects (and threads) sending to the same host and port.
+    """
+    def __init__(self, host, port, max_idle=4, timeout=10):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """return an idle connection that is still open, or a new one"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                s = self.idle.pop()
+            # carbon never writes on the pickle port: a readable socket was closed by the server
+            try:
+                readable, _, _ = select.select([s], [], [], 0)
+            except (OSError, ValueError):
+                readable = [s]
+            if not readable:
+                return s
+            s.close()
+        return socket.create_connection((self.host, self.port), timeout=self.timeout)
+
+    def release(self, s):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(s)
+                return
+        s.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for s in idle:
+            s.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(host, port):
+    """return the connection pool shared by all the senders to host:port"""
+    with _pools_lock:
+        if (host, port) not in _pools:
+            _pools[(host, port)] = GraphiteConnectionPool(host, port)
+        return _pools[(host, port)]
+
 class Graphite(object):
     def __init__(self,host="fifemondata.fnal.gov",pickle_port=2004):
         self.graphite_host = host
         self.graphite_pickle_port = pickle_port
+        self.pool = get_pool(host, pickle_port)
 
     def send_dict(self,namespace, data, send_data=True, timestamp=None, batch_size=1000):
         """send data contained in dictionary as {k: v} to graphite dataset
-        $namespace.k with current timestamp"""
+        $namespace.k with current timestamp
+
+        returns (points, bytes) sent"""
         if data is None:
             logger.warning("send_dict called with no data")
-            return
+            return 0, 0
+        return self.send_dicts({namespace: data}, send_data=send_data, timestamp=timestamp, batch_size=batch_size)
+
+    def send_dicts(self, namespace_data, send_data=True, timestamp=None, batch_size=1000):
+        """send the dictionaries of several namespaces as {namespace: {k: v}}, packed
+        together in as few pickle payloads of up to batch_size points as possible
+
+        returns (points, bytes) sent"""
         if timestamp is None:
             timestamp=time.time()
         post_data=[]
-        # turning data dict into [('$path.$key',($timestamp,$value)),...]]
-        for k,v in data.items():
-            t = (namespace+"."+k, (timestamp, v))
-            post_data.append(t)
-            logger.debug(str(t))
-        for i in range(len(post_data)//batch_size + 1):
+        # turning data dicts into [('$path.$key',($timestamp,$value)),...]]
+        for namespace, data in namespace_data.items():
+            if data is None:
+                logger.warning("send_dicts called with no data for %s" % namespace)
+                continue
+            for k,v in data.items():
+                t = (namespace+"."+k, (timestamp, v))
+                post_data.append(t)
+                logger.debug(str(t))
+        return self.send_points(post_data, send_data=send_data, batch_size=batch_size)
+
+    def send_points(self, post_data, send_data=True, batch_size=1000, raise_errors=False):
+        """send [('$path.$key',($timestamp,$value)),...] in pickle payloads of up to batch_size points
+
+        returns (points, bytes) sent; errors are logged, or raised as socket.error if raise_errors"""
+        messages = []
+        for i in range(0, len(post_data), batch_size):
             # pickle data
-            payload = cPickle.dumps(post_data[i*batch_size:(i+1)*batch_size], protocol=2)
+            payload = cPickle.dumps(post_data[i:i+batch_size], protocol=2)
             header = struct.pack("!L", len(payload))
-            message = header + payload
-            # throw data at graphite
-            if send_data:
-                s=socket.socket()
-                try:
-                    s.connect( (self.graphite_host, self.graphite_pickle_port) )
-                    s.sendall(message)
-                except socket.error as e:
-                    logger.error("unable to send data to graphite at %s:%d\n" % (self.graphite_host,self.graphite_pickle_port))
-                finally:
-                    s.close()
+            messages.append(header + payload)
+        message = b''.join(messages)
+        if not send_data or not message:
+            return 0, 0
+        # throw data at graphite, on a pooled connection; acquire discards the connections closed by the
+        # server since their last use. The data is sent again on a new connection only if the write failed
+        # before any of it went out: once part of it is written, sending it all again would duplicate points
+        for attempt in range(2):
+            try:
+                s = self.pool.acquire()
+            except socket.error as e:
+                if raise_errors:
+                    raise
+                logger.error("unable to connect to graphite at %s:%d: %s\n" % (self.graphite_host,self.graphite_pickle_port,e))
+                return 0, 0
+            bytes_written = 0
+            try:
+                view = memoryview(message)
+                while bytes_written < len(message):
+                    bytes_written += s.send(view[bytes_written:])
+            except socket.error as e:
+                s.close()
+                if attempt == 0 and bytes_written == 0:
+                    logger.debug("graphite connection to %s:%d lost, reconnecting: %s" % (self.graphite_host,self.graphite_pickle_port,e))
+                    continue
+                if raise_errors:
+                    raise
+                logger.error("unable to send data to graphite at %s:%d after %d of %d bytes\n" % (self.graphite_host,self.graphite_pickle_port,bytes_written,len(message)))
+                return 0, 0
+            self.pool.release(s)
+            logger.debug("sent %d points (%d bytes) to graphite at %s:%d" % (len(post_data),len(message),self.graphite_host,self.graphite_pickle_port))
+            return len(post_data), len(message)
+
+class GraphitePublisher(object):
+    """Send data to graphite from a background thread, without blocking the caller.
+
+    Points are put in a bounded in-memory queue drained by a sender thread. Points that
+    cannot be queued (queue full) or delivered (graphite down) are appended to a spool
+    file, and replayed in timestamp order once graphite accepts data again.
+
+    Has the send_dicts interface of Graphite, so it can back a GraphiteBatch.
+
+    The spool file can be shared by the publishers of several processes (one per process, see
+    get_publisher): appending to the spool and moving it aside for a replay are serialized with
+    a file lock, and a single process at a time replays it.
+    """
+    def __init__(self, endpoint, spool_file, max_queued_points=10000, retry_interval=60, batch_size=1000):
+        self.endpoint = endpoint
+        self.spool_file = spool_file
+        self.replay_file = spool_file + ".replay"
+        self.spool_lock_file = spool_file + ".lock"
+        self.replay_lock_file = self.replay_file + ".lock"
+        self.max_queued_points = max_queued_points
+        self.retry_interval = retry_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.spool_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "queued_points": 0,     # points in the queue now
+            "max_queued_points": 0, # highest number of points in the queue
+            "queue_full": 0,        # publications spooled because the queue was full
+            "sent_points": 0,
+            "sent_bytes": 0,
+            "send_errors": 0,
+            "spooled_points": 0,
+            "replayed_points": 0,
+        }
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="graphite-publisher", daemon=True)
+        self.thread.start()
+
+    def get_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def _count(self, **increments):
+        with self.stats_lock:
+            for k,v in increments.items():
+                self.stats[k] += v
+            self.stats["max_queued_points"] = max(self.stats["max_queued_points"], self.stats["queued_points"])
+
+    def send_dicts(self, namespace_data, send_data=True, timestamp=None, batch_size=None):
+        """queue the dictionaries of several namespaces as {namespace: {k: v}}
+
+        returns (points, 0): the bytes are counted by the sender thread"""
+        if timestamp is None:
+            timestamp=time.time()
+        post_data=[]
+        for namespace, data in namespace_data.items():
+            if data is None:
+                logger.warning("send_dicts called with no data for %s" % namespace)
+                continue
+            for k,v in data.items():
+                post_data.append((namespace+"."+k, (timestamp, v)))
+        if not send_data or not post_data:
+            return 0, 0
+        self.publish(post_data)
+        return len(post_data), 0
+
+    def send_dict(self, namespace, data, send_data=True, timestamp=None, batch_size=None):
+        if data is None:
+            logger.warning("send_dict called with no data")
+            return 0, 0
+        return self.send_dicts({namespace: data}, send_data=send_data, timestamp=timestamp)
+
+    def publish(self, post_data):
+        """queue [('$path.$key',($timestamp,$value)),...], or spool it if the queue is full or closed"""
+        with self.stats_lock:
+            accepted = not self.closed and self.stats["queued_points"] + len(post_data) <= self.max_queued_points
+            if accepted:
+                self.stats["queued_points"] += len(post_data)
+                self.stats["max_queued_points"] = max(self.stats["max_queued_points"], self.stats["queued_points"])
+            else:
+                self.stats["queue_full"] += 1
+        if accepted:
+            self.queue.put(post_data)
+        else:
+            logger.warning("graphite publisher queue full: spooling %d points" % len(post_data))
+            self._spool(post_data)
+
+    def close(self, timeout=30):
+        """send the queued points for up to timeout seconds, then spool the remaining ones"""
+        with self.stats_lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+        # The sender thread did not finish in time: keep the points it did not take
+        while True:
+            try:
+                post_data = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if post_data is not None:
+                self._count(queued_points=-len(post_data))
+                self._spool(post_data)
+        logger.info("graphite publisher closed: %s" % self.get_stats())
+
+    def _run(self):
+        while True:
+            try:
+                post_data = self.queue.get(timeout=self.retry_interval)
+            except queue.Empty:
+                post_data = []
+            if post_data is None:
+                break
+            # the thread must survive any error, or the points would only pile up in the spool
+            try:
+                self._count(queued_points=-len(post_data))
+                if post_data:
+                    if not self._send(post_data):
+                        self._spool(post_data)
+                        continue
+                # graphite is up: replay what was spooled
+                if os.path.exists(self.spool_file) or os.path.exists(self.replay_file):
+                    self._replay()
+            except Exception as e:
+                logger.exception("graphite publisher error, %d points may be lost: %s" % (len(post_data), e))
+
+    @contextlib.contextmanager
+    def _file_lock(self, lock_file, blocking=True):
+        """exclusive flock on lock_file, held by this process and thread only;
+        yields False without waiting if not blocking and the lock is held elsewhere"""
+        with open(lock_file, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _send(self, post_data):
+        try:
+            points, bytes_sent = self.endpoint.send_points(post_data, batch_size=self.batch_size, raise_errors=True)
+        except socket.error as e:
+            logger.warning("unable to send %d points to graphite at %s:%d, keeping them in %s: %s" % \
+                (len(post_data),self.endpoint.graphite_host,self.endpoint.graphite_pickle_port,self.spool_file,e))
+            self._count(send_errors=1)
+            return False
+        self._count(sent_points=points, sent_bytes=bytes_sent)
+        return True
+
+    def _spool(self, post_data):
+        # append-only: one framed pickle record per write
+        payload = cPickle.dumps(post_data, protocol=2)
+        with self.spool_lock, self._file_lock(self.spool_lock_file):
+            with open(self.spool_file, "ab") as spool:
+                spool.write(struct.pack("!L", len(payload)) + payload)
+        self._count(spooled_points=len(post_data))
+
+    def _replay(self):
+        # The spool is moved aside, so that new points can be spooled while it is being sent.
+        # If sending fails, the replay file is kept, and sent again next time.
+        # Only one process replays at a time: the others skip, rather than send the same points again
+        with self._file_lock(self.replay_lock_file, blocking=False) as locked:
+            if not locked:
+                return
+            with self.spool_lock, self._file_lock(self.spool_lock_file):
+                if not os.path.exists(self.replay_file):
+                    try:
+                        os.replace(self.spool_file, self.replay_file)
+                    except FileNotFoundError:
+                        return
+            post_data = []
+            try:
+                with open(self.replay_file, "rb") as replay:
+                    while True:
+                        header = replay.read(4)
+                        if len(header) < 4:
+                            break
+                        length, = struct.unpack("!L", header)
+                        payload = replay.read(length)
+                        if len(payload) < length:
+                            logger.warning("ignoring truncated record at the end of %s" % self.replay_file)
+                            break
+                        try:
+                            post_data.extend(cPickle.loads(payload))
+                        except Exception as e:
+                            logger.warning("ignoring corrupted record in %s: %s" % (self.replay_file, e))
+            except FileNotFoundError:
+                return
+            post_data.sort(key=lambda t: t[1][0])
+            logger.info("replaying %d spooled points to graphite" % len(post_data))
+            if not self._send(post_data):
+                return
+            try:
+                os.remove(self.replay_file)
+            except FileNotFoundError:
+                pass
+            self._count(replayed_points=len(post_data))
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+def get_publisher(host, spool_file, pickle_port=2004, **kwargs):
+    """return the publisher to host:port for this process, started on first use
+    and closed when the process exits"""
+    with _publishers_lock:
+        key = (os.getpid(), host, pickle_port)
+        if key not in _publishers:
+            publisher = GraphitePublisher(Graphite(host=host, pickle_port=pickle_port), spool_file, **kwargs)
+            # multiprocessing workers exit without running atexit handlers, but run these finalizers
+            atexit.register(publisher.close)
+            multiprocessing.util.Finalize(None, publisher.close, exitpriority=10)
+            _publishers[key] = publisher
+        return _publishers[key]
+
+class GraphiteBatch(object):
+    """Collect the dictionaries of several namespaces, e.g. over an account cycle,
+    and send them at once with Graphite.send_dicts"""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.namespace_data = {}
+
+    def add_dict(self, namespace, data):
+        if data is None:
+            logger.warning("add_dict called with no data")
+            return
+        self.namespace_data.setdefault(namespace, {}).update(data)
+
+    def flush(self, send_data=True):
+        """send the collected data; returns (points, bytes) sent"""
+        namespace_data, self.namespace_data = self.namespace_data, {}
+        if not namespace_data:
+            return 0, 0
+        return self.endpoint.send_dicts(namespace_data, send_data=send_data)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,89 @@
+import logging
+import os
+import sys
+
+import pytest
+
+from bill_calculator_hep.AWSBillAnalysis import AWSBillCalculator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from generate_aws_bills import generateBillFiles
+
+# Windows as '%m/%d/%y %H:%M': within a month, across the Jan -> Feb 2016 switch to the
+# with-resources-and-tags format, across the Feb -> Mar boundary, and over the three months
+WINDOWS = [ ( '01/15/16 00:00', None ),
+            ( '01/03/16 05:00', '01/09/16 17:00' ),
+            ( '01/20/16 00:00', '02/10/16 12:00' ),
+            ( '02/25/16 06:00', '03/05/16 00:00' ),
+            ( '01/01/16 00:00', '03/31/16 23:00' ) ]
+
+SUPPORT_COST_SCALE = 1000
+
+CONFIGURATIONS = [ { 'billEngine': 'numpy' },
+                   { 'billEngine': 'index' },
+                   { 'billChunkRows': 500 },
+                   { 'billFileWorkers': 2 },
+                   { 'billFileWorkers': 2, 'billFileChunkMB': 0.05 },
+                   { 'billFileWorkers': 2, 'billFileChunkMB': 0.05, 'billEngine': 'numpy' },
+                   { 'billFileWorkers': 2, 'billEngine': 'index' },
+                   { 'lineItemCache': 1 },
+                   { 'lineItemCache': 1, 'billEngine': 'numpy' },
+                   { 'lineItemCache': 1, 'billFileWorkers': 2, 'billEngine': 'index' } ]
+
+
+@pytest.fixture(scope='module')
+def bill_files(tmp_path_factory):
+    outputPath = str(tmp_path_factory.mktemp('bills'))
+    return outputPath, generateBillFiles(outputPath, 6000, months=3, firstMonth='2016-01')
+
+
+def make_calculator(outputPath, billFileList, extraConfig):
+    globalConfig = { 'outputPath': outputPath, 'graphite_host': 'localhost', 'grafana_dashboard': 'dashboard' }
+    globalConfig.update(extraConfig)
+    constants = { 'credentialsProfileName': 'profile', 'accountNumber': 123456789012, 'bucketBillingName': 'bucket',
+                  'lastKnownBillDate': '01/15/16 00:00', 'balanceAtDate': 100000.0, 'applyDiscount': True }
+    calculator = AWSBillCalculator('test', globalConfig, constants, logging.getLogger('test'))
+    # The files are already local: no S3 listing nor download
+    calculator._downloadBillFiles = lambda: billFileList
+    calculator.billFileIdentityDict = dict( ( billFileName, ( '"etag"', os.path.getsize(billFileName) ) ) for billFileName in billFileList )
+    # The generated months cost a few hundred dollars: scale them up so that the windows cross all the support tiers
+    calculator._calculateTieredSupportCost = lambda monthlyCost: AWSBillCalculator._calculateTieredSupportCost(calculator, SUPPORT_COST_SCALE * monthlyCost)
+    return calculator
+
+
+def reference_windows(outputPath, billFileList):
+    # Each window summed up on its own, straight from the parsed line items, by the python engine
+    calculator = make_calculator(outputPath, billFileList, {})
+    windowResultList = []
+    for sumFromDate, sumToDate in WINDOWS:
+        lineItems = calculator._normalizeBillRows(calculator._aggregateBillFiles(billFileList))
+        lastStartDateBilledConsideredDatetime, BillSummaryDict = calculator._sumUpBillFromDateToDate(lineItems, sumFromDate, sumToDate)
+        windowResultList.append( ( lastStartDateBilledConsideredDatetime, calculator._applyBillCorrections(BillSummaryDict) ) )
+    return windowResultList
+
+
+def assert_same_windows(windowResultList, referenceWindowResultList):
+    assert len(windowResultList) == len(referenceWindowResultList)
+    for ( lastStartDate, summaryDict ), ( referenceLastStartDate, referenceSummaryDict ) in zip(windowResultList, referenceWindowResultList):
+        assert lastStartDate == referenceLastStartDate
+        summaryDict = dict(summaryDict)
+        summaryDict.pop('AccountName', None)
+        assert summaryDict.keys() == referenceSummaryDict.keys()
+        for key, value in referenceSummaryDict.items():
+            assert summaryDict[key] == pytest.approx(value, rel=1e-9, abs=1e-6), key
+
+
+def test_python_engine_matches_single_windows(bill_files):
+    outputPath, billFileList = bill_files
+    calculator = make_calculator(outputPath, billFileList, {})
+    assert_same_windows(calculator.CalculateBillForWindows(WINDOWS), reference_windows(outputPath, billFileList))
+
+
+@pytest.mark.parametrize('extraConfig', CONFIGURATIONS, ids=lambda extraConfig: ','.join('%s=%s' % item for item in sorted(extraConfig.items())))
+def test_engines_match_python_engine(bill_files, extraConfig):
+    outputPath, billFileList = bill_files
+    referenceWindowResultList = reference_windows(outputPath, billFileList)
+    calculator = make_calculator(outputPath, billFileList, extraConfig)
+    assert_same_windows(calculator.CalculateBillForWindows(WINDOWS), referenceWindowResultList)
+    # Later windows are summed up from what the first call read
+    assert_same_windows(calculator.CalculateBillForWindows(WINDOWS[::-1]), referenceWindowResultList[::-1])
@@ -0,0 +1,66 @@
+import logging
+import os
+import zipfile
+
+from bill_calculator_hep.AWSBillAnalysis import AWSBillCalculator
+
+BILL_FILE_NAME = '123456789012-aws-billing-detailed-line-items-with-resources-and-tags-2016-03.csv'
+HEADER = 'InvoiceID,ProductName,ItemDescription,UsageStartDate,UsageQuantity,UnblendedCost,ResourceId\n'
+# The second record has a quoted ItemDescription with a newline and doubled quotes
+ROWS = [ 'Estimated,Amazon Elastic Compute Cloud,"$0.05 per On Demand Linux m1.small Instance Hour",2016-03-01 00:00:00,1.0,0.05,i-1\n',
+         'Estimated,Amazon Simple Storage Service,"$0.09 per GB - first 10 TB\n""data transfer out""",2016-03-01 01:00:00,2.0,0.18,\n',
+         'Estimated,Amazon Route 53,"0.50 per Hosted Zone",2016-03-01 02:00:00,1.0,0.5,\n',
+         '"Invoice total","","",,,0.73,\n' ]
+
+
+def make_calculator(outputPath):
+    globalConfig = { 'outputPath': outputPath, 'graphite_host': 'localhost', 'grafana_dashboard': 'dashboard' }
+    constants = { 'credentialsProfileName': 'profile', 'accountNumber': 123456789012, 'bucketBillingName': 'bucket',
+                  'lastKnownBillDate': '03/01/16 00:00', 'balanceAtDate': 1000.0, 'applyDiscount': True }
+    return AWSBillCalculator('test', globalConfig, constants, logging.getLogger('test'))
+
+
+def make_bill_file(tmp_path, rows):
+    billFileName = str(tmp_path / (BILL_FILE_NAME + '.zip'))
+    with zipfile.ZipFile(billFileName, 'w', zipfile.ZIP_DEFLATED) as zipFile:
+        zipFile.writestr(BILL_FILE_NAME, HEADER + ''.join(rows))
+    return billFileName
+
+
+def read_ranges(calculator, csvFileName, headerList, byteRangeList):
+    billRows = []
+    for start, end in byteRangeList:
+        billRows += list(calculator._readBillCSVRange(csvFileName, headerList, start, end))
+    return billRows
+
+
+def test_split_does_not_end_a_chunk_on_a_quoted_newline(tmp_path):
+    calculator = make_calculator(str(tmp_path))
+    billFileName = make_bill_file(tmp_path, ROWS)
+    # The first chunk reaches the second record just before its quoted newline
+    chunkBytes = len(ROWS[0]) + ROWS[1].index('\n') - 1
+    csvFileName, headerList, byteRangeList = calculator._splitBillFile(billFileName, chunkBytes)
+    try:
+        assert headerList == HEADER.rstrip('\n').split(',')
+        secondRecordEnd = len(HEADER) + len(ROWS[0]) + len(ROWS[1])
+        assert byteRangeList[0] == ( len(HEADER), secondRecordEnd )
+        assert [ billRow[0] for billRow in read_ranges(calculator, csvFileName, headerList, byteRangeList[:1]) ] == \
+               [ '2016-03-01 00:00:00', '2016-03-01 01:00:00' ]
+    finally:
+        os.remove(csvFileName)
+
+
+def test_split_chunks_reassemble_into_the_file(tmp_path):
+    calculator = make_calculator(str(tmp_path))
+    billFileName = make_bill_file(tmp_path, ROWS * 50)
+    expectedBillRows = list(calculator._aggregateBillFiles([ billFileName ]))
+    for chunkBytes in ( 1, 7, 64, 1000, 1000000 ):
+        csvFileName, headerList, byteRangeList = calculator._splitBillFile(billFileName, chunkBytes)
+        try:
+            # The ranges follow each other from the end of the header to the end of the file
+            assert byteRangeList[0][0] == len(HEADER)
+            assert all( previousEnd == start for ( _, previousEnd ), ( start, _ ) in zip(byteRangeList, byteRangeList[1:]) )
+            assert byteRangeList[-1][1] == os.path.getsize(csvFileName)
+            assert read_ranges(calculator, csvFileName, headerList, byteRangeList) == expectedBillRows
+        finally:
+            os.remove(csvFileName)